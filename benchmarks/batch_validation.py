@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Per-row overhead of checked evaluation against the validated batch path
+
+Corrections with a simple tree, a single binning or a single category, and
+a compound correction of two such binnings, are evaluated row by row through
+the checked evaluate, which validates the number and types of the inputs on
+each call, and on arrays through evalv and the ufunc, which validate them once
+per call or block. With so little work per row, the difference between the
+two is the per-row cost of the checks and of the call itself.
+
+Usage: python benchmarks/batch_validation.py [--size N] [--repeat R]
+"""
+import argparse
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy
+
+import correctionlib
+import correctionlib.schemav2 as schema
+
+OUTPUT = schema.Variable(name="weight", type="real")
+PT = schema.Variable(name="pt", type="real")
+DM = schema.Variable(name="dm", type="int")
+SYST = schema.Variable(name="syst", type="string")
+EDGES = [15.0 + 5.0 * i for i in range(21)]
+DECAY_MODES = [0, 1, 2, 10, 11]
+SYSTEMATICS = ["nom", "up", "down"]
+
+
+def binning(name: str) -> schema.Correction:
+    return schema.Correction(
+        name=name,
+        version=1,
+        inputs=[PT],
+        output=OUTPUT,
+        data={
+            "nodetype": "binning",
+            "input": "pt",
+            "edges": EDGES,
+            "content": [1.0 + 0.01 * i for i in range(len(EDGES) - 1)],
+            "flow": "clamp",
+        },
+    )
+
+
+def category(name: str, var: schema.Variable, keys: List[Any]) -> schema.Correction:
+    return schema.Correction(
+        name=name,
+        version=1,
+        inputs=[var],
+        output=OUTPUT,
+        data={
+            "nodetype": "category",
+            "input": var.name,
+            "content": [
+                {"key": key, "value": 1.0 + 0.01 * i} for i, key in enumerate(keys)
+            ],
+        },
+    )
+
+
+def make_correctionset() -> correctionlib.CorrectionSet:
+    cset = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[
+            binning("binning"),
+            binning("binning2"),
+            category("category_int", DM, DECAY_MODES),
+            category("category_str", SYST, SYSTEMATICS),
+        ],
+        compound_corrections=[
+            schema.CompoundCorrection(
+                name="compound",
+                inputs=[PT],
+                output=OUTPUT,
+                inputs_update=["pt"],
+                input_op="*",
+                output_op="*",
+                stack=["binning", "binning2"],
+            )
+        ],
+    )
+    return correctionlib.CorrectionSet.from_string(cset.json(exclude_unset=True))
+
+
+def best_time(func: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--scalar-size", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cset = make_correctionset()
+    rng = numpy.random.default_rng(42)
+    columns: Dict[str, Any] = {
+        "binning": rng.exponential(40.0, size=args.size) + 15.0,
+        "category_int": rng.choice(DECAY_MODES, size=args.size),
+        "category_str": rng.choice(numpy.array(SYSTEMATICS, dtype=object), args.size),
+    }
+    columns["compound"] = columns["binning"]
+
+    print(
+        f"{'correction':>14} {'ns/row (checked)':>17} "
+        f"{'ns/row (evalv)':>15} {'ns/row (ufunc)':>15}"
+    )
+    for name in ["binning", "category_int", "category_str", "compound"]:
+        corr = cset.compound[name] if name == "compound" else cset[name]
+        column = columns[name]
+        rows = column[: args.scalar_size].tolist()
+        evaluate = corr._base.evaluate
+
+        def checked() -> None:
+            for x in rows:
+                evaluate(x)
+
+        tchecked = best_time(checked, args.repeat) / len(rows)
+        tbatch = best_time(lambda: corr._base.evalv(column), args.repeat) / args.size
+        tufunc = best_time(lambda: corr.ufunc(column), args.repeat) / args.size
+        print(
+            f"{name:>14} {tchecked * 1e9:>17.1f} "
+            f"{tbatch * 1e9:>15.1f} {tufunc * 1e9:>15.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
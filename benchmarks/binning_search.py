@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Bin lookup time as a function of the number of edges
+
+A one-dimensional binning with non-uniform edges is evaluated on random
+inputs, for edge counts from a handful to several thousands. Non-uniform
+edges are used since uniformly spaced edges do not need a search at all.
+
+Usage: python benchmarks/binning_search.py [--size N] [--repeat R]
+"""
+import argparse
+import time
+
+import numpy
+
+import correctionlib
+import correctionlib.schemav2 as schema
+
+EDGE_COUNTS = [2, 3, 5, 10, 30, 100, 300, 1000, 3000, 10000]
+
+
+def make_correction(edges: numpy.ndarray) -> correctionlib.highlevel.Correction:
+    corr = schema.Correction(
+        name="binning",
+        version=1,
+        inputs=[schema.Variable(name="x", type="real")],
+        output=schema.Variable(name="weight", type="real"),
+        data={
+            "nodetype": "binning",
+            "input": "x",
+            "edges": list(edges),
+            "content": [float(i) for i in range(len(edges) - 1)],
+            "flow": "clamp",
+        },
+    )
+    cset = schema.CorrectionSet(schema_version=schema.VERSION, corrections=[corr])
+    return correctionlib.CorrectionSet.from_string(cset.json())["binning"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(42)
+    print(f"{'edges':>8} {'ns/eval':>10}")
+    for nedges in EDGE_COUNTS:
+        edges = numpy.cumsum(rng.uniform(0.5, 1.5, size=nedges))
+        corr = make_correction(edges)
+        x = rng.uniform(edges[0], edges[-1], size=args.size)
+        corr.evaluate(x[:1000])
+        best = float("inf")
+        for _ in range(args.repeat):
+            tic = time.perf_counter()
+            corr.evaluate(x)
+            best = min(best, time.perf_counter() - tic)
+        print(f"{nedges:>8} {best / args.size * 1e9:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
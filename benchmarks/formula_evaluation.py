@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Evaluation time of formula-dominated corrections
+
+Corrections whose leaves are TFormula expressions of pt, as in energy scale
+and fake-rate parametrizations, are evaluated one row at a time and on
+arrays. Formulas of increasing size are used, from a linear function to a
+fitted turn-on curve, along with a formula reference to a generic formula,
+so that the cost per row is dominated by evaluating the expression.
+
+Usage: python benchmarks/formula_evaluation.py [--size N] [--repeat R]
+"""
+import argparse
+import time
+from typing import Any, Callable, List
+
+import numpy
+
+import correctionlib
+import correctionlib.schemav2 as schema
+
+EXPRESSIONS = {
+    "linear": "[0]+[1]*x",
+    "log": "[0]*(1+[1]*log(x)+[2]*log(x)^2)",
+    "erf": "([0]+[1]*erf((x-[2])/[3]))*(x<200)+[4]*(x>=200)",
+    "turnon": "max(0.0001,((x<10)*([5]))+((x>=10)*([0]+([1]/(pow(log10(x),2)+[2]))"
+    "+([3]*exp(-([4]*((log10(x)-[5])*(log10(x)-[5]))))))))",
+}
+PARAMETERS = [1.02, 0.1, 0.5, 30.0, 0.9, 1.5]
+INPUTS = [
+    schema.Variable(name="pt", type="real"),
+    schema.Variable(name="eta", type="real"),
+]
+OUTPUT = schema.Variable(name="weight", type="real")
+
+
+def binning(content: Callable[[int], Any]) -> Any:
+    nbins = 10
+    return {
+        "nodetype": "binning",
+        "input": "eta",
+        "edges": [-2.5 + 5.0 * i / nbins for i in range(nbins + 1)],
+        "content": [content(i) for i in range(nbins)],
+        "flow": "clamp",
+    }
+
+
+def make_correctionset() -> correctionlib.CorrectionSet:
+    corrections: List[schema.Correction] = [
+        schema.Correction(
+            name=name,
+            version=1,
+            inputs=INPUTS,
+            output=OUTPUT,
+            data=binning(
+                lambda i: {
+                    "nodetype": "formula",
+                    "expression": expression,
+                    "parser": "TFormula",
+                    "variables": ["pt"],
+                    "parameters": [p * (1 + 0.01 * i) for p in PARAMETERS],
+                }
+            ),
+        )
+        for name, expression in EXPRESSIONS.items()
+    ]
+    corrections.append(
+        schema.Correction(
+            name="turnon_ref",
+            version=1,
+            inputs=INPUTS,
+            output=OUTPUT,
+            generic_formulas=[
+                {
+                    "nodetype": "formula",
+                    "expression": EXPRESSIONS["turnon"],
+                    "parser": "TFormula",
+                    "variables": ["pt"],
+                }
+            ],
+            data=binning(
+                lambda i: {
+                    "nodetype": "formularef",
+                    "index": 0,
+                    "parameters": [p * (1 + 0.01 * i) for p in PARAMETERS],
+                }
+            ),
+        )
+    )
+    cset = schema.CorrectionSet(schema_version=schema.VERSION, corrections=corrections)
+    return correctionlib.CorrectionSet.from_string(cset.json(exclude_unset=True))
+
+
+def best_time(func: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--scalar-size", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cset = make_correctionset()
+    rng = numpy.random.default_rng(42)
+    pt = rng.exponential(40.0, size=args.size) + 15.0
+    eta = rng.uniform(-2.5, 2.5, size=args.size)
+    rows = list(zip(pt[: args.scalar_size].tolist(), eta.tolist()))
+
+    print(f"{'correction':>12} {'ns/row (scalar)':>16} {'ns/row (array)':>15}")
+    for name in list(EXPRESSIONS) + ["turnon_ref"]:
+        corr = cset[name]
+        evaluate = corr._base._scalar_evaluator
+
+        def scalar() -> None:
+            for x, y in rows:
+                evaluate(x, y)
+
+        tscalar = best_time(scalar, args.repeat) / len(rows)
+        tarray = best_time(lambda: corr.evaluate(pt, eta), args.repeat) / args.size
+        print(f"{name:>12} {tscalar * 1e9:>16.1f} {tarray * 1e9:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Load time of formula-heavy correction sets
+
+Sets of corrections made of many TFormula nodes, typical of fitted
+scale factors, are loaded from strings, where the time is dominated by
+parsing the formulas. Loads are done one at a time, with a few expressions
+repeated with different parameters, as in converted files, or with every
+expression distinct. Then several python threads load their own sets at
+once, which only scales if formulas can be parsed concurrently.
+
+Usage: python benchmarks/formula_load.py [--formulas N] [--max-threads T]
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import correctionlib
+import correctionlib.schemav2 as schema
+
+EXPRESSIONS = [
+    "[0]+[1]*x",
+    "[0]*(1+[1]*log(x)+[2]*log(x)^2)",
+    "max(0.,[0]+[1]/(x*x)+[2]*exp(-x/[3]))",
+    "([0]+[1]*erf((x-[2])/[3]))*(x<200)+[4]*(x>=200)",
+    "[0]+[1]*pow(x,[2])+[3]*tanh((x-[4])/[5])",
+]
+
+
+def make_cset(nformulas: int, distinct: bool = False) -> str:
+    nbins = 100
+    corrections = [
+        {
+            "name": f"corr{k}",
+            "version": 1,
+            "inputs": [{"name": "pt", "type": "real"}, {"name": "eta", "type": "real"}],
+            "output": {"name": "weight", "type": "real"},
+            "data": {
+                "nodetype": "binning",
+                "input": "eta",
+                "edges": [-2.5 + 5.0 * i / nbins for i in range(nbins + 1)],
+                "flow": "clamp",
+                "content": [
+                    {
+                        "nodetype": "formula",
+                        "expression": EXPRESSIONS[(k + i) % len(EXPRESSIONS)]
+                        + (f"+{k * nbins + i}*0" if distinct else ""),
+                        "parser": "TFormula",
+                        "variables": ["pt"],
+                        "parameters": [1.0 + 0.001 * i, 0.1, 0.2, 30.0, 0.9, 10.0],
+                    }
+                    for i in range(nbins)
+                ],
+            },
+        }
+        for k in range(max(1, nformulas // nbins))
+    ]
+    return json.dumps({"schema_version": schema.VERSION, "corrections": corrections})
+
+
+def load(data: str) -> Any:
+    return correctionlib.CorrectionSet.from_string(data)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--formulas", type=int, default=20_000)
+    parser.add_argument("--max-threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'expressions':>12} {'formulas':>9} {'time [ms]':>10} {'us/formula':>11}")
+    for distinct in [False, True]:
+        data = make_cset(args.formulas, distinct)
+        load(data)
+        best = float("inf")
+        for _ in range(args.repeat):
+            tic = time.perf_counter()
+            load(data)
+            best = min(best, time.perf_counter() - tic)
+        print(
+            f"{'distinct' if distinct else 'repeated':>12} {args.formulas:>9} "
+            f"{best * 1e3:>10.1f} {best / args.formulas * 1e6:>11.2f}"
+        )
+
+    data = make_cset(args.formulas)
+
+    print(f"{'threads':>8} {'time [s]':>10} {'kformulas/s':>12} {'speedup':>8}")
+    base = None
+    nthreads = 1
+    while nthreads <= args.max_threads:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            tic = time.perf_counter()
+            for _ in pool.map(load, [data] * nthreads):
+                pass
+            elapsed = time.perf_counter() - tic
+        rate = nthreads * args.formulas / elapsed / 1e3
+        base = base or rate
+        print(f"{nthreads:>8} {elapsed:>10.3f} {rate:>12.1f} {rate / base:>8.2f}")
+        nthreads *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Load time and memory of a large correction set, eager and lazy
+
+A set of many corrections, each a binning of formulas, is written to a
+temporary file and loaded, then a couple of its corrections are evaluated.
+Eager loading builds all corrections up front, on one or several threads,
+while lazy loading only builds those accessed. Each measurement runs in a
+fresh process, so that the resident memory reported is that of a single load.
+
+Usage: python benchmarks/lazy_load.py [--corrections N] [--used K] [--nthreads T]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import correctionlib
+import correctionlib.schemav2 as schema
+
+
+def make_correction(name: str, nbins: int) -> Any:
+    return {
+        "name": name,
+        "version": 1,
+        "inputs": [
+            {"name": "pt", "type": "real"},
+            {"name": "eta", "type": "real"},
+        ],
+        "output": {"name": "weight", "type": "real"},
+        "data": {
+            "nodetype": "binning",
+            "input": "eta",
+            "edges": [-2.5 + 5.0 * i / nbins for i in range(nbins + 1)],
+            "flow": "clamp",
+            "content": [
+                {
+                    "nodetype": "formula",
+                    "expression": f"[0]+[1]*log(x)+[2]*exp(-x/{10 + i})",
+                    "parser": "TFormula",
+                    "variables": ["pt"],
+                    "parameters": [1.0 + 0.01 * i, 0.002, -0.1],
+                }
+                for i in range(nbins)
+            ],
+        },
+    }
+
+
+def measure(path: str, lazy: bool, used: int, nthreads: int) -> None:
+    tic = time.perf_counter()
+    cset = correctionlib.CorrectionSet.from_file(path, lazy=lazy, nthreads=nthreads)
+    load = time.perf_counter() - tic
+    tic = time.perf_counter()
+    for name in list(cset)[:used]:
+        cset[name].evaluate(35.0, 1.2)
+    first = time.perf_counter() - tic
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"load": load, "first": first, "rss": rss}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--corrections", type=int, default=300)
+    parser.add_argument("--bins", type=int, default=50)
+    parser.add_argument("--used", type=int, default=2)
+    parser.add_argument("--nthreads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--measure", choices=["eager", "lazy"], help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.path, args.measure == "lazy", args.used, args.nthreads)
+        return
+
+    cset = {
+        "schema_version": schema.VERSION,
+        "corrections": [
+            make_correction(f"corr{i:04d}", args.bins) for i in range(args.corrections)
+        ],
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "cset.json")
+        with open(path, "w") as fout:
+            json.dump(cset, fout)
+        size = os.path.getsize(path) / 1e6
+        print(f"{args.corrections} corrections, {size:.1f} MB, {args.used} used")
+        print(
+            f"{'mode':>6} {'threads':>8} {'load [ms]':>10} {'use [ms]':>10} "
+            f"{'max RSS [MB]':>13}"
+        )
+        runs = [("eager", 1), ("eager", args.nthreads), ("lazy", 1)]
+        for mode, nthreads in sorted(set(runs), key=runs.index):
+            cmd = [sys.executable, __file__, "--measure", mode, "--path", path]
+            cmd += ["--used", str(args.used), "--nthreads", str(nthreads)]
+            result = json.loads(subprocess.check_output(cmd))
+            print(
+                f"{mode:>6} {nthreads:>8} {result['load'] * 1e3:>10.1f} "
+                f"{result['first'] * 1e3:>10.2f} {result['rss']:>13.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
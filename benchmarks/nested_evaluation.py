@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Evaluation time of nested transforms and compound correction stacks
+
+Corrections made of several nested transforms, and compound corrections of
+several JEC-style stages, are evaluated one row at a time and on small
+batches. Both rewrite some inputs before evaluating the next node or stage,
+so their cost per row is sensitive to any copy or allocation made per call.
+
+Usage: python benchmarks/nested_evaluation.py [--size N] [--repeat R]
+"""
+import argparse
+import time
+from typing import Any, Callable, List
+
+import numpy
+
+import correctionlib
+import correctionlib.schemav2 as schema
+
+DEPTHS = [1, 2, 4, 8]
+ERA = "Run2018ABCD_UltraLegacy"
+SYST = "nominal_systematic_variation"
+
+INPUTS = [
+    schema.Variable(name="pt", type="real"),
+    schema.Variable(name="eta", type="real"),
+    schema.Variable(name="era", type="string"),
+    schema.Variable(name="syst", type="string"),
+]
+OUTPUT = schema.Variable(name="weight", type="real")
+
+
+def binning(input: str, nbins: int, content: Callable[[int], Any]) -> Any:
+    return {
+        "nodetype": "binning",
+        "input": input,
+        "edges": [5.0 * i for i in range(nbins + 1)],
+        "content": [content(i) for i in range(nbins)],
+        "flow": "clamp",
+    }
+
+
+def make_transform(depth: int) -> schema.Correction:
+    data = {
+        "nodetype": "category",
+        "input": "syst",
+        "content": [
+            {"key": SYST, "value": binning("pt", 20, lambda i: 1.0 + 0.01 * i)}
+        ],
+    }
+    for _ in range(depth):
+        data = {
+            "nodetype": "transform",
+            "input": "pt",
+            "rule": {
+                "nodetype": "formula",
+                "expression": "x*1.001",
+                "parser": "TFormula",
+                "variables": ["pt"],
+            },
+            "content": data,
+        }
+    return schema.Correction(
+        name=f"transform{depth}",
+        version=1,
+        inputs=INPUTS,
+        output=OUTPUT,
+        data=data,
+    )
+
+
+def make_stage(level: int) -> schema.Correction:
+    return schema.Correction(
+        name=f"L{level}",
+        version=1,
+        inputs=INPUTS,
+        output=OUTPUT,
+        data={
+            "nodetype": "category",
+            "input": "era",
+            "content": [
+                {
+                    "key": ERA,
+                    "value": binning(
+                        "eta",
+                        10,
+                        lambda i: binning("pt", 20, lambda j: 1.0 + 0.001 * (i + j)),
+                    ),
+                }
+            ],
+        },
+    )
+
+
+def make_correctionset() -> correctionlib.CorrectionSet:
+    stages = [make_stage(level) for level in range(max(DEPTHS))]
+    compound = [
+        schema.CompoundCorrection(
+            name=f"jec{depth}",
+            inputs=INPUTS,
+            output=OUTPUT,
+            inputs_update=["pt"],
+            input_op="*",
+            output_op="*",
+            stack=[stage.name for stage in stages[:depth]],
+        )
+        for depth in DEPTHS
+    ]
+    cset = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[make_transform(depth) for depth in DEPTHS] + stages,
+        compound_corrections=compound,
+    )
+    return correctionlib.CorrectionSet.from_string(cset.json(exclude_unset=True))
+
+
+def best_time(func: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    cset = make_correctionset()
+    rng = numpy.random.default_rng(42)
+    pt = rng.uniform(0.0, 100.0, size=args.size)
+    eta = rng.uniform(0.0, 50.0, size=args.size)
+    rows = list(zip(pt.tolist(), eta.tolist()))
+    batches: List[slice] = [slice(i, i + 16) for i in range(0, args.size, 16)]
+
+    print(f"{'correction':>12} {'ns/row':>10} {'ns/row (16)':>12}")
+    for name in [f"transform{d}" for d in DEPTHS] + [f"jec{d}" for d in DEPTHS]:
+        corr = cset.compound[name] if name.startswith("jec") else cset[name]
+
+        def scalar() -> None:
+            for x, y in rows:
+                corr.evaluate(x, y, ERA, SYST)
+
+        def batch() -> None:
+            for s in batches:
+                corr.evaluate(pt[s], eta[s], ERA, SYST)
+
+        tscalar = best_time(scalar, args.repeat)
+        tbatch = best_time(batch, args.repeat)
+        print(
+            f"{name:>12} {tscalar / args.size * 1e9:>10.1f} "
+            f"{tbatch / args.size * 1e9:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Scalar evaluation calls per second
+
+A correction with real, integer and string inputs, and a compound correction
+of two stages, are evaluated one row at a time on python scalars, as done by
+per-event analysis loops. Each call is timed through the high-level evaluate,
+the generic binding, which casts its arguments to variants, and the scalar
+evaluator, which converts them according to the input types.
+
+Usage: python benchmarks/scalar_calls.py [--calls N] [--repeat R]
+"""
+import argparse
+import timeit
+from typing import Any, Callable, Dict
+
+import correctionlib
+import correctionlib.schemav2 as schema
+
+INPUTS = [
+    schema.Variable(name="pt", type="real"),
+    schema.Variable(name="eta", type="real"),
+    schema.Variable(name="dm", type="int"),
+    schema.Variable(name="syst", type="string"),
+]
+OUTPUT = schema.Variable(name="weight", type="real")
+ARGS = (42.5, 1.2, 10, "nom")
+
+
+def make_correction(name: str) -> schema.Correction:
+    return schema.Correction(
+        name=name,
+        version=1,
+        inputs=INPUTS,
+        output=OUTPUT,
+        data={
+            "nodetype": "category",
+            "input": "syst",
+            "content": [
+                {
+                    "key": "nom",
+                    "value": {
+                        "nodetype": "category",
+                        "input": "dm",
+                        "content": [
+                            {
+                                "key": dm,
+                                "value": {
+                                    "nodetype": "binning",
+                                    "input": "pt",
+                                    "edges": [20.0, 30.0, 50.0, 100.0],
+                                    "content": [1.01, 1.02, 1.03],
+                                    "flow": "clamp",
+                                },
+                            }
+                            for dm in (0, 1, 10, 11)
+                        ],
+                    },
+                }
+            ],
+        },
+    )
+
+
+def make_correctionset() -> correctionlib.CorrectionSet:
+    cset = schema.CorrectionSet(
+        schema_version=schema.VERSION,
+        corrections=[make_correction("L1"), make_correction("L2")],
+        compound_corrections=[
+            schema.CompoundCorrection(
+                name="stack",
+                inputs=INPUTS,
+                output=OUTPUT,
+                inputs_update=["pt"],
+                input_op="*",
+                output_op="*",
+                stack=["L1", "L2"],
+            )
+        ],
+    )
+    return correctionlib.CorrectionSet.from_string(cset.json(exclude_unset=True))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--calls", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cset = make_correctionset()
+    print(f"{'correction':>12} {'path':>10} {'ns/call':>10} {'Mcalls/s':>10}")
+    for name, corr in [("L1", cset["L1"]), ("stack", cset.compound["stack"])]:
+        paths: Dict[str, Callable[..., Any]] = {
+            "highlevel": corr.evaluate,
+            "generic": corr._base.evaluate,
+            "scalar": corr._base._scalar_evaluator,
+        }
+        for path, func in paths.items():
+            best = min(
+                timeit.repeat(
+                    lambda: func(*ARGS), number=args.calls, repeat=args.repeat
+                )
+            )
+            print(
+                f"{name:>12} {path:>10} {best / args.calls * 1e9:>10.1f} "
+                f"{args.calls / best / 1e6:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Thread scaling of vectorized evaluation
+
+Several python threads each evaluate a correction on their own large input
+columns. Since the evaluation loop runs without the GIL, the aggregate
+throughput should scale with the number of threads, up to the number of
+available cores.
+
+Usage: python benchmarks/thread_scaling.py [--size N] [--max-threads T]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+import correctionlib
+import correctionlib.schemav2 as schema
+
+
+def make_correction() -> correctionlib.CorrectionSet:
+    formula = {
+        "nodetype": "formula",
+        "expression": "[0]*x + [1]*log(x)",
+        "parser": "TFormula",
+        "variables": ["pt"],
+        "parameters": [1.01, 0.02],
+    }
+    corr = schema.Correction(
+        name="sf",
+        version=1,
+        inputs=[
+            schema.Variable(name="pt", type="real"),
+            schema.Variable(name="eta", type="real"),
+            schema.Variable(name="dm", type="int"),
+        ],
+        output=schema.Variable(name="weight", type="real"),
+        data={
+            "nodetype": "binning",
+            "input": "eta",
+            "edges": [-2.5, -1.5, 0.0, 1.5, 2.5],
+            "flow": "clamp",
+            "content": [
+                {
+                    "nodetype": "category",
+                    "input": "dm",
+                    "content": [{"key": dm, "value": formula} for dm in (0, 1, 10, 11)],
+                    "default": 1.0,
+                }
+            ]
+            * 4,
+        },
+    )
+    cset = schema.CorrectionSet(schema_version=schema.VERSION, corrections=[corr])
+    return correctionlib.CorrectionSet.from_string(cset.json())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--max-threads", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    corr = make_correction()["sf"]
+    rng = numpy.random.default_rng(42)
+    pt = rng.exponential(30.0, size=args.size) + 20.0
+    eta = rng.uniform(-2.5, 2.5, size=args.size)
+    dm = rng.choice([0, 1, 10, 11], size=args.size).astype(numpy.int32)
+    corr.evaluate(pt[:1000], eta[:1000], dm[:1000])
+
+    print(f"{'threads':>8} {'time [s]':>10} {'Mevals/s':>10} {'speedup':>8}")
+    base = None
+    nthreads = 1
+    while nthreads <= args.max_threads:
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            tic = time.perf_counter()
+            futures = [pool.submit(corr.evaluate, pt, eta, dm) for _ in range(nthreads)]
+            for future in futures:
+                future.result()
+            elapsed = time.perf_counter() - tic
+        rate = nthreads * args.size / elapsed / 1e6
+        base = base or rate
+        print(f"{nthreads:>8} {elapsed:>10.3f} {rate:>10.2f} {rate / base:>8.2f}")
+        nthreads *= 2
+
+
+if __name__ == "__main__":
+    main()
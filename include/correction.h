@@ -1,6 +1,8 @@
 #ifndef CORRECTION_H
 #define CORRECTION_H
 
+#include <cstddef>
+#include <cstdint>
 #include <string>
 #include <vector>
 #include <variant>
@@ -13,6 +15,7 @@ namespace correction {
 constexpr int evaluator_version { 2 };
 
 class JSONObject; // internal wrapper around rapidjson
+class Column;
 
 class Variable {
   public:
@@ -25,6 +28,7 @@ class Variable {
     VarType type() const { return type_; };
     std::string typeStr() const;
     void validate(const Type& t) const;
+    void validate(const Column& c) const;
 
   private:
     std::string name_;
@@ -32,6 +36,51 @@ class Variable {
     VarType type_;
 };
 
+// A read-only view of the values of one input for batch evaluation.
+// The data must outlive the column. A stride of zero broadcasts a single
+// value to all rows.
+class Column {
+  public:
+    Column(const int * data, std::ptrdiff_t stride = 1) :
+      type_(Variable::VarType::integer), data_(data), stride_(stride) {};
+    Column(const double * data, std::ptrdiff_t stride = 1) :
+      type_(Variable::VarType::real), data_(data), stride_(stride) {};
+    // string columns are dictionary-encoded: each row is an index into the
+    // array of distinct values, so that lookups can be done once per value
+    Column(const int * codes, const std::string * dictionary, size_t dictionary_size, std::ptrdiff_t stride = 1) :
+      type_(Variable::VarType::string), data_(codes), stride_(stride),
+      dictionary_(dictionary), dictionary_size_(dictionary_size) {};
+    static Column scalar(const Variable::Type& value);
+
+    Variable::VarType type() const { return type_; };
+    bool is_scalar() const { return stride_ == 0; };
+    Column slice(size_t row) const;
+    int integer(size_t row) const { return static_cast<const int*>(data_)[offset(row)]; };
+    double real(size_t row) const { return static_cast<const double*>(data_)[offset(row)]; };
+    const std::string& string(size_t row) const { return dictionary_[code(row)]; };
+    int code(size_t row) const { return static_cast<const int*>(data_)[offset(row)]; };
+    size_t dictionary_size() const { return dictionary_size_; };
+    Variable::Type value(size_t row) const;
+
+  private:
+    std::ptrdiff_t offset(size_t row) const { return static_cast<std::ptrdiff_t>(row) * stride_; };
+
+    Variable::VarType type_;
+    const void * data_;
+    std::ptrdiff_t stride_;
+    const std::string * dictionary_ {nullptr};
+    size_t dictionary_size_ {0};
+};
+
+// The outcome of a row in batch evaluations that record lookup errors per
+// row rather than throwing them for the whole batch
+enum class Status : uint8_t {
+  ok = 0,
+  below_bounds, // input below the edges of a binning with error flow
+  above_bounds, // input above the edges, or NaN, in a binning with error flow
+  missing_key, // input not among the keys of a category without default
+};
+
 class Formula;
 class FormulaRef;
 class Transform;
@@ -79,28 +128,84 @@ class FormulaAst {
       UnaryFcn,
       BinaryFcn
     > NodeData;
-    // TODO: try std::unique_ptr<const Ast> child1, child2 or std::array
     typedef std::vector<FormulaAst> Children;
+    // Generic ASTs by parser type and expression, so that an expression
+    // repeated over many formulas is parsed once and only bound for each
+    typedef std::map<std::pair<ParserType, std::string>, FormulaAst> ParseCache;
 
     static FormulaAst parse(
         ParserType type,
         const std::string_view expression,
         const std::vector<double>& params,
         const std::vector<size_t>& variableIdx,
-        bool bind_parameters
+        bool bind_parameters,
+        ParseCache * cache = nullptr
         );
 
     FormulaAst() : nodetype_(NodeType::Undefined) {};
     FormulaAst(NodeType nodetype, NodeData data, Children children) :
-      nodetype_(nodetype), data_(data), children_(children) {};
+      nodetype_(nodetype), data_(data), children_(std::move(children)) {};
     double evaluate(const std::vector<Variable::Type>& variables, const std::vector<double>& parameters) const;
 
   private:
+    friend class FormulaProgram;
+    void bind(const std::vector<double>& params, const std::vector<size_t>& variableIdx, bool bind_parameters);
+
     NodeType nodetype_;
     NodeData data_;
     Children children_;
 };
 
+// A FormulaAst compiled to a flat postfix program run on a stack, with the
+// subexpressions of literals folded. A block of rows is evaluated one
+// instruction at a time over all rows, each stack slot holding a column.
+class FormulaProgram {
+  public:
+    FormulaProgram(const FormulaAst& ast);
+    double evaluate(const std::vector<Variable::Type>& variables, const std::vector<double>& parameters) const;
+    // evaluates the rows of columns given by rows into out[rows[i]]
+    void evaluate(
+        const std::vector<Column>& columns,
+        const std::vector<double>& parameters,
+        const uint32_t * rows,
+        size_t nrows,
+        double * out
+        ) const;
+
+  private:
+    enum class Op : uint8_t {
+      Literal,
+      Variable,
+      Parameter,
+      Negative,
+      UnaryCall,
+      BinaryCall,
+      Equal,
+      NotEqual,
+      Greater,
+      Less,
+      GreaterEq,
+      LessEq,
+      Minus,
+      Plus,
+      Div,
+      Times,
+      Pow,
+    };
+    struct Instruction {
+      Op op;
+      size_t index; // of the variable or parameter
+      double value;
+      FormulaAst::UnaryFcn unary;
+      FormulaAst::BinaryFcn binary;
+    };
+
+    bool compile(const FormulaAst& ast, size_t depth);
+
+    std::vector<Instruction> code_;
+    size_t depth_ {0}; // the largest stack size reached
+};
+
 class Formula {
   public:
     typedef std::shared_ptr<const Formula> Ref;
@@ -109,11 +214,19 @@ class Formula {
     std::string expression() const { return expression_; };
     double evaluate(const std::vector<Variable::Type>& values) const;
     double evaluate(const std::vector<Variable::Type>& values, const std::vector<double>& parameters) const;
+    void evaluate_batch(const std::vector<Column>& columns, const uint32_t * rows, size_t nrows, double * out) const;
+    void evaluate_batch(
+        const std::vector<Column>& columns,
+        const std::vector<double>& parameters,
+        const uint32_t * rows,
+        size_t nrows,
+        double * out
+        ) const;
 
   private:
     std::string expression_;
     FormulaAst::ParserType type_;
-    std::unique_ptr<FormulaAst> ast_;
+    std::unique_ptr<const FormulaProgram> program_;
     bool generic_;
 };
 
@@ -121,6 +234,7 @@ class FormulaRef {
   public:
     FormulaRef(const JSONObject& json, const Correction& context);
     double evaluate(const std::vector<Variable::Type>& values) const;
+    void evaluate_batch(const std::vector<Column>& columns, const uint32_t * rows, size_t nrows, double * out) const;
 
   private:
     Formula::Ref formula_;
@@ -131,6 +245,9 @@ class Transform {
   public:
     Transform(const JSONObject& json, const Correction& context);
     double evaluate(const std::vector<Variable::Type>& values) const;
+    size_t variable_index() const { return variableIdx_; };
+    const Content& rule() const;
+    const Content& content() const;
 
   private:
     size_t variableIdx_;
@@ -140,14 +257,31 @@ class Transform {
 
 // common internal for Binning and MultiBinning
 enum class _FlowBehavior {value, clamp, error};
+// if the edges are uniformly spaced, the bin of a value is computed rather than searched
+struct _UniformEdges {
+  bool uniform;
+  double low;
+  double inverse_width;
+};
 
 class Binning {
   public:
     Binning(const JSONObject& json, const Correction& context);
     const Content& child(const std::vector<Variable::Type>& values) const;
+    // index-based interface, used by compiled evaluation
+    size_t variable_index() const { return variableIdx_; };
+    // Lookup errors throw, unless status is given: it is then set to the
+    // reason and the largest size_t value is returned instead.
+    size_t index(double value, Status * status = nullptr) const;
+    size_t nchildren() const;
+    const Content& content(size_t idx) const;
 
   private:
-    std::vector<std::tuple<double, Content>> bins_;
+    // edges are kept apart from the content so that searches stay within one contiguous array
+    std::vector<double> edges_;
+    // first element is the default value (underflow position of the edge search)
+    std::vector<Content> content_;
+    _UniformEdges uniform_;
     size_t variableIdx_;
     _FlowBehavior flow_;
 };
@@ -157,10 +291,19 @@ class MultiBinning {
     MultiBinning(const JSONObject& json, const Correction& context);
     size_t ndimensions() const { return axes_.size(); };
     const Content& child(const std::vector<Variable::Type>& values) const;
+    // index-based interface, used by compiled evaluation
+    size_t index(const std::vector<Variable::Type>& values) const;
+    // see Binning::index for status
+    size_t index(const std::vector<Column>& columns, size_t row, Status * status = nullptr) const;
+    size_t nchildren() const;
+    const Content& content(size_t idx) const;
 
   private:
-    // variableIdx, stride, edges
-    std::vector<std::tuple<size_t, size_t, std::vector<double>>> axes_;
+    template<typename F>
+    size_t find_index(F&& axis_value, Status * status) const;
+
+    // variableIdx, stride, edges, uniform
+    std::vector<std::tuple<size_t, size_t, std::vector<double>, _UniformEdges>> axes_;
     std::vector<Content> content_;
     _FlowBehavior flow_;
 };
@@ -169,28 +312,83 @@ class Category {
   public:
     Category(const JSONObject& json, const Correction& context);
     const Content& child(const std::vector<Variable::Type>& values) const;
+    // index-based interface, used by compiled evaluation
+    size_t variable_index() const { return variableIdx_; };
+    // see Binning::index for status
+    size_t index(int value, Status * status = nullptr) const;
+    size_t index(const std::string& value, Status * status = nullptr) const;
+    size_t nchildren() const;
+    const Content& content(size_t idx) const;
 
   private:
-    typedef std::map<int, Content> IntMap;
-    typedef std::map<std::string, Content> StrMap;
+    // Lookup tables from key to index in content_. Integer keys spanning a
+    // compact range use a dense table offset by the lowest key, other keys
+    // an open-addressing hash table (linear probing, power-of-two size).
+    // Missing entries hold the largest size_t value.
+    struct IntMap {
+      int low;
+      std::vector<size_t> dense;
+      std::vector<int> keys;
+      std::vector<size_t> slots;
+    };
+    struct StrMap {
+      std::vector<std::string> keys;
+      std::vector<size_t> slots;
+    };
     std::variant<IntMap, StrMap> map_;
-    std::unique_ptr<const Content> default_;
+    // if there is a default, it is stored at the end of content_
+    std::vector<Content> content_;
+    bool has_default_;
     size_t variableIdx_;
 };
 
+class _Program; // internal: flattened Content tree, defined in correction.cc
+
 class Correction {
   public:
     typedef std::shared_ptr<const Correction> Ref;
 
     Correction(const JSONObject& json);
+    // the compiled program refers to the nodes in data_, so they must not move
+    Correction(const Correction&) = delete;
+    Correction& operator=(const Correction&) = delete;
     std::string name() const { return name_; };
     std::string description() const { return description_; };
     int version() const { return version_; };
     const std::vector<Variable>& inputs() const { return inputs_; };
     size_t input_index(const std::string_view name) const;
     Formula::Ref formula_ref(size_t idx) const { return formula_refs_.at(idx); };
+    // only set while the correction is being built
+    FormulaAst::ParseCache * formula_cache() const { return formula_cache_.get(); };
     const Variable& output() const { return output_; };
     double evaluate(const std::vector<Variable::Type>& values) const;
+    void evaluate_batch(const std::vector<Column>& columns, double * out, size_t n) const;
+    // Check the number and types of the inputs, as evaluate and
+    // evaluate_batch do on each call. The unchecked variants skip this, for
+    // callers evaluating inputs of fixed types many times, which validate once.
+    void validate(const std::vector<Variable::Type>& values) const;
+    void validate(const std::vector<Column>& columns) const;
+    double evaluate_unchecked(const std::vector<Variable::Type>& values) const;
+    void evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, size_t n) const;
+    // As evaluate_batch, but a row failing a lookup gets the fill value and
+    // the reason in status, rather than an exception aborting the batch.
+    // status holds n values, ok for the rows evaluated normally.
+    void evaluate_batch(const std::vector<Column>& columns, double * out, Status * status, double fill, size_t n) const;
+    void evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, Status * status, double fill, size_t n) const;
+    // As evaluate_batch, but only for the rows where select is true: the
+    // outputs of the other rows are left untouched
+    void evaluate_batch(const std::vector<Column>& columns, double * out, const bool * select, size_t n) const;
+    void evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, const bool * select, size_t n) const;
+    // Evaluates n rows for each of the values of one input at once, walking
+    // the shared part of the tree only once per row. The column of that
+    // input is ignored, and out holds n rows of values.size() outputs.
+    void evaluate_variations(
+        const std::vector<Column>& columns,
+        size_t input,
+        const std::vector<Variable::Type>& values,
+        double * out,
+        size_t n
+        ) const;
 
   private:
     std::string name_;
@@ -199,8 +397,10 @@ class Correction {
     std::vector<Variable> inputs_;
     Variable output_;
     std::vector<Formula::Ref> formula_refs_;
+    std::unique_ptr<FormulaAst::ParseCache> formula_cache_;
     bool initialized_; // is data_ filled?
     Content data_;
+    std::shared_ptr<const _Program> program_;
 };
 
 typedef Correction::Ref CorrectionPtr; // deprecated
@@ -217,10 +417,26 @@ class CompoundCorrection {
     size_t input_index(const std::string_view name) const;
     const Variable& output() const { return output_; };
     double evaluate(const std::vector<Variable::Type>& values) const;
+    void evaluate_batch(const std::vector<Column>& columns, double * out, size_t n) const;
+    // see Correction
+    void validate(const std::vector<Variable::Type>& values) const;
+    void validate(const std::vector<Column>& columns) const;
+    double evaluate_unchecked(const std::vector<Variable::Type>& values) const;
+    void evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, size_t n) const;
+    // a row failing a lookup in any stage gets the fill value and the reason
+    // of its first failure
+    void evaluate_batch(const std::vector<Column>& columns, double * out, Status * status, double fill, size_t n) const;
+    void evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, Status * status, double fill, size_t n) const;
+    // see Correction
+    void evaluate_batch(const std::vector<Column>& columns, double * out, const bool * select, size_t n) const;
+    void evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, const bool * select, size_t n) const;
 
   private:
     enum class UpdateOp {Add, Multiply, Divide, Last};
 
+    // the batch evaluations, with any of a status or a selection
+    void evaluate_stages(const std::vector<Column>& columns, double * out, Status * status, double fill, const bool * select, size_t n) const;
+
     std::string name_;
     std::string description_;
     std::vector<Variable> inputs_;
@@ -229,27 +445,50 @@ class CompoundCorrection {
     UpdateOp input_op_;
     UpdateOp output_op_;
     std::vector<std::tuple<std::vector<size_t>, Correction::Ref>> stack_;
+    // whether the inputs of every stage have the type of the compound input
+    // they are taken from, so that stages need no checks of their own
+    bool stack_types_match_;
 };
 
 class CorrectionSet {
   public:
-    static std::unique_ptr<CorrectionSet> from_file(const std::string& fn);
-    static std::unique_ptr<CorrectionSet> from_string(const char * data);
-
-    CorrectionSet(const JSONObject& json);
+    // With lazy, each correction is only parsed and built when first
+    // accessed through at(), so that loading costs time and memory in
+    // proportion to the corrections used. Errors in a correction are then
+    // only raised on its first access. Iterating builds all corrections.
+    // Otherwise the corrections are built on nthreads threads (0 for one
+    // per core), with the same result, or the same error for the first
+    // invalid correction, as when built one after the other.
+    static std::unique_ptr<CorrectionSet> from_file(const std::string& fn, bool lazy = false, size_t nthreads = 1);
+    static std::unique_ptr<CorrectionSet> from_string(const char * data, bool lazy = false, size_t nthreads = 1);
+
+    CorrectionSet(const JSONObject& json, size_t nthreads = 1);
     bool validate();
     int schema_version() const { return schema_version_; };
     std::string description() const { return description_; };
-    auto size() const { return corrections_.size(); };
-    auto begin() const { return corrections_.cbegin(); };
-    auto end() const { return corrections_.cend(); };
-    Correction::Ref at(const std::string& key) const { return corrections_.at(key); };
+    size_t size() const;
+    std::map<std::string, Correction::Ref>::const_iterator begin() const;
+    std::map<std::string, Correction::Ref>::const_iterator end() const;
+    // the names of the corrections, in order, without building any
+    std::vector<std::string> names() const;
+    bool contains(const std::string& key) const;
+    Correction::Ref at(const std::string& key) const;
     Correction::Ref operator[](const std::string& key) const { return at(key); };
     const auto& compound() const { return compoundcorrections_; };
 
   private:
+    // the text of the corrections not built yet, for lazy sets
+    struct Pending;
+
+    CorrectionSet(const JSONObject& json, std::shared_ptr<Pending> pending, size_t nthreads);
+    static std::unique_ptr<CorrectionSet> from_text(std::string text);
+    // builds all pending corrections into corrections_
+    void build_all() const;
+
     int schema_version_;
-    std::map<std::string, Correction::Ref> corrections_;
+    std::shared_ptr<Pending> pending_;
+    // filled on construction, or once iterated for lazy sets
+    mutable std::map<std::string, Correction::Ref> corrections_;
     std::map<std::string, CompoundCorrection::Ref> compoundcorrections_;
     std::string description_;
 };
@@ -1,10 +1,21 @@
 #include <rapidjson/document.h>
 #include <rapidjson/filereadstream.h>
+#include <rapidjson/reader.h>
 #include <rapidjson/error/en.h>
 #include <optional>
 #include <algorithm>
+#include <numeric>
 #include <stdexcept>
 #include <cmath>
+#include <functional>
+#include <limits>
+#include <array>
+#include <deque>
+#include <fstream>
+#include <iterator>
+#include <mutex>
+#include <thread>
+#include <atomic>
 #include "correction.h"
 
 using namespace correction;
@@ -102,6 +113,98 @@ namespace {
     throw std::runtime_error("Invalid Content node type");
   }
 
+  // relative deviation from the average bin width below which edges are uniform
+  constexpr double uniform_edges_tolerance { 1e-6 };
+
+  _UniformEdges find_uniform(const std::vector<double>& edges) {
+    if ( edges.size() < 3 ) {
+      return {false, 0., 0.};
+    }
+    size_t nbins = edges.size() - 1;
+    double low = edges.front();
+    double width = (edges.back() - low) / nbins;
+    if ( ! std::isfinite(low) || ! std::isfinite(width) || width <= 0. ) {
+      return {false, 0., 0.};
+    }
+    for (size_t i=1; i < nbins; ++i) {
+      if ( std::abs(edges[i] - (low + i * width)) > uniform_edges_tolerance * width ) {
+        return {false, 0., 0.};
+      }
+    }
+    return {true, low, 1. / width};
+  }
+
+  // Same as the position of std::upper_bound(edges, value).
+  // For uniform edges the position is computed, then checked against the
+  // neighboring edges, so rounding in the guess never changes the result.
+  // Otherwise a branchless binary search is used: the loop has a fixed trip
+  // count for a given number of edges and compiles to conditional moves,
+  // avoiding branch mispredictions on every probe.
+  size_t edges_upper_bound(const std::vector<double>& edges, const _UniformEdges& uniform, double value) {
+    const size_t nedges = edges.size();
+    if ( uniform.uniform ) {
+      double pos = (value - uniform.low) * uniform.inverse_width;
+      if ( std::isnan(value) ) return nedges;
+      if ( ! (pos >= 0.) ) return 0;
+      size_t i = ( pos >= nedges ) ? nedges : static_cast<size_t>(pos) + 1;
+      while ( i > 0 && edges[i - 1] > value ) --i;
+      while ( i < nedges && edges[i] <= value ) ++i;
+      return i;
+    }
+    if ( nedges == 0 ) return 0;
+    const double * base = edges.data();
+    size_t n = nedges;
+    while ( n > 1 ) {
+      size_t half = n / 2;
+      // same comparison as std::upper_bound, so NaN sorts past the last edge
+      base = ( value < base[half] ) ? base : base + half;
+      n -= half;
+    }
+    return (base - edges.data()) + ( value < *base ? 0 : 1 );
+  }
+
+  constexpr size_t missing_slot { std::numeric_limits<size_t>::max() };
+  // integer category keys use a dense table if it is not much larger than the number of keys
+  constexpr int64_t dense_category_min_size { 64 };
+  constexpr int64_t dense_category_max_ratio { 4 };
+
+  size_t key_hash(int key) {
+    // Fibonacci hashing, so that consecutive keys spread over the table
+    return (static_cast<uint64_t>(static_cast<uint32_t>(key)) * 0x9E3779B97F4A7C15ull) >> 32;
+  }
+
+  size_t key_hash(const std::string& key) {
+    return std::hash<std::string>{}(key);
+  }
+
+  template<typename K>
+  void flat_insert(std::vector<K>& keys, std::vector<size_t>& slots, const K& key, size_t value) {
+    size_t mask = slots.size() - 1;
+    size_t i = key_hash(key) & mask;
+    while ( slots[i] != missing_slot ) i = (i + 1) & mask;
+    keys[i] = key;
+    slots[i] = value;
+  }
+
+  template<typename K>
+  size_t flat_find(const std::vector<K>& keys, const std::vector<size_t>& slots, const K& key) {
+    size_t mask = slots.size() - 1;
+    for (size_t i = key_hash(key) & mask; slots[i] != missing_slot; i = (i + 1) & mask) {
+      if ( keys[i] == key ) return slots[i];
+    }
+    return missing_slot;
+  }
+
+  // hash table at most half full
+  template<typename K, typename M>
+  void flat_build(std::vector<K>& keys, std::vector<size_t>& slots, const M& map) {
+    size_t size {1};
+    while ( size < 2 * map.size() ) size *= 2;
+    keys.assign(size, K());
+    slots.assign(size, missing_slot);
+    for (const auto& [key, value] : map) flat_insert(keys, slots, key, value);
+  }
+
   struct node_evaluate {
     double operator() (double node) { return node; };
     double operator() (const Binning& node) {
@@ -125,6 +228,61 @@ namespace {
 
     const std::vector<Variable::Type>& values;
   };
+
+  // rows are processed in blocks of this size, indexed relative to the block start
+  constexpr size_t batch_block_size { 1024 };
+  typedef uint32_t row_t;
+
+  // the rows of a full block, shared by all block evaluations
+  const row_t * block_rows() {
+    static const auto rows = [] {
+      std::array<row_t, batch_block_size> out;
+      std::iota(out.begin(), out.end(), 0);
+      return out;
+    }();
+    return rows.data();
+  }
+
+  template<typename T>
+  void validate_inputs(const std::vector<Variable>& inputs, const std::vector<T>& values) {
+    if ( values.size() > inputs.size() ) {
+      throw std::runtime_error("Too many inputs");
+    }
+    else if ( values.size() < inputs.size() ) {
+      throw std::runtime_error("Insufficient inputs");
+    }
+    for (size_t i=0; i < inputs.size(); ++i) {
+      inputs[i].validate(values[i]);
+    }
+  }
+
+  // A block evaluated without status throws at the first node pass that
+  // fails, which need not be for its first failing row. Called from the
+  // handler, this evaluates the block again with a status and raises the
+  // error of the first failing of the given rows from the scalar evaluate,
+  // as a row by row evaluation would, else the error being handled.
+  template<typename C>
+  [[noreturn]] void rethrow_first_error(const C& corr, const std::vector<Column>& columns, const row_t * rows, size_t nrows, size_t nblock) {
+    auto error = std::current_exception();
+    // copied, as the evaluations below reuse the buffers they may point to
+    const std::vector<Column> block(columns);
+    const std::vector<row_t> candidates(rows, rows + nrows);
+    std::vector<double> out(nblock);
+    std::vector<Status> status(nblock);
+    size_t first = 0;
+    try {
+      corr.evaluate_batch_unchecked(block, out.data(), status.data(), 0., nblock);
+      while ( first < nrows && status[candidates[first]] == Status::ok ) ++first;
+    } catch (...) {
+      // not a failed lookup, so look for the failing row one at a time
+    }
+    std::vector<Variable::Type> values(block.size());
+    for (size_t i=first; i < nrows; ++i) {
+      for (size_t j=0; j < block.size(); ++j) values[j] = block[j].value(candidates[i]);
+      corr.evaluate_unchecked(values);
+    }
+    std::rethrow_exception(error);
+  }
 }
 
 Variable::Variable(const JSONObject& json) :
@@ -163,6 +321,41 @@ void Variable::validate(const Type& t) const {
   }
 }
 
+void Variable::validate(const Column& c) const {
+  if ( c.type() != type_ ) {
+    std::string got;
+    if ( c.type() == VarType::string ) { got = "string"; }
+    else if ( c.type() == VarType::integer ) { got = "int"; }
+    else if ( c.type() == VarType::real ) { got = "real-valued"; }
+    throw std::runtime_error("Input " + name() + " has wrong type: got " + got + " expected " + typeStr());
+  }
+}
+
+Column Column::scalar(const Variable::Type& value) {
+  if ( auto pval = std::get_if<int>(&value) ) { return Column(pval, 0); }
+  else if ( auto pval = std::get_if<double>(&value) ) { return Column(pval, 0); }
+  static const int code {0};
+  return Column(&code, &std::get<std::string>(value), 1, 0);
+}
+
+Column Column::slice(size_t row) const {
+  switch ( type_ ) {
+    case Variable::VarType::integer: return Column(&static_cast<const int*>(data_)[offset(row)], stride_);
+    case Variable::VarType::real: return Column(&static_cast<const double*>(data_)[offset(row)], stride_);
+    case Variable::VarType::string: return Column(&static_cast<const int*>(data_)[offset(row)], dictionary_, dictionary_size_, stride_);
+  }
+  throw std::logic_error("Invalid column type");
+}
+
+Variable::Type Column::value(size_t row) const {
+  switch ( type_ ) {
+    case Variable::VarType::integer: return integer(row);
+    case Variable::VarType::real: return real(row);
+    case Variable::VarType::string: return string(row);
+  }
+  throw std::logic_error("Invalid column type");
+}
+
 Formula::Formula(const JSONObject& json, const Correction& context, bool generic) :
   expression_(json.getRequired<const char *>("expression")),
   generic_(generic)
@@ -192,18 +385,37 @@ Formula::Formula(const JSONObject& json, const Correction& context, bool generic
     }
   }
 
-  ast_ = std::make_unique<FormulaAst>(FormulaAst::parse(type_, expression_, params, variableIdx, !generic));
+  program_ = std::make_unique<const FormulaProgram>(
+      FormulaAst::parse(type_, expression_, params, variableIdx, !generic, context.formula_cache())
+      );
 }
 
 double Formula::evaluate(const std::vector<Variable::Type>& values) const {
   if ( generic_ ) {
     throw std::runtime_error("Generic formulas must be evaluated with parameters");
   }
-  return ast_->evaluate(values, {});
+  return program_->evaluate(values, {});
 }
 
 double Formula::evaluate(const std::vector<Variable::Type>& values, const std::vector<double>& params) const {
-  return ast_->evaluate(values, params);
+  return program_->evaluate(values, params);
+}
+
+void Formula::evaluate_batch(const std::vector<Column>& columns, const uint32_t * rows, size_t nrows, double * out) const {
+  if ( generic_ ) {
+    throw std::runtime_error("Generic formulas must be evaluated with parameters");
+  }
+  program_->evaluate(columns, {}, rows, nrows, out);
+}
+
+void Formula::evaluate_batch(
+    const std::vector<Column>& columns,
+    const std::vector<double>& params,
+    const uint32_t * rows,
+    size_t nrows,
+    double * out
+    ) const {
+  program_->evaluate(columns, params, rows, nrows, out);
 }
 
 FormulaRef::FormulaRef(const JSONObject& json, const Correction& context) {
@@ -217,6 +429,10 @@ double FormulaRef::evaluate(const std::vector<Variable::Type>& values) const {
   return formula_->evaluate(values, parameters_);
 }
 
+void FormulaRef::evaluate_batch(const std::vector<Column>& columns, const uint32_t * rows, size_t nrows, double * out) const {
+  formula_->evaluate_batch(columns, parameters_, rows, nrows, out);
+}
+
 Transform::Transform(const JSONObject& json, const Correction& context) {
   variableIdx_ = context.input_index(json.getRequired<std::string_view>("input"));
   const auto& variable = context.inputs()[variableIdx_];
@@ -227,6 +443,10 @@ Transform::Transform(const JSONObject& json, const Correction& context) {
   content_ = std::make_unique<Content>(resolve_content(json.getRequiredValue("content"), context));
 }
 
+const Content& Transform::rule() const { return *rule_; }
+
+const Content& Transform::content() const { return *content_; }
+
 double Transform::evaluate(const std::vector<Variable::Type>& values) const {
   std::vector<Variable::Type> new_values(values);
   double vnew = std::visit(node_evaluate{values}, *rule_);
@@ -256,6 +476,7 @@ Binning::Binning(const JSONObject& json, const Correction& context)
   if ( edges.size() != content.Size() + 1 ) {
     throw std::runtime_error("Inconsistency in Binning: number of content nodes does not match binning");
   }
+  uniform_ = find_uniform(edges);
   variableIdx_ = context.input_index(json.getRequired<std::string_view>("input"));
   Content default_value{0.};
   const auto& flowbehavior = json.getRequiredValue("flow");
@@ -269,41 +490,57 @@ Binning::Binning(const JSONObject& json, const Correction& context)
     flow_ = _FlowBehavior::value;
     default_value = resolve_content(flowbehavior, context);
   }
-  bins_.reserve(edges.size());
+  content_.reserve(edges.size());
   // first bin is never accessed for content in range (corresponds to std::upper_bound underflow)
   // use it to store default value
-  bins_.push_back({*edges.begin(), std::move(default_value)});
-  for (size_t i=0; i < content.Size(); ++i) {
-    bins_.push_back({edges[i + 1], resolve_content(content[i], context)});
+  content_.push_back(std::move(default_value));
+  for (const auto& item : content) {
+    content_.push_back(resolve_content(item, context));
   }
+  edges_ = std::move(edges);
 }
 
 const Content& Binning::child(const std::vector<Variable::Type>& values) const {
-  double value = std::get<double>(values[variableIdx_]);
-  auto it = std::upper_bound(std::begin(bins_), std::end(bins_), value, [](const double& a, const auto& b) { return a < std::get<0>(b); });
-  if ( it == std::begin(bins_) ) {
+  return content(index(std::get<double>(values[variableIdx_])));
+}
+
+size_t Binning::nchildren() const { return content_.size(); }
+
+const Content& Binning::content(size_t idx) const { return content_[idx]; }
+
+size_t Binning::index(double value, Status * status) const {
+  size_t idx = edges_upper_bound(edges_, uniform_, value);
+  if ( idx == 0 ) {
     if ( flow_ == _FlowBehavior::value ) {
-      // default value already at std::begin
+      // default value already at index 0
     }
     else if ( flow_ == _FlowBehavior::error ) {
+      if ( status != nullptr ) {
+        *status = Status::below_bounds;
+        return missing_slot;
+      }
       throw std::runtime_error("Index below bounds in Binning for input argument " + std::to_string(variableIdx_) + " value: " + std::to_string(value));
     }
     else { // clamp
-      it++;
+      idx++;
     }
   }
-  else if ( it == std::end(bins_) ) {
+  else if ( idx == edges_.size() ) {
     if ( flow_ == _FlowBehavior::value ) {
-      it = std::begin(bins_);
+      idx = 0;
     }
     else if ( flow_ == _FlowBehavior::error ) {
+      if ( status != nullptr ) {
+        *status = Status::above_bounds;
+        return missing_slot;
+      }
       throw std::runtime_error("Index above bounds in Binning for input argument " + std::to_string(variableIdx_) + " value: " + std::to_string(value));
     }
     else { // clamp
-      it--;
+      idx--;
     }
   }
-  return std::get<1>(*it);
+  return idx;
 }
 
 MultiBinning::MultiBinning(const JSONObject& json, const Correction& context)
@@ -323,7 +560,8 @@ MultiBinning::MultiBinning(const JSONObject& json, const Correction& context)
     }
     const auto& input = inputs[idx];
     if ( ! input.IsString() ) { throw std::runtime_error("invalid multibinning input type"); }
-    axes_.push_back({context.input_index(input.GetString()), 0, std::move(dim_edges)});
+    auto uniform = find_uniform(dim_edges);
+    axes_.push_back({context.input_index(input.GetString()), 0, std::move(dim_edges), uniform});
     idx++;
   }
 
@@ -356,15 +594,36 @@ MultiBinning::MultiBinning(const JSONObject& json, const Correction& context)
 }
 
 const Content& MultiBinning::child(const std::vector<Variable::Type>& values) const {
+  return content_[index(values)];
+}
+
+size_t MultiBinning::index(const std::vector<Variable::Type>& values) const {
+  return find_index([&](size_t variableIdx) { return std::get<double>(values[variableIdx]); }, nullptr);
+}
+
+size_t MultiBinning::nchildren() const { return content_.size(); }
+
+const Content& MultiBinning::content(size_t idx) const { return content_[idx]; }
+
+size_t MultiBinning::index(const std::vector<Column>& columns, size_t row, Status * status) const {
+  return find_index([&](size_t variableIdx) { return columns[variableIdx].real(row); }, status);
+}
+
+template<typename F>
+size_t MultiBinning::find_index(F&& axis_value, Status * status) const {
   size_t idx {0};
-  for (const auto& [variableIdx, stride, edges] : axes_) {
-    double value = std::get<double>(values[variableIdx]);
-    auto it = std::upper_bound(std::begin(edges), std::end(edges), value);
+  for (const auto& [variableIdx, stride, edges, uniform] : axes_) {
+    double value = axis_value(variableIdx);
+    auto it = std::begin(edges) + edges_upper_bound(edges, uniform, value);
     if ( it == std::begin(edges) ) {
       if ( flow_ == _FlowBehavior::value ) {
-        return *content_.rbegin();
+        return content_.size() - 1;
       }
       else if ( flow_ == _FlowBehavior::error ) {
+        if ( status != nullptr ) {
+          *status = Status::below_bounds;
+          return missing_slot;
+        }
         throw std::runtime_error("Index below bounds in MultiBinning for input argument " + std::to_string(variableIdx) + " val: " + std::to_string(value));
       }
       else { // clamp
@@ -373,9 +632,13 @@ const Content& MultiBinning::child(const std::vector<Variable::Type>& values) co
     }
     else if ( it == std::end(edges) ) {
       if ( flow_ == _FlowBehavior::value ) {
-        return *content_.rbegin();
+        return content_.size() - 1;
       }
       else if ( flow_ == _FlowBehavior::error ) {
+        if ( status != nullptr ) {
+          *status = Status::above_bounds;
+          return missing_slot;
+        }
         throw std::runtime_error("Index above bounds in MultiBinning input argument" + std::to_string(variableIdx) + " val: " + std::to_string(value));
       }
       else { // clamp
@@ -385,77 +648,720 @@ const Content& MultiBinning::child(const std::vector<Variable::Type>& values) co
     size_t localidx = std::distance(std::begin(edges), it) - 1;
     idx += localidx * stride;
   }
-  return content_.at(idx);
+  return idx;
 }
 
 Category::Category(const JSONObject& json, const Correction& context)
 {
   variableIdx_ = context.input_index(json.getRequired<std::string_view>("input"));
   const auto& variable = context.inputs()[variableIdx_];
-  if ( variable.type() == Variable::VarType::string ) {
-    map_ = StrMap();
-  } // (default-constructed as IntMap)
-  for (const auto& kv_pair : json.getRequired<rapidjson::Value::ConstArray>("content"))
+  // keys are first collected in ordered maps, then moved to the lookup tables
+  std::map<int, size_t> int_keys;
+  std::map<std::string, size_t> str_keys;
+  const auto& content = json.getRequired<rapidjson::Value::ConstArray>("content");
+  content_.reserve(content.Size() + 1); // + 1 for default value
+  for (const auto& kv_pair : content)
   {
     if ( ! (kv_pair.IsObject() && kv_pair.HasMember("key") && kv_pair.HasMember("value")) ) {
       throw std::runtime_error("Expected CategoryItem object");
     }
+    bool inserted;
     if ( kv_pair["key"].IsString() ) {
       if ( variable.type() != Variable::VarType::string ) {
         throw std::runtime_error("Category got a key not of type string, but its input is string type");
       }
-      std::get<StrMap>(map_).try_emplace(kv_pair["key"].GetString(), resolve_content(kv_pair["value"], context));
+      inserted = str_keys.try_emplace(kv_pair["key"].GetString(), content_.size()).second;
     }
     else if ( kv_pair["key"].IsInt() ) {
       if ( variable.type() != Variable::VarType::integer ) {
         throw std::runtime_error("Category got a key not of type int, but its input is int type");
       }
-      std::get<IntMap>(map_).try_emplace(kv_pair["key"].GetInt(), resolve_content(kv_pair["value"], context));
+      inserted = int_keys.try_emplace(kv_pair["key"].GetInt(), content_.size()).second;
     }
     else {
       throw std::runtime_error("Invalid key type in Category");
     }
+    // the value of a duplicate key is discarded, but still checked
+    auto value = resolve_content(kv_pair["value"], context);
+    if ( inserted ) {
+      content_.push_back(std::move(value));
+    }
+  }
+
+  if ( variable.type() == Variable::VarType::string ) {
+    StrMap map;
+    flat_build(map.keys, map.slots, str_keys);
+    map_ = std::move(map);
+  }
+  else {
+    IntMap map;
+    map.low = 0;
+    if ( int_keys.size() > 0 ) {
+      int64_t low = int_keys.begin()->first;
+      int64_t range = int_keys.rbegin()->first - low + 1;
+      if ( range <= std::max(dense_category_min_size, dense_category_max_ratio * (int64_t) int_keys.size()) ) {
+        map.low = low;
+        map.dense.assign(range, missing_slot);
+        for (const auto& [key, value] : int_keys) map.dense[key - low] = value;
+      }
+    }
+    if ( map.dense.size() == 0 ) {
+      flat_build(map.keys, map.slots, int_keys);
+    }
+    map_ = std::move(map);
   }
 
   const auto def = json.FindMember("default");
-  if ( def != json.MemberEnd() && ! def->value.IsNull() ) {
-    default_ = std::make_unique<Content>(resolve_content(def->value, context));
+  has_default_ = def != json.MemberEnd() && ! def->value.IsNull();
+  if ( has_default_ ) {
+    content_.push_back(resolve_content(def->value, context));
   }
 }
 
 const Content& Category::child(const std::vector<Variable::Type>& values) const {
   if ( auto pval = std::get_if<std::string>(&values[variableIdx_]) ) {
-    try {
-      return std::get<StrMap>(map_).at(*pval);
-    } catch (std::out_of_range& ex) {
-      if ( default_ ) {
-        return *default_;
+    return content_[index(*pval)];
+  }
+  else if ( auto pval = std::get_if<int>(&values[variableIdx_]) ) {
+    return content_[index(*pval)];
+  }
+  throw std::runtime_error("Invalid variable type");
+}
+
+size_t Category::nchildren() const { return content_.size(); }
+
+const Content& Category::content(size_t idx) const { return content_[idx]; }
+
+size_t Category::index(int value, Status * status) const {
+  const auto& map = std::get<IntMap>(map_);
+  size_t idx {missing_slot};
+  if ( map.dense.size() > 0 ) {
+    // keys below low wrap around to large offsets
+    uint64_t offset = static_cast<uint64_t>(static_cast<int64_t>(value) - map.low);
+    if ( offset < map.dense.size() ) idx = map.dense[offset];
+  }
+  else {
+    idx = flat_find(map.keys, map.slots, value);
+  }
+  if ( idx != missing_slot ) {
+    return idx;
+  }
+  else if ( has_default_ ) {
+    return content_.size() - 1;
+  }
+  else if ( status != nullptr ) {
+    *status = Status::missing_key;
+    return missing_slot;
+  }
+  throw std::out_of_range("Index not available in Category for input argument " + std::to_string(variableIdx_) + " val: " + std::to_string(value));
+}
+
+size_t Category::index(const std::string& value, Status * status) const {
+  const auto& map = std::get<StrMap>(map_);
+  size_t idx = flat_find(map.keys, map.slots, value);
+  if ( idx != missing_slot ) {
+    return idx;
+  }
+  else if ( has_default_ ) {
+    return content_.size() - 1;
+  }
+  else if ( status != nullptr ) {
+    *status = Status::missing_key;
+    return missing_slot;
+  }
+  throw std::out_of_range("Index not available in Category for input argument " + std::to_string(variableIdx_) + " val: " + value);
+}
+
+// Flattened representation of a Content tree. The instructions are stored
+// in depth-first order, the root first. A branching node finds the index of
+// its child, then either reads the value directly if all of its children are
+// values (leaves), or jumps to the instruction of the child (targets).
+class correction::_Program {
+  public:
+    enum class Op : uint8_t {Value, Binning, MultiBinning, Category, Formula, FormulaRef, Transform};
+    struct Instruction {
+      Op op;
+      bool leaves; // children are in leaves rather than targets
+      size_t variableIdx;
+      size_t children; // offset in leaves or targets
+      size_t nchildren;
+      const void * node;
+      double value;
+    };
+
+    // the values of one input to evaluate the program for at once
+    struct Variations {
+      size_t variableIdx;
+      std::vector<Column> values;
+      // whether each instruction, or any below it, reads the input
+      std::vector<bool> depends;
+    };
+
+    // buffers reused by the evaluations of a thread, so that evaluation does
+    // not allocate once they have grown to size
+    struct Scratch {
+      // the buffers of one level of a batch evaluation, nested nodes use the next
+      struct Level {
+        std::vector<size_t> idx;
+        std::vector<size_t> offsets;
+        std::vector<size_t> lookup;
+        std::vector<row_t> sorted;
+        std::vector<row_t> kept;
+        std::vector<double> rule;
+        std::vector<double> reals;
+        std::vector<int> ints;
+        std::vector<Column> columns;
+      };
+      Level& level(size_t depth) {
+        // references to the levels stay valid as more are added
+        while ( levels.size() <= depth ) levels.emplace_back();
+        return levels[depth];
+      };
+      // the inputs of a row, rewritten in place by transforms
+      std::vector<Variable::Type> values;
+      std::vector<Column> block_columns;
+      std::vector<row_t> selected;
+      std::deque<Level> levels;
+      // if set, the status of the rows of the block: lookup errors are
+      // recorded there and give the fill value rather than throwing
+      Status * status {nullptr};
+      double fill {0.};
+    };
+    static Scratch& scratch();
+
+    _Program(const Content& root) { std::visit(Compiler{*this}, root); };
+    double evaluate(const std::vector<Variable::Type>& values, Scratch& scratch, size_t pc = 0) const;
+    void evaluate_batch(
+        const std::vector<Column>& columns,
+        const row_t * rows,
+        size_t nrows,
+        size_t nblock,
+        double * out,
+        Scratch& scratch,
+        size_t depth = 0,
+        size_t pc = 0
+        ) const;
+    Variations variations(const Variable& input, size_t variableIdx, const std::vector<Variable::Type>& values) const;
+    void evaluate_variations(
+        const std::vector<Column>& columns,
+        const Variations& variations,
+        const size_t * ks,
+        size_t nk,
+        const row_t * rows,
+        size_t nrows,
+        size_t nblock,
+        double * out,
+        Scratch& scratch,
+        size_t depth = 0,
+        size_t pc = 0
+        ) const;
+
+  private:
+    struct Compiler {
+      size_t operator() (double node) {
+        return emit({Op::Value, false, 0, 0, 0, nullptr, node});
+      };
+      size_t operator() (const Binning& node) {
+        return branch(Op::Binning, node.variable_index(), node);
+      };
+      size_t operator() (const MultiBinning& node) {
+        return branch(Op::MultiBinning, 0, node);
+      };
+      size_t operator() (const Category& node) {
+        return branch(Op::Category, node.variable_index(), node);
+      };
+      size_t operator() (const Formula& node) {
+        return emit({Op::Formula, false, 0, 0, 0, &node, 0.});
+      };
+      size_t operator() (const FormulaRef& node) {
+        return emit({Op::FormulaRef, false, 0, 0, 0, &node, 0.});
+      };
+      size_t operator() (const Transform& node) {
+        size_t offset = program.targets_.size();
+        program.targets_.resize(offset + 2);
+        size_t pc = emit({Op::Transform, false, node.variable_index(), offset, 2, &node, 0.});
+        program.targets_[offset] = std::visit(*this, node.rule());
+        program.targets_[offset + 1] = std::visit(*this, node.content());
+        return pc;
+      };
+
+      size_t emit(Instruction&& instruction) {
+        program.code_.push_back(std::move(instruction));
+        return program.code_.size() - 1;
+      };
+      template<typename T>
+      size_t branch(Op op, size_t variableIdx, const T& node) {
+        size_t n = node.nchildren();
+        bool leaves = true;
+        for (size_t i=0; i < n; ++i) {
+          leaves &= std::holds_alternative<double>(node.content(i));
+        }
+        if ( leaves ) {
+          size_t offset = program.leaves_.size();
+          for (size_t i=0; i < n; ++i) {
+            program.leaves_.push_back(std::get<double>(node.content(i)));
+          }
+          return emit({op, true, variableIdx, offset, n, &node, 0.});
+        }
+        size_t offset = program.targets_.size();
+        program.targets_.resize(offset + n);
+        size_t pc = emit({op, false, variableIdx, offset, n, &node, 0.});
+        for (size_t i=0; i < n; ++i) {
+          program.targets_[offset + i] = std::visit(*this, node.content(i));
+        }
+        return pc;
+      };
+
+      _Program& program;
+    };
+
+    void child_index(
+        const Instruction& ins,
+        const std::vector<Column>& columns,
+        const row_t * rows,
+        size_t nrows,
+        Scratch::Level& level,
+        Status * status
+        ) const;
+    size_t drop_failed(
+        const row_t *& rows,
+        size_t nrows,
+        double * out,
+        std::vector<size_t> * idx,
+        Scratch& scratch,
+        Scratch::Level& level
+        ) const;
+    void dispatch(
+        const Instruction& ins,
+        const std::vector<Column>& columns,
+        const row_t * rows,
+        size_t nrows,
+        size_t nblock,
+        double * out,
+        Scratch& scratch,
+        size_t depth
+        ) const;
+    template<typename F>
+    void partition(
+        const Instruction& ins,
+        const row_t * rows,
+        size_t nrows,
+        Scratch::Level& level,
+        F&& func
+        ) const;
+
+    std::vector<Instruction> code_;
+    std::vector<size_t> targets_;
+    std::vector<double> leaves_;
+};
+
+_Program::Scratch& _Program::scratch() {
+  thread_local Scratch scratch;
+  return scratch;
+}
+
+double _Program::evaluate(const std::vector<Variable::Type>& values, Scratch& scratch, size_t pc) const {
+  while ( true ) {
+    const auto& ins = code_[pc];
+    size_t idx {0};
+    switch ( ins.op ) {
+      case Op::Value:
+        return ins.value;
+      case Op::Formula:
+        return static_cast<const Formula*>(ins.node)->evaluate(values);
+      case Op::FormulaRef:
+        return static_cast<const FormulaRef*>(ins.node)->evaluate(values);
+      case Op::Transform: {
+        if ( &values != &scratch.values ) {
+          // the outermost transform copies the inputs once, nested ones
+          // rewrite the copy in place
+          scratch.values.assign(values.begin(), values.end());
+          return evaluate(scratch.values, scratch, pc);
+        }
+        double vnew = evaluate(scratch.values, scratch, targets_[ins.children]);
+        auto& v = scratch.values[ins.variableIdx];
+        const auto old = v;
+        if ( std::holds_alternative<double>(v) ) {
+          v = vnew;
+        }
+        else if ( std::holds_alternative<int>(v) ) {
+          v = (int) std::round(vnew);
+        }
+        else {
+          throw std::logic_error("I should not have ever seen a string");
+        }
+        double out = evaluate(scratch.values, scratch, targets_[ins.children + 1]);
+        v = old;
+        return out;
+      }
+      case Op::Binning:
+        idx = static_cast<const Binning*>(ins.node)->index(std::get<double>(values[ins.variableIdx]));
+        break;
+      case Op::MultiBinning:
+        idx = static_cast<const MultiBinning*>(ins.node)->index(values);
+        break;
+      case Op::Category:
+        if ( auto pval = std::get_if<int>(&values[ins.variableIdx]) ) {
+          idx = static_cast<const Category*>(ins.node)->index(*pval);
+        }
+        else {
+          idx = static_cast<const Category*>(ins.node)->index(std::get<std::string>(values[ins.variableIdx]));
+        }
+        break;
+    }
+    if ( ins.leaves ) {
+      return leaves_[ins.children + idx];
+    }
+    pc = targets_[ins.children + idx];
+  }
+}
+
+// Evaluates an instruction for a selection of rows of a block at once:
+// branching nodes compute the child index of every row in one pass, then the
+// rows are grouped by child and each child is evaluated for its group.
+void _Program::evaluate_batch(
+    const std::vector<Column>& columns,
+    const row_t * rows,
+    size_t nrows,
+    size_t nblock,
+    double * out,
+    Scratch& scratch,
+    size_t depth,
+    size_t pc
+    ) const {
+  const auto& ins = code_[pc];
+  auto& level = scratch.level(depth);
+  switch ( ins.op ) {
+    case Op::Value:
+      for (size_t i=0; i < nrows; ++i) out[rows[i]] = ins.value;
+      return;
+    case Op::Formula:
+      return static_cast<const Formula*>(ins.node)->evaluate_batch(columns, rows, nrows, out);
+    case Op::FormulaRef:
+      return static_cast<const FormulaRef*>(ins.node)->evaluate_batch(columns, rows, nrows, out);
+    case Op::Transform: {
+      level.rule.resize(nblock);
+      evaluate_batch(columns, rows, nrows, nblock, level.rule.data(), scratch, depth + 1, targets_[ins.children]);
+      if ( scratch.status != nullptr ) {
+        nrows = drop_failed(rows, nrows, out, nullptr, scratch, level);
+        if ( nrows == 0 ) return;
+      }
+      level.columns = columns;
+      auto& column = level.columns[ins.variableIdx];
+      if ( column.type() == Variable::VarType::real ) {
+        level.reals.resize(nblock);
+        for (size_t i=0; i < nrows; ++i) level.reals[rows[i]] = level.rule[rows[i]];
+        column = Column(level.reals.data());
+      }
+      else if ( column.type() == Variable::VarType::integer ) {
+        level.ints.resize(nblock);
+        for (size_t i=0; i < nrows; ++i) level.ints[rows[i]] = (int) std::round(level.rule[rows[i]]);
+        column = Column(level.ints.data());
       }
       else {
-        throw std::out_of_range("Index not available in Category for input argument " + std::to_string(variableIdx_) + " val: " + *pval);
+        throw std::logic_error("I should not have ever seen a string");
       }
+      return evaluate_batch(level.columns, rows, nrows, nblock, out, scratch, depth + 1, targets_[ins.children + 1]);
     }
+    default:
+      child_index(ins, columns, rows, nrows, level, scratch.status);
+      if ( scratch.status != nullptr ) {
+        nrows = drop_failed(rows, nrows, out, &level.idx, scratch, level);
+        if ( nrows == 0 ) return;
+      }
+      break;
   }
-  else if ( auto pval = std::get_if<int>(&values[variableIdx_]) ) {
-    try {
-      return std::get<IntMap>(map_).at(*pval);
-    } catch (std::out_of_range& ex) {
-      if ( default_ ) {
-        return *default_;
+  dispatch(ins, columns, rows, nrows, nblock, out, scratch, depth);
+}
+
+// The rows with a failed lookup get the fill value, and the others are kept
+// in level.kept, along with their child index if idx is given. Returns the
+// number of rows kept, and points rows to them.
+size_t _Program::drop_failed(
+    const row_t *& rows,
+    size_t nrows,
+    double * out,
+    std::vector<size_t> * idx,
+    Scratch& scratch,
+    Scratch::Level& level
+    ) const {
+  const Status * status = scratch.status;
+  if ( std::all_of(rows, rows + nrows, [&](row_t row) { return status[row] == Status::ok; }) ) {
+    return nrows;
+  }
+  // a single child index is shared by all rows, so they all failed
+  bool per_row = idx != nullptr && idx->size() == nrows;
+  level.kept.resize(nrows);
+  size_t nkept {0};
+  for (size_t i=0; i < nrows; ++i) {
+    if ( status[rows[i]] != Status::ok ) {
+      out[rows[i]] = scratch.fill;
+      continue;
+    }
+    if ( per_row ) (*idx)[nkept] = (*idx)[i];
+    level.kept[nkept++] = rows[i];
+  }
+  if ( per_row ) idx->resize(nkept);
+  rows = level.kept.data();
+  return nkept;
+}
+
+// level.idx holds the child index of each row, or a single index shared by all rows
+void _Program::dispatch(
+    const Instruction& ins,
+    const std::vector<Column>& columns,
+    const row_t * rows,
+    size_t nrows,
+    size_t nblock,
+    double * out,
+    Scratch& scratch,
+    size_t depth
+    ) const {
+  auto& level = scratch.level(depth);
+  const auto& idx = level.idx;
+  if ( ins.leaves ) {
+    const double * leaves = leaves_.data() + ins.children;
+    if ( idx.size() == 1 ) {
+      for (size_t i=0; i < nrows; ++i) out[rows[i]] = leaves[idx[0]];
+    }
+    else {
+      for (size_t i=0; i < nrows; ++i) out[rows[i]] = leaves[idx[i]];
+    }
+    return;
+  }
+  partition(ins, rows, nrows, level, [&](size_t j, const row_t * group, size_t ngroup) {
+    evaluate_batch(columns, group, ngroup, nblock, out, scratch, depth + 1, targets_[ins.children + j]);
+  });
+}
+
+// calls func(j, group, ngroup) for the rows of each child j with any row,
+// given their child indices in level.idx
+template<typename F>
+void _Program::partition(
+    const Instruction& ins,
+    const row_t * rows,
+    size_t nrows,
+    Scratch::Level& level,
+    F&& func
+    ) const {
+  const auto& idx = level.idx;
+  if ( std::all_of(idx.begin(), idx.end(), [&](size_t j) { return j == idx[0]; }) ) {
+    return func(idx[0], rows, nrows);
+  }
+  // counting sort of the rows by child index: offsets[j] starts as the
+  // first position of child j and ends as the first one past it
+  auto& offsets = level.offsets;
+  offsets.assign(ins.nchildren + 1, 0);
+  for (size_t j : idx) offsets[j + 1]++;
+  std::partial_sum(offsets.begin(), offsets.end(), offsets.begin());
+  level.sorted.resize(nrows);
+  for (size_t i=0; i < nrows; ++i) level.sorted[offsets[idx[i]]++] = rows[i];
+  size_t begin {0};
+  for (size_t j=0; j < ins.nchildren; ++j) {
+    if ( offsets[j] > begin ) {
+      func(j, level.sorted.data() + begin, offsets[j] - begin);
+    }
+    begin = offsets[j];
+  }
+}
+
+// sets level.idx to the child index of each row, or a single index shared by all rows
+void _Program::child_index(
+    const Instruction& ins,
+    const std::vector<Column>& columns,
+    const row_t * rows,
+    size_t nrows,
+    Scratch::Level& level,
+    Status * status
+    ) const {
+  auto& idx = level.idx;
+  // with a status, failed lookups give missing_slot and their reason here
+  Status reason {Status::ok};
+  Status * preason = status != nullptr ? &reason : nullptr;
+  switch ( ins.op ) {
+    case Op::Value:
+    case Op::Formula:
+    case Op::FormulaRef:
+    case Op::Transform:
+      throw std::logic_error("Not a branching instruction");
+    case Op::Binning: {
+      const auto& node = *static_cast<const Binning*>(ins.node);
+      const auto& column = columns[ins.variableIdx];
+      if ( column.is_scalar() ) {
+        idx.assign(1, node.index(column.real(0), preason));
+        break;
+      }
+      idx.resize(nrows);
+      for (size_t i=0; i < nrows; ++i) {
+        idx[i] = node.index(column.real(rows[i]), preason);
+        if ( idx[i] == missing_slot ) status[rows[i]] = reason;
+      }
+      break;
+    }
+    case Op::MultiBinning: {
+      const auto& node = *static_cast<const MultiBinning*>(ins.node);
+      idx.resize(nrows);
+      for (size_t i=0; i < nrows; ++i) {
+        idx[i] = node.index(columns, rows[i], preason);
+        if ( idx[i] == missing_slot ) status[rows[i]] = reason;
+      }
+      break;
+    }
+    case Op::Category: {
+      const auto& node = *static_cast<const Category*>(ins.node);
+      const auto& column = columns[ins.variableIdx];
+      if ( column.type() == Variable::VarType::string ) {
+        if ( column.is_scalar() ) {
+          idx.assign(1, node.index(column.string(0), preason));
+          break;
+        }
+        idx.resize(nrows);
+        if ( column.dictionary_size() <= nrows ) {
+          // each distinct value is looked up once, at its first occurrence
+          auto& lookup = level.lookup;
+          lookup.assign(column.dictionary_size(), missing_slot);
+          for (size_t i=0; i < nrows; ++i) {
+            size_t& j = lookup[column.code(rows[i])];
+            // failed lookups are repeated, to record their reason
+            if ( j == missing_slot ) j = node.index(column.string(rows[i]), preason);
+            idx[i] = j;
+            if ( j == missing_slot ) status[rows[i]] = reason;
+          }
+          break;
+        }
+        for (size_t i=0; i < nrows; ++i) {
+          idx[i] = node.index(column.string(rows[i]), preason);
+          if ( idx[i] == missing_slot ) status[rows[i]] = reason;
+        }
       }
       else {
-        throw std::out_of_range("Index not available in Category for input argument " + std::to_string(variableIdx_) + " val: " + std::to_string(*pval));
+        if ( column.is_scalar() ) {
+          idx.assign(1, node.index(column.integer(0), preason));
+          break;
+        }
+        idx.resize(nrows);
+        for (size_t i=0; i < nrows; ++i) {
+          idx[i] = node.index(column.integer(rows[i]), preason);
+          if ( idx[i] == missing_slot ) status[rows[i]] = reason;
+        }
       }
+      break;
     }
   }
-  throw std::runtime_error("Invalid variable type");
+  if ( idx.size() == 1 && idx[0] == missing_slot ) {
+    // a lookup shared by all rows
+    for (size_t i=0; i < nrows; ++i) status[rows[i]] = reason;
+  }
+}
+
+_Program::Variations _Program::variations(const Variable& input, size_t variableIdx, const std::vector<Variable::Type>& values) const {
+  Variations out {variableIdx, {}, std::vector<bool>(code_.size(), false)};
+  out.values.reserve(values.size());
+  for (const auto& value : values) out.values.push_back(Column::scalar(value));
+  // children always come after their parent
+  for (size_t pc=code_.size(); pc-- > 0; ) {
+    const auto& ins = code_[pc];
+    bool depends {false};
+    switch ( ins.op ) {
+      case Op::Value:
+        break;
+      case Op::Binning:
+      case Op::Category:
+      case Op::Transform:
+        depends = ins.variableIdx == variableIdx;
+        break;
+      case Op::MultiBinning:
+      case Op::Formula:
+      case Op::FormulaRef:
+        // these may read any real-valued input
+        depends = input.type() == Variable::VarType::real;
+        break;
+    }
+    if ( ! ins.leaves ) {
+      size_t nchildren = ins.op == Op::Transform ? 2 : ins.nchildren;
+      for (size_t j=0; j < nchildren; ++j) depends = depends || out.depends[targets_[ins.children + j]];
+    }
+    out.depends[pc] = depends;
+  }
+  return out;
+}
+
+// Evaluates the variations ks[0..nk) at once, the output of variation k being
+// at out + k * nblock. Subtrees not reading the input are evaluated once and
+// copied, category and binning nodes of the input split the variations by
+// child, and any other node reading it is evaluated once per variation.
+void _Program::evaluate_variations(
+    const std::vector<Column>& columns,
+    const Variations& variations,
+    const size_t * ks,
+    size_t nk,
+    const row_t * rows,
+    size_t nrows,
+    size_t nblock,
+    double * out,
+    Scratch& scratch,
+    size_t depth,
+    size_t pc
+    ) const {
+  const auto& ins = code_[pc];
+  if ( ! variations.depends[pc] ) {
+    double * first = out + ks[0] * nblock;
+    evaluate_batch(columns, rows, nrows, nblock, first, scratch, depth, pc);
+    for (size_t k=1; k < nk; ++k) {
+      double * plane = out + ks[k] * nblock;
+      for (size_t i=0; i < nrows; ++i) plane[rows[i]] = first[rows[i]];
+    }
+    return;
+  }
+  auto& level = scratch.level(depth);
+  auto& varied = level.columns;
+  varied = columns;
+  bool reads_input = ins.variableIdx == variations.variableIdx;
+  if ( (ins.op == Op::Binning || ins.op == Op::Category) && reads_input ) {
+    // the child only depends on the variation
+    std::vector<size_t> kidx(nk);
+    for (size_t k=0; k < nk; ++k) {
+      varied[ins.variableIdx] = variations.values[ks[k]];
+      child_index(ins, varied, rows, nrows, level, nullptr);
+      kidx[k] = level.idx[0];
+    }
+    std::vector<size_t> group;
+    for (size_t j=0; j < ins.nchildren; ++j) {
+      group.clear();
+      for (size_t k=0; k < nk; ++k) if ( kidx[k] == j ) group.push_back(ks[k]);
+      if ( group.empty() ) continue;
+      if ( ins.leaves ) {
+        for (size_t k : group) {
+          double * plane = out + k * nblock;
+          for (size_t i=0; i < nrows; ++i) plane[rows[i]] = leaves_[ins.children + j];
+        }
+        continue;
+      }
+      evaluate_variations(columns, variations, group.data(), group.size(), rows, nrows, nblock, out, scratch, depth + 1, targets_[ins.children + j]);
+    }
+    return;
+  }
+  if ( ins.op == Op::Binning || ins.op == Op::Category
+      || (ins.op == Op::MultiBinning && columns[variations.variableIdx].type() != Variable::VarType::real) ) {
+    // a branch on other inputs, above the nodes reading the input
+    child_index(ins, columns, rows, nrows, level, nullptr);
+    partition(ins, rows, nrows, level, [&](size_t j, const row_t * group, size_t ngroup) {
+      evaluate_variations(columns, variations, ks, nk, group, ngroup, nblock, out, scratch, depth + 1, targets_[ins.children + j]);
+    });
+    return;
+  }
+  for (size_t k=0; k < nk; ++k) {
+    varied[variations.variableIdx] = variations.values[ks[k]];
+    evaluate_batch(varied, rows, nrows, nblock, out + ks[k] * nblock, scratch, depth + 1, pc);
+  }
 }
 
 Correction::Correction(const JSONObject& json) :
   name_(json.getRequired<const char *>("name")),
   description_(json.getOptional<const char*>("description").value_or("")),
   version_(json.getRequired<int>("version")),
-  output_(json.getRequired<rapidjson::Value::ConstObject>("output"))
+  output_(json.getRequired<rapidjson::Value::ConstObject>("output")),
+  formula_cache_(std::make_unique<FormulaAst::ParseCache>())
 {
   if ( output_.type() != Variable::VarType::real ) { throw std::runtime_error("Outputs can only be real-valued"); }
   for (const auto& item : json.getRequired<rapidjson::Value::ConstArray>("inputs")) {
@@ -470,6 +1376,10 @@ Correction::Correction(const JSONObject& json) :
   }
 
   data_ = resolve_content(json.getRequiredValue("data"), *this);
+  // the cache is per correction, so that corrections built on several
+  // threads share nothing, and is dropped once they are built
+  formula_cache_.reset();
+  program_ = std::make_shared<const _Program>(data_);
   initialized_ = true;
 }
 
@@ -482,20 +1392,140 @@ size_t Correction::input_index(const std::string_view name) const {
   throw std::runtime_error("Error: could not find variable " + std::string(name) + " in inputs");
 }
 
+void Correction::validate(const std::vector<Variable::Type>& values) const {
+  if ( ! initialized_ ) {
+    throw std::logic_error("Not initialized");
+  }
+  validate_inputs(inputs_, values);
+}
+
+void Correction::validate(const std::vector<Column>& columns) const {
+  if ( ! initialized_ ) {
+    throw std::logic_error("Not initialized");
+  }
+  validate_inputs(inputs_, columns);
+}
+
 double Correction::evaluate(const std::vector<Variable::Type>& values) const {
+  validate(values);
+  return evaluate_unchecked(values);
+}
+
+double Correction::evaluate_unchecked(const std::vector<Variable::Type>& values) const {
+  return program_->evaluate(values, _Program::scratch());
+}
+
+void Correction::evaluate_batch(const std::vector<Column>& columns, double * out, size_t n) const {
+  validate(columns);
+  evaluate_batch_unchecked(columns, out, n);
+}
+
+void Correction::evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, size_t n) const {
+  evaluate_batch_unchecked(columns, out, nullptr, 0., n);
+}
+
+void Correction::evaluate_batch(const std::vector<Column>& columns, double * out, Status * status, double fill, size_t n) const {
+  validate(columns);
+  evaluate_batch_unchecked(columns, out, status, fill, n);
+}
+
+void Correction::evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, Status * status, double fill, size_t n) const {
+  auto& scratch = _Program::scratch();
+  auto& block_columns = scratch.block_columns;
+  if ( status != nullptr ) std::fill(status, status + n, Status::ok);
+  scratch.fill = fill;
+  for (size_t begin=0; begin < n; begin += batch_block_size) {
+    size_t nblock = std::min(batch_block_size, n - begin);
+    scratch.status = status != nullptr ? status + begin : nullptr;
+    block_columns.clear();
+    for (const auto& column : columns) block_columns.push_back(column.slice(begin));
+    if ( status != nullptr ) {
+      program_->evaluate_batch(block_columns, block_rows(), nblock, nblock, out + begin, scratch);
+      continue;
+    }
+    try {
+      program_->evaluate_batch(block_columns, block_rows(), nblock, nblock, out + begin, scratch);
+    } catch (...) {
+      rethrow_first_error(*this, block_columns, block_rows(), nblock, nblock);
+    }
+  }
+}
+
+void Correction::evaluate_batch(const std::vector<Column>& columns, double * out, const bool * select, size_t n) const {
+  validate(columns);
+  evaluate_batch_unchecked(columns, out, select, n);
+}
+
+void Correction::evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, const bool * select, size_t n) const {
+  auto& scratch = _Program::scratch();
+  auto& block_columns = scratch.block_columns;
+  auto& selected = scratch.selected;
+  scratch.status = nullptr;
+  for (size_t begin=0; begin < n; begin += batch_block_size) {
+    size_t nblock = std::min(batch_block_size, n - begin);
+    const bool * bselect = select + begin;
+    selected.clear();
+    for (size_t i=0; i < nblock; ++i) {
+      if ( bselect[i] ) selected.push_back(i);
+    }
+    if ( selected.empty() ) continue;
+    block_columns.clear();
+    for (const auto& column : columns) block_columns.push_back(column.slice(begin));
+    // the program only reads and writes the rows it is given
+    const row_t * rows = selected.size() == nblock ? block_rows() : selected.data();
+    try {
+      program_->evaluate_batch(block_columns, rows, selected.size(), nblock, out + begin, scratch);
+    } catch (...) {
+      rethrow_first_error(*this, block_columns, rows, selected.size(), nblock);
+    }
+  }
+}
+
+void Correction::evaluate_variations(
+    const std::vector<Column>& columns,
+    size_t input,
+    const std::vector<Variable::Type>& values,
+    double * out,
+    size_t n
+    ) const {
   if ( ! initialized_ ) {
     throw std::logic_error("Not initialized");
   }
-  if ( values.size() > inputs_.size() ) {
+  if ( columns.size() > inputs_.size() ) {
     throw std::runtime_error("Too many inputs");
   }
-  else if ( values.size() < inputs_.size() ) {
+  else if ( columns.size() < inputs_.size() ) {
     throw std::runtime_error("Insufficient inputs");
   }
+  if ( input >= inputs_.size() ) {
+    throw std::out_of_range("Input index " + std::to_string(input) + " out of range");
+  }
   for (size_t i=0; i < inputs_.size(); ++i) {
-    inputs_[i].validate(values[i]);
+    if ( i != input ) inputs_[i].validate(columns[i]);
+  }
+  for (const auto& value : values) {
+    inputs_[input].validate(value);
+  }
+  const size_t nk = values.size();
+  if ( nk == 0 ) return;
+  const auto variations = program_->variations(inputs_[input], input, values);
+  std::vector<size_t> ks(nk);
+  std::iota(ks.begin(), ks.end(), 0);
+  std::vector<double> planes(nk * std::min(n, batch_block_size));
+  auto& scratch = _Program::scratch();
+  auto& block_columns = scratch.block_columns;
+  scratch.status = nullptr;
+  for (size_t begin=0; begin < n; begin += batch_block_size) {
+    size_t nblock = std::min(batch_block_size, n - begin);
+    block_columns.clear();
+    for (const auto& column : columns) block_columns.push_back(column.slice(begin));
+    // the input column is not read, the variations replace it
+    block_columns[input] = variations.values[0];
+    program_->evaluate_variations(block_columns, variations, ks.data(), nk, block_rows(), nblock, nblock, planes.data(), scratch);
+    for (size_t i=0; i < nblock; ++i) {
+      for (size_t k=0; k < nk; ++k) out[(begin + i) * nk + k] = planes[k * nblock + i];
+    }
   }
-  return std::visit(node_evaluate{values}, data_);
 }
 
 CompoundCorrection::CompoundCorrection(const JSONObject& json, const CorrectionSet& context) :
@@ -545,6 +1575,14 @@ CompoundCorrection::CompoundCorrection(const JSONObject& json, const CorrectionS
     }
     stack_.emplace_back(std::move(inmap), corr);
   }
+  // a mismatch is only an error when the stage is evaluated
+  stack_types_match_ = std::all_of(stack_.begin(), stack_.end(), [this](const auto& stage) {
+      const auto& [inmap, corr] = stage;
+      for (size_t i=0; i < inmap.size(); ++i) {
+        if ( corr->inputs()[i].type() != inputs_[inmap[i]].type() ) return false;
+      }
+      return true;
+  });
 }
 
 size_t CompoundCorrection::input_index(const std::string_view name) const {
@@ -556,25 +1594,50 @@ size_t CompoundCorrection::input_index(const std::string_view name) const {
   throw std::runtime_error("Error: could not find variable " + std::string(name) + " in inputs");
 }
 
+void CompoundCorrection::validate(const std::vector<Variable::Type>& values) const {
+  validate_inputs(inputs_, values);
+}
+
+void CompoundCorrection::validate(const std::vector<Column>& columns) const {
+  validate_inputs(inputs_, columns);
+}
+
 double CompoundCorrection::evaluate(const std::vector<Variable::Type>& values) const {
-  if ( values.size() > inputs_.size() ) {
-    throw std::runtime_error("Too many inputs");
-  }
-  else if ( values.size() < inputs_.size() ) {
-    throw std::runtime_error("Insufficient inputs");
-  }
-  for (size_t i=0; i < inputs_.size(); ++i) {
-    inputs_[i].validate(values[i]);
+  validate(values);
+  return evaluate_unchecked(values);
+}
+
+namespace {
+  // buffers reused by the compound corrections evaluated on a thread
+  struct CompoundScratch {
+    std::vector<Variable::Type> ivalues;
+    std::vector<Variable::Type> cvalues;
+    std::vector<Column> icolumns;
+    std::vector<Column> ccolumns;
+    std::vector<std::vector<double>> updated;
+    std::vector<double> sf;
+    std::vector<Status> status;
+    std::vector<double> output;
+  };
+
+  CompoundScratch& compound_scratch() {
+    thread_local CompoundScratch scratch;
+    return scratch;
   }
-  std::vector<Variable::Type> ivalues(values);
-  std::vector<Variable::Type> cvalues;
-  cvalues.reserve(values.size());
+}
+
+double CompoundCorrection::evaluate_unchecked(const std::vector<Variable::Type>& values) const {
+  auto& scratch = compound_scratch();
+  auto& ivalues = scratch.ivalues;
+  auto& cvalues = scratch.cvalues;
+  // element-wise assignment reuses the storage of any string already there
+  ivalues.assign(values.begin(), values.end());
   double out, sf;
   bool start{true};
   for(const auto& [inmap, corr] : stack_) {
-    cvalues.clear();
-    for(size_t pos : inmap) cvalues.push_back(ivalues[pos]);
-    sf = corr->evaluate(cvalues);
+    cvalues.resize(inmap.size());
+    for(size_t i=0; i < inmap.size(); ++i) cvalues[i] = ivalues[inmap[i]];
+    sf = stack_types_match_ ? corr->evaluate_unchecked(cvalues) : corr->evaluate(cvalues);
     for(size_t pos : inputs_update_) {
       switch ( input_op_ ) {
         case UpdateOp::Add: std::get<double>(ivalues[pos]) += sf; break;
@@ -596,7 +1659,305 @@ double CompoundCorrection::evaluate(const std::vector<Variable::Type>& values) c
   return out;
 }
 
-std::unique_ptr<CorrectionSet> CorrectionSet::from_file(const std::string& fn) {
+void CompoundCorrection::evaluate_batch(const std::vector<Column>& columns, double * out, size_t n) const {
+  validate(columns);
+  evaluate_batch_unchecked(columns, out, n);
+}
+
+void CompoundCorrection::evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, size_t n) const {
+  evaluate_stages(columns, out, nullptr, 0., nullptr, n);
+}
+
+void CompoundCorrection::evaluate_batch(const std::vector<Column>& columns, double * out, Status * status, double fill, size_t n) const {
+  validate(columns);
+  evaluate_batch_unchecked(columns, out, status, fill, n);
+}
+
+void CompoundCorrection::evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, Status * status, double fill, size_t n) const {
+  evaluate_stages(columns, out, status, fill, nullptr, n);
+}
+
+void CompoundCorrection::evaluate_batch(const std::vector<Column>& columns, double * out, const bool * select, size_t n) const {
+  validate(columns);
+  evaluate_batch_unchecked(columns, out, select, n);
+}
+
+void CompoundCorrection::evaluate_batch_unchecked(const std::vector<Column>& columns, double * out, const bool * select, size_t n) const {
+  evaluate_stages(columns, out, nullptr, 0., select, n);
+}
+
+void CompoundCorrection::evaluate_stages(const std::vector<Column>& columns, double * out, Status * status, double fill, const bool * select, size_t n) const {
+  auto& scratch = compound_scratch();
+  auto& icolumns = scratch.icolumns;
+  auto& ccolumns = scratch.ccolumns;
+  auto& sf = scratch.sf;
+  // updated inputs are copied to private buffers, rewritten after each stage
+  auto& updated = scratch.updated;
+  updated.resize(inputs_update_.size());
+  for (auto& values : updated) values.resize(batch_block_size);
+  sf.resize(batch_block_size);
+  // the status of each stage, merged into that of the rows
+  auto& stage_status = scratch.status;
+  stage_status.resize(batch_block_size);
+  if ( status != nullptr ) std::fill(status, status + n, Status::ok);
+  // with a selection, the outputs of a block are combined apart, and only
+  // those of the selected rows copied out
+  scratch.output.resize(batch_block_size);
+  for (size_t begin=0; begin < n; begin += batch_block_size) {
+    size_t nblock = std::min(batch_block_size, n - begin);
+    const bool * bselect = select != nullptr ? select + begin : nullptr;
+    if ( bselect != nullptr && std::none_of(bselect, bselect + nblock, [](bool b) { return b; }) ) continue;
+    double * bout = bselect != nullptr ? scratch.output.data() : out + begin;
+    icolumns.clear();
+    for (const auto& column : columns) icolumns.push_back(column.slice(begin));
+    for (size_t k=0; k < inputs_update_.size(); ++k) {
+      auto& column = icolumns[inputs_update_[k]];
+      for (size_t i=0; i < nblock; ++i) updated[k][i] = column.real(i);
+      column = Column(updated[k].data());
+    }
+    try {
+      bool start{true};
+      for(const auto& [inmap, corr] : stack_) {
+        ccolumns.clear();
+        for(size_t pos : inmap) ccolumns.push_back(icolumns[pos]);
+        if ( status != nullptr ) {
+          if ( stack_types_match_ ) corr->evaluate_batch_unchecked(ccolumns, sf.data(), stage_status.data(), fill, nblock);
+          else corr->evaluate_batch(ccolumns, sf.data(), stage_status.data(), fill, nblock);
+          Status * bstatus = status + begin;
+          for (size_t i=0; i < nblock; ++i) {
+            if ( bstatus[i] == Status::ok ) bstatus[i] = stage_status[i];
+          }
+        }
+        else if ( bselect != nullptr ) {
+          // sf keeps stale values for the other rows, which are never copied out
+          if ( stack_types_match_ ) corr->evaluate_batch_unchecked(ccolumns, sf.data(), bselect, nblock);
+          else corr->evaluate_batch(ccolumns, sf.data(), bselect, nblock);
+        }
+        else if ( stack_types_match_ ) corr->evaluate_batch_unchecked(ccolumns, sf.data(), nblock);
+        else corr->evaluate_batch(ccolumns, sf.data(), nblock);
+        for (auto& values : updated) {
+          for (size_t i=0; i < nblock; ++i) {
+            switch ( input_op_ ) {
+              case UpdateOp::Add: values[i] += sf[i]; break;
+              case UpdateOp::Multiply: values[i] *= sf[i]; break;
+              case UpdateOp::Divide: values[i] /= sf[i]; break;
+              case UpdateOp::Last: throw std::logic_error("Illegal update op");
+            }
+          }
+        }
+        if ( start ) {
+          std::copy(sf.begin(), sf.begin() + nblock, bout);
+          start = false;
+        }
+        else {
+          for (size_t i=0; i < nblock; ++i) {
+            switch ( output_op_ ) {
+              case UpdateOp::Add: bout[i] += sf[i]; break;
+              case UpdateOp::Multiply: bout[i] *= sf[i]; break;
+              case UpdateOp::Divide: bout[i] /= sf[i]; break;
+              case UpdateOp::Last: bout[i] = sf[i];
+            }
+          }
+        }
+      }
+    } catch (...) {
+      if ( status != nullptr ) throw;
+      // the inputs of the block before any update, and the rows evaluated
+      icolumns.clear();
+      for (const auto& column : columns) icolumns.push_back(column.slice(begin));
+      std::vector<row_t> rows;
+      for (size_t i=0; i < nblock; ++i) {
+        if ( bselect == nullptr || bselect[i] ) rows.push_back(i);
+      }
+      rethrow_first_error(*this, icolumns, rows.data(), rows.size(), nblock);
+    }
+    if ( status != nullptr ) {
+      const Status * bstatus = status + begin;
+      for (size_t i=0; i < nblock; ++i) {
+        if ( bstatus[i] != Status::ok ) bout[i] = fill;
+      }
+    }
+    if ( bselect != nullptr ) {
+      for (size_t i=0; i < nblock; ++i) {
+        if ( bselect[i] ) out[begin + i] = bout[i];
+      }
+    }
+  }
+}
+
+namespace {
+  // Forwards the parse events of a correction set to a document, except for
+  // the objects of its corrections array: of those only the name and the
+  // span in the text are recorded, for lazy sets to parse them on first use.
+  class LazyReader {
+    public:
+      struct Span {
+        std::optional<std::string> name;
+        size_t begin;
+        size_t end;
+      };
+
+      LazyReader(rapidjson::Document& document, const rapidjson::StringStream& stream) :
+        document_(document), stream_(stream) { }
+      const std::vector<Span>& spans() const { return spans_; }
+
+      bool Null() { return skipped() || document_.Null(); }
+      bool Bool(bool b) { return skipped() || document_.Bool(b); }
+      bool Int(int i) { return skipped() || document_.Int(i); }
+      bool Uint(unsigned i) { return skipped() || document_.Uint(i); }
+      bool Int64(int64_t i) { return skipped() || document_.Int64(i); }
+      bool Uint64(uint64_t i) { return skipped() || document_.Uint64(i); }
+      bool Double(double d) { return skipped() || document_.Double(d); }
+      bool RawNumber(const char * str, rapidjson::SizeType length, bool copy) {
+        return skipped() || document_.RawNumber(str, length, copy);
+      }
+      bool String(const char * str, rapidjson::SizeType length, bool copy) {
+        if ( skipping_ == 1 && name_next_ ) spans_.back().name.emplace(str, length);
+        return skipped() || document_.String(str, length, copy);
+      }
+      bool Key(const char * str, rapidjson::SizeType length, bool copy) {
+        const std::string_view key(str, length);
+        name_next_ = skipping_ == 1 && key == "name";
+        corrections_next_ = skipping_ == 0 && depth_ == 1 && key == "corrections";
+        return skipping_ > 0 || document_.Key(str, length, copy);
+      }
+      bool StartObject() {
+        if ( skipping_ == 0 && in_corrections() ) {
+          // the reader is past the opening brace
+          spans_.push_back({std::nullopt, stream_.Tell() - 1, 0});
+        }
+        if ( skipping_ > 0 || in_corrections() ) {
+          ++skipping_;
+          return true;
+        }
+        ++depth_;
+        return document_.StartObject();
+      }
+      bool EndObject(rapidjson::SizeType count) {
+        if ( skipping_ > 0 ) {
+          if ( --skipping_ == 0 ) spans_.back().end = stream_.Tell();
+          return true;
+        }
+        --depth_;
+        return document_.EndObject(count);
+      }
+      bool StartArray() {
+        if ( skipped() ) {
+          ++skipping_;
+          return true;
+        }
+        ++depth_;
+        if ( corrections_next_ && depth_ == 2 ) {
+          corrections_depth_ = depth_;
+          elements_ = 0;
+        }
+        corrections_next_ = false;
+        return document_.StartArray();
+      }
+      bool EndArray(rapidjson::SizeType count) {
+        if ( skipping_ > 0 ) {
+          --skipping_;
+          return true;
+        }
+        if ( in_corrections() ) {
+          // only the elements forwarded are in the document
+          count = elements_;
+          corrections_depth_ = 0;
+        }
+        --depth_;
+        return document_.EndArray(count);
+      }
+
+    private:
+      bool in_corrections() const { return corrections_depth_ > 0 && depth_ == corrections_depth_; }
+      // whether a value is part of a skipped correction, otherwise counting
+      // it if it is an element of the corrections array
+      bool skipped() {
+        if ( skipping_ > 0 ) return true;
+        if ( in_corrections() ) ++elements_;
+        return false;
+      }
+
+      rapidjson::Document& document_;
+      const rapidjson::StringStream& stream_;
+      std::vector<Span> spans_;
+      size_t depth_{0};
+      size_t corrections_depth_{0};
+      rapidjson::SizeType elements_{0};
+      size_t skipping_{0};
+      bool name_next_{false};
+      bool corrections_next_{false};
+  };
+}
+
+namespace {
+  // Builds the corrections of an array, on nthreads threads. Items are taken
+  // in order and the lowest failing index is kept: every item below it is
+  // still built, as a lower one may fail too, and none above it, so the error
+  // raised is that of the first failing item, as when building them one
+  // after the other.
+  std::vector<Correction::Ref> build_corrections(const rapidjson::Value::ConstArray& items, size_t nthreads) {
+    const size_t n = items.Size();
+    std::vector<Correction::Ref> out(n);
+    std::vector<std::exception_ptr> errors(n);
+    std::atomic<size_t> next{0};
+    std::atomic<size_t> first_failed{n};
+    auto fail = [&](size_t i) {
+      size_t current = first_failed;
+      while ( i < current && ! first_failed.compare_exchange_weak(current, i) ) {}
+    };
+    auto build = [&] {
+      // indices are taken in increasing order, so none is left below the
+      // lowest failing one once a thread reaches it
+      for (size_t i = next++; i < n && i < first_failed; i = next++) {
+        try {
+          const auto& item = items[static_cast<rapidjson::SizeType>(i)];
+          if ( ! item.IsObject() ) { throw std::runtime_error("Expected Correction object"); }
+          out[i] = std::make_shared<Correction>(item.GetObject());
+        } catch (...) {
+          errors[i] = std::current_exception();
+          fail(i);
+        }
+      }
+    };
+    if ( nthreads == 0 ) {
+      nthreads = std::max(1u, std::thread::hardware_concurrency());
+    }
+    std::vector<std::thread> threads;
+    try {
+      for (size_t k=1; k < std::min(nthreads, n); ++k) threads.emplace_back(build);
+    } catch (...) {
+      // stop the threads started, which take no further items
+      fail(0);
+      for (auto& thread : threads) thread.join();
+      throw;
+    }
+    build();
+    for (auto& thread : threads) thread.join();
+    if ( first_failed < n ) std::rethrow_exception(errors[first_failed]);
+    return out;
+  }
+}
+
+struct CorrectionSet::Pending {
+  struct Entry {
+    size_t begin;
+    size_t end;
+    std::once_flag built;
+    Correction::Ref correction;
+  };
+
+  std::string text;
+  std::map<std::string, Entry> entries;
+  std::once_flag all_built;
+};
+
+std::unique_ptr<CorrectionSet> CorrectionSet::from_file(const std::string& fn, bool lazy, size_t nthreads) {
+  if ( lazy ) {
+    std::ifstream file(fn, std::ios::binary);
+    if ( ! file ) { throw std::runtime_error("Failed to open " + fn); }
+    return from_text(std::string(std::istreambuf_iterator<char>(file), std::istreambuf_iterator<char>()));
+  }
   rapidjson::Document json;
   FILE* fp = fopen(fn.c_str(), "rb");
   char readBuffer[65536];
@@ -610,10 +1971,11 @@ std::unique_ptr<CorrectionSet> CorrectionSet::from_file(const std::string& fn) {
   }
   fclose(fp);
   if ( ! json.IsObject() ) { throw std::runtime_error("Expected CorrectionSet object"); }
-  return std::make_unique<CorrectionSet>(json);
+  return std::make_unique<CorrectionSet>(json, nthreads);
 }
 
-std::unique_ptr<CorrectionSet> CorrectionSet::from_string(const char * data) {
+std::unique_ptr<CorrectionSet> CorrectionSet::from_string(const char * data, bool lazy, size_t nthreads) {
+  if ( lazy ) return from_text(data);
   rapidjson::Document json;
   rapidjson::ParseResult ok = json.Parse<rapidjson::kParseNanAndInfFlag>(data);
   if (!ok) {
@@ -623,10 +1985,44 @@ std::unique_ptr<CorrectionSet> CorrectionSet::from_string(const char * data) {
         );
   }
   if ( ! json.IsObject() ) { throw std::runtime_error("Expected CorrectionSet object"); }
-  return std::make_unique<CorrectionSet>(json);
+  return std::make_unique<CorrectionSet>(json, nthreads);
 }
 
-CorrectionSet::CorrectionSet(const JSONObject& json) {
+std::unique_ptr<CorrectionSet> CorrectionSet::from_text(std::string text) {
+  auto pending = std::make_shared<Pending>();
+  pending->text = std::move(text);
+  // the whole text is still checked, but the corrections are not kept in
+  // the document, which then only holds the rest of the set
+  rapidjson::Document json;
+  rapidjson::StringStream stream(pending->text.c_str());
+  rapidjson::Reader reader;
+  LazyReader handler(json, stream);
+  auto parse = [&](rapidjson::Document&) {
+    return ! reader.Parse<rapidjson::kParseNanAndInfFlag>(stream, handler).IsError();
+  };
+  json.Populate(parse);
+  if ( reader.HasParseError() ) {
+    throw std::runtime_error(
+        std::string("JSON parse error: ") + rapidjson::GetParseError_En(reader.GetParseErrorCode())
+        + " at offset " + std::to_string(reader.GetErrorOffset())
+        );
+  }
+  if ( ! json.IsObject() ) { throw std::runtime_error("Expected CorrectionSet object"); }
+  for (const auto& span : handler.spans()) {
+    if ( ! span.name ) { throw std::runtime_error("Object missing required attribute 'name'"); }
+    // as for eager sets, the last of corrections with the same name is kept
+    auto& entry = pending->entries[*span.name];
+    entry.begin = span.begin;
+    entry.end = span.end;
+  }
+  return std::unique_ptr<CorrectionSet>(new CorrectionSet(json, std::move(pending), 1));
+}
+
+CorrectionSet::CorrectionSet(const JSONObject& json, size_t nthreads) : CorrectionSet(json, nullptr, nthreads) { }
+
+CorrectionSet::CorrectionSet(const JSONObject& json, std::shared_ptr<Pending> pending, size_t nthreads) :
+  pending_(std::move(pending))
+{
   schema_version_ = json.getRequired<int>("schema_version");
   if ( schema_version_ > evaluator_version ) {
     throw std::runtime_error("Evaluator is designed for schema v" + std::to_string(evaluator_version) + " and is not forward-compatible");
@@ -635,11 +2031,12 @@ CorrectionSet::CorrectionSet(const JSONObject& json) {
     throw std::runtime_error("Evaluator is designed for schema v" + std::to_string(evaluator_version) + " and is not backward-compatible");
   }
   description_ = json.getOptional<const char*>("description").value_or("");
-  for (const auto& item : json.getRequired<rapidjson::Value::ConstArray>("corrections")) {
-    if ( ! item.IsObject() ) { throw std::runtime_error("Expected Correction object"); }
-    auto corr = std::make_shared<Correction>(item.GetObject());
-    corrections_[corr->name()] = corr;
+  // for lazy sets, only the elements that are not objects are left here
+  auto items = json.getRequired<rapidjson::Value::ConstArray>("corrections");
+  for (auto& corr : build_corrections(items, nthreads)) {
+    corrections_[corr->name()] = std::move(corr);
   }
+  // the stages of compound corrections are all built by now
   if (auto items = json.getOptional<rapidjson::Value::ConstArray>("compound_corrections")) {
     for (const auto& item : *items) {
       if ( ! item.IsObject() ) { throw std::runtime_error("Expected CompoundCorrection object"); }
@@ -649,6 +2046,57 @@ CorrectionSet::CorrectionSet(const JSONObject& json) {
   }
 }
 
+size_t CorrectionSet::size() const {
+  return pending_ ? pending_->entries.size() : corrections_.size();
+}
+
+std::map<std::string, Correction::Ref>::const_iterator CorrectionSet::begin() const {
+  build_all();
+  return corrections_.cbegin();
+}
+
+std::map<std::string, Correction::Ref>::const_iterator CorrectionSet::end() const {
+  build_all();
+  return corrections_.cend();
+}
+
+std::vector<std::string> CorrectionSet::names() const {
+  std::vector<std::string> out;
+  out.reserve(size());
+  if ( pending_ ) {
+    for (const auto& item : pending_->entries) out.push_back(item.first);
+  }
+  else {
+    for (const auto& item : corrections_) out.push_back(item.first);
+  }
+  return out;
+}
+
+bool CorrectionSet::contains(const std::string& key) const {
+  return pending_ ? pending_->entries.count(key) > 0 : corrections_.count(key) > 0;
+}
+
+Correction::Ref CorrectionSet::at(const std::string& key) const {
+  if ( ! pending_ ) return corrections_.at(key);
+  auto& entry = pending_->entries.at(key);
+  // concurrent first accesses wait for a single build, and a build that
+  // throws is attempted again on the next access
+  std::call_once(entry.built, [this, &entry] {
+    rapidjson::Document json;
+    // the span is known to be a well-formed object
+    json.Parse<rapidjson::kParseNanAndInfFlag>(pending_->text.data() + entry.begin, entry.end - entry.begin);
+    entry.correction = std::make_shared<Correction>(json);
+  });
+  return entry.correction;
+}
+
+void CorrectionSet::build_all() const {
+  if ( ! pending_ ) return;
+  std::call_once(pending_->all_built, [this] {
+    for (const auto& item : pending_->entries) corrections_[item.first] = at(item.first);
+  });
+}
+
 bool CorrectionSet::validate() {
   // TODO: validate with https://rapidjson.org/md_doc_schema.html
   return true;
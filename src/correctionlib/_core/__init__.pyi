@@ -1,4 +1,15 @@
-from typing import Any, Dict, Iterator, List, Type, TypeVar, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
 import numpy
 
@@ -10,6 +21,28 @@ class Variable:
     @property
     def type(self) -> str: ...
 
+class EncodedStrings:
+    def __init__(
+        self, codes: numpy.ndarray[Any, Any], dictionary: List[str]
+    ) -> None: ...
+    @staticmethod
+    def encode(values: numpy.ndarray[Any, Any]) -> EncodedStrings: ...
+    @property
+    def codes(self) -> numpy.ndarray[Any, numpy.dtype[numpy.int32]]: ...
+    @property
+    def dictionary(self) -> List[str]: ...
+
+class JaggedArray:
+    def __init__(
+        self,
+        offsets: numpy.ndarray[Any, Any],
+        content: Union[numpy.ndarray[Any, Any], EncodedStrings],
+    ) -> None: ...
+    @property
+    def offsets(self) -> numpy.ndarray[Any, numpy.dtype[numpy.int64]]: ...
+    @property
+    def content(self) -> Union[numpy.ndarray[Any, Any], EncodedStrings]: ...
+
 class CompoundCorrection:
     @property
     def name(self) -> str: ...
@@ -20,7 +53,37 @@ class CompoundCorrection:
     @property
     def output(self) -> Variable: ...
     def evaluate(self, *args: Union[str, int, float]) -> float: ...
-    def evalv(self, *args: Union[numpy.ndarray[Any, Any], str, int, float]) -> numpy.ndarray[Any, numpy.dtype[numpy.float64]]: ...
+    @property
+    def _scalar_evaluator(self) -> Callable[..., float]: ...
+    def evalv(
+        self,
+        *args: Union[
+            numpy.ndarray[Any, Any], EncodedStrings, JaggedArray, str, int, float
+        ],
+        nthreads: int = ...,
+        out: Union[
+            numpy.ndarray[Any, numpy.dtype[numpy.float64]], JaggedArray, None
+        ] = ...,
+        op: Optional[str] = ...,
+        where: Union[numpy.ndarray[Any, Any], JaggedArray, None] = ...,
+        fill: float = ...
+    ) -> Union[numpy.ndarray[Any, numpy.dtype[numpy.float64]], JaggedArray]: ...
+    def evalv_status(
+        self,
+        *args: Union[
+            numpy.ndarray[Any, Any], EncodedStrings, JaggedArray, str, int, float
+        ],
+        fill: float,
+        nthreads: int = ...
+    ) -> Union[
+        Tuple[
+            numpy.ndarray[Any, numpy.dtype[numpy.float64]],
+            numpy.ndarray[Any, numpy.dtype[numpy.uint8]],
+        ],
+        Tuple[JaggedArray, JaggedArray],
+    ]: ...
+    @property
+    def ufunc(self) -> numpy.ufunc: ...
 
 class Correction:
     @property
@@ -34,19 +97,71 @@ class Correction:
     @property
     def output(self) -> Variable: ...
     def evaluate(self, *args: Union[str, int, float]) -> float: ...
-    def evalv(self, *args: Union[numpy.ndarray[Any, Any], str, int, float]) -> numpy.ndarray[Any, numpy.dtype[numpy.float64]]: ...
+    @property
+    def _scalar_evaluator(self) -> Callable[..., float]: ...
+    def evalv(
+        self,
+        *args: Union[
+            numpy.ndarray[Any, Any], EncodedStrings, JaggedArray, str, int, float
+        ],
+        nthreads: int = ...,
+        out: Union[
+            numpy.ndarray[Any, numpy.dtype[numpy.float64]], JaggedArray, None
+        ] = ...,
+        op: Optional[str] = ...,
+        where: Union[numpy.ndarray[Any, Any], JaggedArray, None] = ...,
+        fill: float = ...
+    ) -> Union[numpy.ndarray[Any, numpy.dtype[numpy.float64]], JaggedArray]: ...
+    def evalv_status(
+        self,
+        *args: Union[
+            numpy.ndarray[Any, Any], EncodedStrings, JaggedArray, str, int, float
+        ],
+        fill: float,
+        nthreads: int = ...
+    ) -> Union[
+        Tuple[
+            numpy.ndarray[Any, numpy.dtype[numpy.float64]],
+            numpy.ndarray[Any, numpy.dtype[numpy.uint8]],
+        ],
+        Tuple[JaggedArray, JaggedArray],
+    ]: ...
+    def evaluate_variations(
+        self,
+        input: str,
+        values: List[Union[str, int, float]],
+        *args: Union[
+            numpy.ndarray[Any, Any], EncodedStrings, JaggedArray, str, int, float
+        ],
+        nthreads: int = ...
+    ) -> Union[numpy.ndarray[Any, numpy.dtype[numpy.float64]], JaggedArray]: ...
+    @property
+    def ufunc(self) -> numpy.ufunc: ...
 
 T = TypeVar("T", bound="CorrectionSet")
 
 class CorrectionSet:
     @classmethod
-    def from_file(cls: Type[T], filename: str) -> T: ...
+    def from_file(
+        cls: Type[T], filename: str, lazy: bool = ..., nthreads: int = ...
+    ) -> T: ...
     @classmethod
-    def from_string(cls: Type[T], data: str) -> T: ...
+    def from_string(
+        cls: Type[T], data: str, lazy: bool = ..., nthreads: int = ...
+    ) -> T: ...
     @property
     def schema_version(self) -> int: ...
     def __getitem__(self, key: str) -> Correction: ...
     def __len__(self) -> int: ...
+    def __contains__(self, key: str) -> bool: ...
     def __iter__(self) -> Iterator[str]: ...
     @property
     def compound(self) -> Dict[str, CompoundCorrection]: ...
+    def evaluate_many(
+        self,
+        names: List[str],
+        inputs: Dict[
+            str, Union[numpy.ndarray[Any, Any], EncodedStrings, str, int, float]
+        ],
+        nthreads: int = ...,
+    ) -> Dict[str, numpy.ndarray[Any, numpy.dtype[numpy.float64]]]: ...
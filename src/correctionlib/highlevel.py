@@ -1,9 +1,23 @@
 """High-level correctionlib objects
 
 """
+import enum
 import json
+import sys
 from numbers import Integral
-from typing import Any, Dict, Iterator, List, Mapping, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
 
 import numpy
 
@@ -45,6 +59,134 @@ def model_auto(data: str) -> Any:
     raise ValueError(f"Unknown CorrectionSet schema version ({version})")
 
 
+_array_types = (
+    numpy.ndarray,
+    correctionlib._core.EncodedStrings,
+    correctionlib._core.JaggedArray,
+)
+# the result of evaluate, built once rather than in each cast
+_EvaluateResult = Union[float, "numpy.ndarray[Any, numpy.dtype[numpy.float64]]"]
+
+
+def _evaluate(
+    base: Union[correctionlib._core.Correction, correctionlib._core.CompoundCorrection],
+    args: Any,
+    nthreads: int,
+    out: Any = None,
+    op: Optional[str] = None,
+    where: Any = None,
+    fill: float = numpy.nan,
+    scalar: Optional[Callable[..., float]] = None,
+) -> Any:
+    """Evaluate a correction for the evaluate methods
+
+    Array arguments are broadcast against each other. Per-object inputs can be
+    jagged, as awkward arrays of lists or `JaggedArray`, with one value per list
+    in the other arrays. String inputs accept arrays of strings or
+    `EncodedStrings`. The result is written to ``out`` if given, a C-contiguous
+    float64 array of its shape (the flat content for jagged inputs), or combined
+    with its values by ``op``, "multiply" or "add". ``where``, a boolean mask or
+    indices into the flat result, selects the rows evaluated; the others keep
+    the values of ``out``, or are set to ``fill``. Python scalars of the input
+    types are first tried with ``scalar``, the fast path of the binding.
+    """
+    if scalar is not None and out is None and where is None:
+        # python scalars of the input types skip the generic conversions,
+        # anything else is left to the generic evaluation below
+        try:
+            return scalar(*args)
+        except TypeError:
+            pass
+
+    def evalv(*cargs: Any) -> Any:
+        return base.evalv(
+            *cargs, nthreads=nthreads, out=out, op=op, where=where, fill=fill
+        )
+
+    # awkward arrays can only be given if awkward was imported already
+    if "awkward" in sys.modules:
+        import awkward
+
+        if any(isinstance(arg, awkward.Array) for arg in args):
+            if isinstance(where, awkward.Array):
+                where = awkward.to_numpy(awkward.flatten(where, axis=None))
+            return _evaluate_awkward(evalv, args)
+    # arrays are broadcast by the evaluator itself, without copies
+    if (
+        out is not None
+        or where is not None
+        or any(isinstance(arg, _array_types) for arg in args)
+    ):
+        return evalv(*args)
+    return base.evaluate(*args)
+
+
+class EvaluationStatus(enum.IntEnum):
+    """Status of an output of ``evaluate_with_status``"""
+
+    ok = 0
+    #: input below the edges of a binning with error flow
+    below_bounds = 1
+    #: input above the edges, or NaN, in a binning with error flow
+    above_bounds = 2
+    #: input not among the keys of a category without default
+    missing_key = 3
+
+
+def _evaluate_with_status(
+    base: Union[correctionlib._core.Correction, correctionlib._core.CompoundCorrection],
+    args: Any,
+    fill: float,
+    nthreads: int,
+) -> Tuple[Any, Any]:
+    """Evaluate a correction, recording lookup errors per row
+
+    A row with an input outside the edges of a binning with error flow, or
+    missing from a category without default, gets the ``fill`` output and a
+    non-zero status, rather than raising for the whole evaluation.
+    """
+
+    def evaluate(*cargs: Any) -> Any:
+        return base.evalv_status(*cargs, fill=fill, nthreads=nthreads)
+
+    if "awkward" in sys.modules:
+        import awkward
+
+        if any(isinstance(arg, awkward.Array) for arg in args):
+            return _evaluate_awkward(evaluate, args)  # type: ignore
+    out, status = evaluate(*args)
+    if not any(isinstance(arg, _array_types) for arg in args):
+        return float(out[0]), EvaluationStatus(status[0])
+    return out, status
+
+
+def _evaluate_awkward(evaluate: Callable[..., Any], args: Any) -> Any:
+    import awkward
+
+    cargs = []
+    for arg in args:
+        if isinstance(arg, awkward.Array) and arg.ndim == 2:
+            counts = awkward.to_numpy(awkward.num(arg, axis=1))
+            offsets = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+            numpy.cumsum(counts, out=offsets[1:])
+            content = awkward.to_numpy(awkward.flatten(arg, axis=1))
+            cargs.append(correctionlib._core.JaggedArray(offsets, content))
+        elif isinstance(arg, awkward.Array):
+            cargs.append(awkward.to_numpy(arg))
+        else:
+            cargs.append(arg)
+
+    def unflatten(out: Any) -> Any:
+        if isinstance(out, correctionlib._core.JaggedArray):
+            return awkward.unflatten(out.content, numpy.diff(out.offsets))
+        return out
+
+    out = evaluate(*cargs)
+    if isinstance(out, tuple):
+        return tuple(unflatten(item) for item in out)
+    return unflatten(out)
+
+
 class Correction:
     """High-level correction evaluator object
 
@@ -56,6 +198,8 @@ class Correction:
         self._base = base
         self._name = base.name
         self._context = context
+        self._evaluate_scalar = base._scalar_evaluator
+        self._ufunc: Optional[numpy.ufunc] = None
 
     def __getstate__(self) -> Dict[str, Any]:
         return {"_context": self._context, "_name": self._name}
@@ -64,6 +208,8 @@ class Correction:
         self._context = state["_context"]
         self._name = state["_name"]
         self._base = self._context[self._name]._base
+        self._evaluate_scalar = self._base._scalar_evaluator
+        self._ufunc = None
 
     @property
     def name(self) -> str:
@@ -78,22 +224,118 @@ class Correction:
         return self._base.version
 
     def evaluate(
-        self, *args: Union["numpy.ndarray[Any, Any]", str, int, float]
+        self,
+        *args: Union[
+            "numpy.ndarray[Any, Any]",
+            correctionlib._core.EncodedStrings,
+            correctionlib._core.JaggedArray,
+            str,
+            int,
+            float,
+        ],
+        nthreads: int = 1,
+        out: Optional["numpy.ndarray[Any, numpy.dtype[numpy.float64]]"] = None,
+        op: Optional[str] = None,
+        where: Optional["numpy.ndarray[Any, Any]"] = None,
+        fill: float = numpy.nan,
     ) -> Union[float, "numpy.ndarray[Any, numpy.dtype[numpy.float64]]"]:
-        # TODO: create a ufunc with numpy.vectorize in constructor?
-        vargs = [arg for arg in args if isinstance(arg, numpy.ndarray)]
-        if vargs:
-            bargs = numpy.broadcast_arrays(*vargs)  # type: ignore
-            oshape = bargs[0].shape
-            bargs = (arg.flatten() for arg in bargs)
-            out = self._base.evalv(
-                *(
-                    next(bargs) if isinstance(arg, numpy.ndarray) else arg
-                    for arg in args
+        """Evaluate the correction on scalars, or on arrays broadcast together
+
+        Array evaluations run on ``nthreads`` threads (0 for all cores), can write
+        or accumulate with ``op`` into ``out``, and only evaluate the rows selected
+        by ``where``, as described in `_evaluate`.
+        """
+        return cast(
+            _EvaluateResult,
+            _evaluate(
+                self._base, args, nthreads, out, op, where, fill, self._evaluate_scalar
+            ),
+        )
+
+    def evaluate_with_status(
+        self,
+        *args: Union[
+            "numpy.ndarray[Any, Any]",
+            correctionlib._core.EncodedStrings,
+            correctionlib._core.JaggedArray,
+            str,
+            int,
+            float,
+        ],
+        fill: float = numpy.nan,
+        nthreads: int = 1,
+    ) -> Tuple[Any, Any]:
+        """Evaluate the correction, giving ``fill`` and a status for failed lookups
+
+        The result is the outputs and an array of their `EvaluationStatus`.
+        """
+        return _evaluate_with_status(self._base, args, fill, nthreads)
+
+    def evaluate_variations(
+        self,
+        input_name: str,
+        values: Sequence[Union[str, int, float]],
+        *args: Union[
+            "numpy.ndarray[Any, Any]",
+            correctionlib._core.EncodedStrings,
+            correctionlib._core.JaggedArray,
+            str,
+            int,
+            float,
+        ],
+        nthreads: int = 1,
+    ) -> "numpy.ndarray[Any, numpy.dtype[numpy.float64]]":
+        """Evaluate the correction for several values of one input
+
+        The other inputs are given in order as for `evaluate`, and the result has
+        one more dimension than them, indexing ``values``. This is typically used
+        for systematic variations: the correction tree is walked once per row,
+        and branches on ``values`` only at the nodes that read that input.
+        """
+        values = list(values)
+        if "awkward" in sys.modules:
+            import awkward
+
+            if any(isinstance(arg, awkward.Array) for arg in args):
+                return _evaluate_awkward(  # type: ignore
+                    lambda *cargs: self._base.evaluate_variations(
+                        input_name, values, *cargs, nthreads=nthreads
+                    ),
+                    args,
                 )
-            )
-            return out.reshape(oshape)
-        return self._base.evaluate(*args)  # type: ignore
+        return self._base.evaluate_variations(  # type: ignore
+            input_name, values, *args, nthreads=nthreads
+        )
+
+    @property
+    def ufunc(self) -> numpy.ufunc:
+        """The correction as a numpy ufunc
+
+        The ufunc takes one argument per input and returns float64 values, with
+        the full ufunc machinery: broadcasting, ``out=``, ``where=``, and dispatch
+        through ``__array_ufunc__`` from other array libraries. Real inputs are
+        evaluated as float64, integer inputs as int32 or int64, and string inputs
+        as python objects.
+        """
+        if self._ufunc is None:
+            self._ufunc = self._base.ufunc
+        return self._ufunc
+
+    def encode(
+        self, input_name: str, values: "numpy.ndarray[Any, Any]"
+    ) -> correctionlib._core.EncodedStrings:
+        """Encode an array of strings for a string input of this correction
+
+        Each distinct value is stored once, and each element as an index into
+        the distinct values. The result can be passed to `evaluate` in place of
+        the array any number of times, saving the encoding of the strings.
+        """
+        for var in self._base.inputs:
+            if var.name == input_name:
+                if var.type != "string":
+                    raise ValueError(f"Input {input_name} is not of string type")
+                return correctionlib._core.EncodedStrings.encode(numpy.asarray(values))
+        raise KeyError(f"No input named {input_name} in correction {self._name}")
 
 
 class CompoundCorrection:
@@ -109,6 +351,8 @@ class CompoundCorrection:
         self._base = base
         self._name = base.name
         self._context = context
+        self._evaluate_scalar = base._scalar_evaluator
+        self._ufunc: Optional[numpy.ufunc] = None
 
     def __getstate__(self) -> Dict[str, Any]:
         return {"_context": self._context, "_name": self._name}
@@ -117,6 +361,8 @@ class CompoundCorrection:
         self._context = state["_context"]
         self._name = state["_name"]
         self._base = self._context.compound[self._name]._base
+        self._evaluate_scalar = self._base._scalar_evaluator
+        self._ufunc = None
 
     @property
     def name(self) -> str:
@@ -127,22 +373,51 @@ class CompoundCorrection:
         return self._base.description
 
     def evaluate(
-        self, *args: Union["numpy.ndarray[Any, Any]", str, int, float]
+        self,
+        *args: Union[
+            "numpy.ndarray[Any, Any]",
+            correctionlib._core.EncodedStrings,
+            correctionlib._core.JaggedArray,
+            str,
+            int,
+            float,
+        ],
+        nthreads: int = 1,
+        out: Optional["numpy.ndarray[Any, numpy.dtype[numpy.float64]]"] = None,
+        op: Optional[str] = None,
+        where: Optional["numpy.ndarray[Any, Any]"] = None,
+        fill: float = numpy.nan,
     ) -> Union[float, "numpy.ndarray[Any, numpy.dtype[numpy.float64]]"]:
-        # TODO: create a ufunc with numpy.vectorize in constructor?
-        vargs = [arg for arg in args if isinstance(arg, numpy.ndarray)]
-        if vargs:
-            bargs = numpy.broadcast_arrays(*vargs)  # type: ignore
-            oshape = bargs[0].shape
-            bargs = (arg.flatten() for arg in bargs)
-            out = self._base.evalv(
-                *(
-                    next(bargs) if isinstance(arg, numpy.ndarray) else arg
-                    for arg in args
-                )
-            )
-            return out.reshape(oshape)
-        return self._base.evaluate(*args)  # type: ignore
+        """As `Correction.evaluate`"""
+        return cast(
+            _EvaluateResult,
+            _evaluate(
+                self._base, args, nthreads, out, op, where, fill, self._evaluate_scalar
+            ),
+        )
+
+    def evaluate_with_status(
+        self,
+        *args: Union[
+            "numpy.ndarray[Any, Any]",
+            correctionlib._core.EncodedStrings,
+            correctionlib._core.JaggedArray,
+            str,
+            int,
+            float,
+        ],
+        fill: float = numpy.nan,
+        nthreads: int = 1,
+    ) -> Tuple[Any, Any]:
+        """As `Correction.evaluate_with_status`"""
+        return _evaluate_with_status(self._base, args, fill, nthreads)
+
+    @property
+    def ufunc(self) -> numpy.ufunc:
+        """The correction as a numpy ufunc, see `Correction.ufunc`"""
+        if self._ufunc is None:
+            self._ufunc = self._base.ufunc
+        return self._ufunc
 
 
 class _CompoundMap(Mapping[str, CompoundCorrection]):
@@ -172,29 +447,45 @@ class CorrectionSet(Mapping[str, Correction]):
     schema version, or can be initialized via the ``from_file`` or
     ``from_string`` factory methods. Corrections can be accessed
     via getitem syntax, e.g. ``cset["some correction"]``.
+
+    With ``lazy=True``, each correction is only built when first accessed, so
+    that loading a large set to use a few of its corrections is cheap. Errors
+    in a correction are then only raised on its first access. Otherwise all
+    corrections are built on load, split across ``nthreads`` native threads
+    (0 for all available cores).
     """
 
-    def __init__(self, data: Any):
+    def __init__(self, data: Any, lazy: bool = False, nthreads: int = 1):
         if isinstance(data, str):
             self._data = data
         else:
             self._data = data.json(exclude_unset=True)
-        self._base = correctionlib._core.CorrectionSet.from_string(self._data)
+        self._lazy = lazy
+        self._base = correctionlib._core.CorrectionSet.from_string(
+            self._data, lazy, nthreads
+        )
 
     @classmethod
-    def from_file(cls, filename: str) -> "CorrectionSet":
-        return cls(open_auto(filename))
+    def from_file(
+        cls, filename: str, lazy: bool = False, nthreads: int = 1
+    ) -> "CorrectionSet":
+        return cls(open_auto(filename), lazy, nthreads)
 
     @classmethod
-    def from_string(cls, data: str) -> "CorrectionSet":
-        return cls(data)
+    def from_string(
+        cls, data: str, lazy: bool = False, nthreads: int = 1
+    ) -> "CorrectionSet":
+        return cls(data, lazy, nthreads)
 
     def __getstate__(self) -> Dict[str, Any]:
-        return {"_data": self._data}
+        return {"_data": self._data, "_lazy": self._lazy}
 
     def __setstate__(self, state: Dict[str, Any]) -> None:
         self._data = state["_data"]
-        self._base = correctionlib._core.CorrectionSet.from_string(self._data)
+        self._lazy = state.get("_lazy", False)
+        self._base = correctionlib._core.CorrectionSet.from_string(
+            self._data, self._lazy
+        )
 
     def _ipython_key_completions_(self) -> List[str]:
         return list(self.keys())
@@ -210,9 +501,38 @@ class CorrectionSet(Mapping[str, Correction]):
     def __len__(self) -> int:
         return len(self._base)
 
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and key in self._base
+
     def __iter__(self) -> Iterator[str]:
         return iter(self._base)
 
     @property
     def compound(self) -> _CompoundMap:
         return _CompoundMap(self._base.compound, self)
+
+    def evaluate_many(
+        self,
+        names: List[str],
+        inputs: Mapping[
+            str,
+            Union[
+                "numpy.ndarray[Any, Any]",
+                correctionlib._core.EncodedStrings,
+                str,
+                int,
+                float,
+            ],
+        ],
+        nthreads: int = 1,
+    ) -> Dict[str, "numpy.ndarray[Any, numpy.dtype[numpy.float64]]"]:
+        """Evaluate several corrections on shared inputs
+
+        The corrections, or compound corrections, are given by name, and their
+        inputs are taken from ``inputs`` by variable name. Array inputs are
+        broadcast against each other, and each distinct input is converted once
+        for all corrections, which are then evaluated in a single pass over the
+        rows, optionally split across ``nthreads`` native threads (0 for all
+        available cores). The outputs are returned by correction name.
+        """
+        return self._base.evaluate_many(list(names), dict(inputs), nthreads)
@@ -1,213 +1,320 @@
-#include <mutex>
+#include <algorithm>
+#include <array>
 #include <cmath>
-#include "peglib.h"
+#include <cstdlib>
+#include <stdexcept>
+#include <string_view>
 #include "correction.h"
 
 using namespace correction;
 
 namespace {
-  class PEGParser {
+  struct UnaryFunction {
+    std::string_view name;
+    FormulaAst::UnaryFcn fun;
+  };
+
+  const UnaryFunction unary_functions[] = {
+    {"log",   [](double x) { return std::log(x); }},
+    {"log10", [](double x) { return std::log10(x); }},
+    {"exp",   [](double x) { return std::exp(x); }},
+    {"erf",   [](double x) { return std::erf(x); }},
+    {"sqrt",  [](double x) { return std::sqrt(x); }},
+    {"abs",   [](double x) { return std::abs(x); }},
+    {"cos",   [](double x) { return std::cos(x); }},
+    {"sin",   [](double x) { return std::sin(x); }},
+    {"tan",   [](double x) { return std::tan(x); }},
+    {"acos",  [](double x) { return std::acos(x); }},
+    {"asin",  [](double x) { return std::asin(x); }},
+    {"atan",  [](double x) { return std::atan(x); }},
+    {"cosh",  [](double x) { return std::cosh(x); }},
+    {"sinh",  [](double x) { return std::sinh(x); }},
+    {"tanh",  [](double x) { return std::tanh(x); }},
+    {"acosh", [](double x) { return std::acosh(x); }},
+    {"asinh", [](double x) { return std::asinh(x); }},
+    {"atanh", [](double x) { return std::atanh(x); }},
+  };
+
+  struct BinaryFunction {
+    std::string_view name;
+    FormulaAst::BinaryFcn fun;
+  };
+
+  const BinaryFunction binary_functions[] = {
+    {"atan2", [](double x, double y) { return std::atan2(x, y); }},
+    {"pow",   [](double x, double y) { return std::pow(x, y); }},
+    {"max",   [](double x, double y) { return std::max(x, y); }},
+    {"min",   [](double x, double y) { return std::min(x, y); }},
+  };
+
+  struct BinaryOperator {
+    std::string_view token;
+    FormulaAst::BinaryOp op;
+    int precedence;
+  };
+
+  // two-character tokens first, so that the longest one matches
+  const BinaryOperator binary_operators[] = {
+    {"==", FormulaAst::BinaryOp::Equal, 0},
+    {"!=", FormulaAst::BinaryOp::NotEqual, 0},
+    {">=", FormulaAst::BinaryOp::GreaterEq, 1},
+    {"<=", FormulaAst::BinaryOp::LessEq, 1},
+    {">",  FormulaAst::BinaryOp::Greater, 1},
+    {"<",  FormulaAst::BinaryOp::Less, 1},
+    {"-",  FormulaAst::BinaryOp::Minus, 2},
+    {"+",  FormulaAst::BinaryOp::Plus, 2},
+    {"/",  FormulaAst::BinaryOp::Div, 3},
+    {"*",  FormulaAst::BinaryOp::Times, 3},
+    {"^",  FormulaAst::BinaryOp::Pow, 4},
+  };
+
+  struct ParseError : std::runtime_error {
+    using std::runtime_error::runtime_error;
+  };
+
+  // Recursive descent parser of TFormula expressions, building the AST as
+  // it goes. All its state is local to one parse, so that formulas can be
+  // parsed on any number of threads at once. The grammar is
+  //
+  //   EXPRESSION <- ATOM (BINARYOP ATOM)*
+  //   ATOM       <- LITERAL / '-'? (CALLU / CALLB / NAME / '(' EXPRESSION ')')
+  //   CALLU      <- UNARYF '(' EXPRESSION ')'
+  //   CALLB      <- BINARYF '(' EXPRESSION ',' EXPRESSION ')'
+  //   NAME       <- '[' [0-9]+ ']' / [xyzt]
+  //   LITERAL    <- '-'? [0-9]+ ('.' [0-9]*)? ('e' '-'? [0-9]+)?
+  //
+  // with spaces or tabs between tokens. The binary operators are, by
+  // increasing precedence, == != then > < >= <= then - + then / * then ^,
+  // all left-associative except ^. A leading minus is part of the atom, so
+  // it binds tighter than any binary operator: -x^2 is (-x)^2.
+  //
+  // The AST built is generic: parameters are left as Parameter nodes, and
+  // variables refer to their position in xyzt rather than to an input.
+  class TFormulaParser {
     public:
-      // We are not sure if peglib is threadsafe, so the policy is to lock this
-      // parser mutex until we are done with the peg::Ast object
-      std::mutex m;
-      typedef std::shared_ptr<peg::Ast> AstPtr;
-
-      PEGParser(const char * grammar) {
-        parser_.load_grammar(grammar);
-        parser_.enable_ast();
-        parser_.enable_packrat_parsing();
-      };
-      AstPtr parse(const std::string_view expression) {
-        AstPtr peg_ast;
-        int pos;
-        std::string msg;
-        parser_.log = [&](size_t ln, size_t col, const std::string &themsg) {
-          pos = col;
-          msg = themsg;
-        };
-        if ( ! parser_.parse(expression, peg_ast) ) {
-          throw std::runtime_error(
-            "Failed to parse Formula expression at position " + std::to_string(pos) + ":\n"
-            + std::string(expression) + "\n"
-            + std::string(pos, ' ') + "^\n"
-            + msg
-          );
+      TFormulaParser(const std::string_view expression) : expression_(expression) { };
+
+      FormulaAst parse() {
+        auto ast = parse_expression(0);
+        skip_whitespace();
+        if ( pos_ < expression_.size() ) {
+          fail("expecting a binary operator or the end of the expression");
         }
-        peg_ast = parser_.optimize_ast(peg_ast);
-        return peg_ast;
+        return ast;
       };
 
     private:
-      peg::parser parser_;
-  };
+      [[noreturn]] void fail(const std::string& msg) const {
+        throw ParseError(
+          "Failed to parse Formula expression at position " + std::to_string(pos_ + 1) + ":\n"
+          + std::string(expression_) + "\n"
+          + std::string(pos_, ' ') + "^\n"
+          + msg
+        );
+      };
 
-  PEGParser tformula_parser(R"(
-  EXPRESSION  <- ATOM (BINARYOP ATOM)* {
-                  precedence
-                    L == !=
-                    L > < >= <=
-                    L - +
-                    L / *
-                    R ^
-                }
-  UNARYOP     <- < '-' >
-  BINARYOP    <- < '==' | '!=' | '>' | '<' | '>=' | '<=' | '-' | '+' | '/' | '*' | '^' >
-  UNARYF      <- < 'log' | 'log10' | 'exp' | 'erf' | 'sqrt' | 'abs' | 'cos' | 'sin' | 'tan' | 'acos' | 'asin' | 'atan' | 'cosh' | 'sinh' | 'tanh' | 'acosh' | 'asinh' | 'atanh' >
-  BINARYF     <- < 'atan2' | 'pow' | 'max' | 'min' >
-  PARAMETER   <- '[' < [0-9]+ > ']'
-  VARIABLE    <- < [xyzt] >
-  LITERAL     <- < '-'? [0-9]+ ('.' [0-9]*)? ('e' '-'? [0-9]+)? >
-  CALLU       <- UNARYF '(' EXPRESSION ')'
-  CALLB       <- BINARYF '(' EXPRESSION ',' EXPRESSION ')'
-  ATOM        <- LITERAL / UATOM
-  UATOM       <- UNARYOP? ( CALLU / CALLB / NAME / '(' EXPRESSION ')' )
-  NAME        <- PARAMETER / VARIABLE
-  %whitespace <- [ \t]*
-  )");
-
-  struct TranslationContext {
-      const std::vector<double>& params;
-      const std::vector<size_t>& variableIdx;
-      bool bind_parameters;
-  };
+      void skip_whitespace() {
+        while ( pos_ < expression_.size() && (expression_[pos_] == ' ' || expression_[pos_] == '\t') ) ++pos_;
+      };
 
-  FormulaAst translate_tformula_ast(
-      const PEGParser::AstPtr ast,
-      const TranslationContext& context
-      ) {
-    if (ast->is_token) {
-      if (ast->name == "LITERAL") {
-        return {FormulaAst::NodeType::Literal, ast->token_to_number<double>(), {}};
-      }
-      else if (ast->name == "VARIABLE") {
-        size_t idx;
-        if ( ast->token == "x" ) idx = 0;
-        else if ( ast->token == "y" ) idx = 1;
-        else if ( ast->token == "z" ) idx = 2;
-        else if ( ast->token == "t" ) idx = 3;
-        else {
-          throw std::runtime_error("Unrecognized variable name in formula");
+      bool is_digit(size_t pos) const {
+        return pos < expression_.size() && expression_[pos] >= '0' && expression_[pos] <= '9';
+      };
+
+      size_t skip_digits(size_t pos) const {
+        while ( is_digit(pos) ) ++pos;
+        return pos;
+      };
+
+      bool accept(char c) {
+        skip_whitespace();
+        if ( pos_ < expression_.size() && expression_[pos_] == c ) {
+          ++pos_;
+          return true;
         }
-        if ( context.variableIdx.size() <= idx ) {
-          throw std::runtime_error("Insufficient variables for formula");
+        return false;
+      };
+
+      void expect(char c) {
+        if ( ! accept(c) ) fail(std::string("expecting '") + c + "'");
+      };
+
+      FormulaAst parse_expression(int min_precedence) {
+        auto left = parse_atom();
+        while ( true ) {
+          skip_whitespace();
+          const BinaryOperator * match = nullptr;
+          for (const auto& item : binary_operators) {
+            if ( expression_.substr(pos_, item.token.size()) == item.token ) {
+              match = &item;
+              break;
+            }
+          }
+          if ( match == nullptr || match->precedence < min_precedence ) return left;
+          pos_ += match->token.size();
+          // ^ is right-associative
+          const int next = match->op == FormulaAst::BinaryOp::Pow ? match->precedence : match->precedence + 1;
+          // An operator without a valid operand after it is skipped, and
+          // parsing goes on after it, e.g. x+ is x and (x>y^*z) is (x>y)*z.
+          // The earlier parser, based on peglib, behaved this way, which is
+          // kept so that existing formulas read as they always did.
+          const size_t operand = pos_;
+          try {
+            auto right = parse_expression(next);
+            left = FormulaAst(FormulaAst::NodeType::Expression, match->op, {std::move(left), std::move(right)});
+          } catch (const ParseError&) {
+            pos_ = operand;
+            return left;
+          }
         }
-        return {FormulaAst::NodeType::Variable, context.variableIdx[idx], {}};
-      }
-      else if (ast->name == "PARAMETER") {
-        auto pidx = ast->token_to_number<size_t>();
-        if ( context.bind_parameters ) {
-          if ( pidx >= context.params.size() ) {
-            throw std::runtime_error("Insufficient parameters for formula");
+      };
+
+      FormulaAst parse_atom() {
+        skip_whitespace();
+        const size_t start = pos_;
+        size_t end = start;
+        if ( end < expression_.size() && expression_[end] == '-' ) ++end;
+        if ( is_digit(end) ) {
+          end = skip_digits(end);
+          if ( end < expression_.size() && expression_[end] == '.' ) end = skip_digits(end + 1);
+          if ( end < expression_.size() && expression_[end] == 'e' ) {
+            size_t exponent = end + 1;
+            if ( exponent < expression_.size() && expression_[exponent] == '-' ) ++exponent;
+            if ( is_digit(exponent) ) end = skip_digits(exponent);
           }
-          return {FormulaAst::NodeType::Literal, context.params[pidx], {}};
+          pos_ = end;
+          const std::string token(expression_.substr(start, end - start));
+          return {FormulaAst::NodeType::Literal, std::strtod(token.c_str(), nullptr), {}};
         }
-        else {
-          return {FormulaAst::NodeType::Parameter, pidx, {}};
+        if ( accept('-') ) {
+          return {FormulaAst::NodeType::UAtom, FormulaAst::UnaryOp::Negative, {parse_operand()}};
         }
-      }
-    }
-    else if (ast->name == "UATOM" ) {
-      if ( ast->nodes.size() != 2 ) { throw std::runtime_error("UATOM without 2 nodes?"); }
-      auto opname = ast->nodes[0]->token;
-      FormulaAst::UnaryOp op;
-      if      ( opname == "-" ) { op = FormulaAst::UnaryOp::Negative; }
-      else { throw std::runtime_error("Unrecognized unary operation: " + std::string(opname)); }
-      return {
-        FormulaAst::NodeType::UAtom,
-        op,
-        {translate_tformula_ast(ast->nodes[1], context)}
-      };
-    }
-    else if (ast->name == "CALLU" ) {
-      if ( ast->nodes.size() != 2 ) { throw std::runtime_error("CALLU without 2 nodes?"); }
-      FormulaAst::UnaryFcn fun;
-      auto name = ast->nodes[0]->token;
-      // TODO: lookup in static map
-      if      ( name == "log" )   { fun = [](double x) { return std::log(x); }; }
-      else if ( name == "log10" ) { fun = [](double x) { return std::log10(x); }; }
-      else if ( name == "exp" )   { fun = [](double x) { return std::exp(x); }; }
-      else if ( name == "erf" )   { fun = [](double x) { return std::erf(x); }; }
-      else if ( name == "sqrt" )  { fun = [](double x) { return std::sqrt(x); }; }
-      else if ( name == "abs" )   { fun = [](double x) { return std::abs(x); }; }
-      else if ( name == "cos" )   { fun = [](double x) { return std::cos(x); }; }
-      else if ( name == "sin" )   { fun = [](double x) { return std::sin(x); }; }
-      else if ( name == "tan" )   { fun = [](double x) { return std::tan(x); }; }
-      else if ( name == "acos" )  { fun = [](double x) { return std::acos(x); }; }
-      else if ( name == "asin" )  { fun = [](double x) { return std::asin(x); }; }
-      else if ( name == "atan" )  { fun = [](double x) { return std::atan(x); }; }
-      else if ( name == "cosh" )  { fun = [](double x) { return std::cosh(x); }; }
-      else if ( name == "sinh" )  { fun = [](double x) { return std::sinh(x); }; }
-      else if ( name == "tanh" )  { fun = [](double x) { return std::tanh(x); }; }
-      else if ( name == "acosh" ) { fun = [](double x) { return std::acosh(x); }; }
-      else if ( name == "asinh" ) { fun = [](double x) { return std::asinh(x); }; }
-      else if ( name == "atanh" ) { fun = [](double x) { return std::atanh(x); }; }
-      else {
-        throw std::runtime_error("unrecognized unary function: " + std::string(name));
-      }
-      return {
-        FormulaAst::NodeType::UnaryCall,
-        fun,
-        {translate_tformula_ast(ast->nodes[1], context)}
+        return parse_operand();
       };
-    }
-    else if (ast->name == "CALLB" ) {
-      if ( ast->nodes.size() != 3 ) { throw std::runtime_error("CALLB without 3 nodes?"); }
-      FormulaAst::BinaryFcn fun;
-      auto name = ast->nodes[0]->token;
-      // TODO: lookup in static map
-      if      ( name == "atan2" ) { fun = [](double x, double y) { return std::atan2(x, y); }; }
-      else if ( name == "pow" )   { fun = [](double x, double y) { return std::pow(x, y); }; }
-      else if ( name == "max" )   { fun = [](double x, double y) { return std::max(x, y); }; }
-      else if ( name == "min" )   { fun = [](double x, double y) { return std::min(x, y); }; }
-      else {
-        throw std::runtime_error("unrecognized binary function: " + std::string(name));
-      }
-      return {
-        FormulaAst::NodeType::BinaryCall,
-        fun,
-        {translate_tformula_ast(ast->nodes[1], context), translate_tformula_ast(ast->nodes[2], context)}
-      };
-    }
-    else if (ast->name == "EXPRESSION" ) {
-      if ( ast->nodes.size() != 3 ) { throw std::runtime_error("EXPRESSION without 3 nodes?"); }
-      auto opname = ast->nodes[1]->token;
-      FormulaAst::BinaryOp op;
-      if      ( opname == "==" ) { op = FormulaAst::BinaryOp::Equal; }
-      else if ( opname == "!=" ) { op = FormulaAst::BinaryOp::NotEqual; }
-      else if ( opname == ">"  ) { op = FormulaAst::BinaryOp::Greater; }
-      else if ( opname == "<"  ) { op = FormulaAst::BinaryOp::Less; }
-      else if ( opname == ">=" ) { op = FormulaAst::BinaryOp::GreaterEq; }
-      else if ( opname == "<=" ) { op = FormulaAst::BinaryOp::LessEq; }
-      else if ( opname == "-"  ) { op = FormulaAst::BinaryOp::Minus; }
-      else if ( opname == "+"  ) { op = FormulaAst::BinaryOp::Plus; }
-      else if ( opname == "/"  ) { op = FormulaAst::BinaryOp::Div; }
-      else if ( opname == "*"  ) { op = FormulaAst::BinaryOp::Times; }
-      else if ( opname == "^"  ) { op = FormulaAst::BinaryOp::Pow; }
-      else { throw std::runtime_error("Unrecognized binary operation: " + std::string(opname)); }
-      return {
-        FormulaAst::NodeType::Expression,
-        op,
-        {translate_tformula_ast(ast->nodes[0], context), translate_tformula_ast(ast->nodes[2], context)}
+
+      FormulaAst parse_operand() {
+        skip_whitespace();
+        // the longest function name the expression continues with
+        const UnaryFunction * unary = nullptr;
+        const BinaryFunction * binary = nullptr;
+        size_t length = 0;
+        for (const auto& item : unary_functions) {
+          if ( item.name.size() > length && expression_.substr(pos_, item.name.size()) == item.name ) {
+            unary = &item;
+            length = item.name.size();
+          }
+        }
+        for (const auto& item : binary_functions) {
+          if ( item.name.size() > length && expression_.substr(pos_, item.name.size()) == item.name ) {
+            unary = nullptr;
+            binary = &item;
+            length = item.name.size();
+          }
+        }
+        if ( unary != nullptr ) {
+          pos_ += length;
+          expect('(');
+          auto arg = parse_expression(0);
+          expect(')');
+          return {FormulaAst::NodeType::UnaryCall, unary->fun, {std::move(arg)}};
+        }
+        if ( binary != nullptr ) {
+          pos_ += length;
+          expect('(');
+          auto arg1 = parse_expression(0);
+          expect(',');
+          auto arg2 = parse_expression(0);
+          expect(')');
+          return {FormulaAst::NodeType::BinaryCall, binary->fun, {std::move(arg1), std::move(arg2)}};
+        }
+        if ( accept('(') ) {
+          auto ast = parse_expression(0);
+          expect(')');
+          return ast;
+        }
+        if ( accept('[') ) {
+          skip_whitespace();
+          const size_t start = pos_;
+          pos_ = skip_digits(pos_);
+          if ( pos_ == start ) fail("expecting a parameter index");
+          const size_t pidx = std::stoul(std::string(expression_.substr(start, pos_ - start)));
+          expect(']');
+          return {FormulaAst::NodeType::Parameter, pidx, {}};
+        }
+        if ( pos_ < expression_.size() ) {
+          const size_t idx = std::string_view("xyzt").find(expression_[pos_]);
+          if ( idx != std::string_view::npos ) {
+            ++pos_;
+            return {FormulaAst::NodeType::Variable, idx, {}};
+          }
+        }
+        fail("expecting a number, variable, parameter, function call or '('");
       };
-    }
-    throw std::runtime_error("Unrecognized AST node");
-  }
+
+      const std::string_view expression_;
+      size_t pos_{0};
+  };
 
 }
 
 FormulaAst FormulaAst::parse(
     FormulaAst::ParserType type,
     const std::string_view expression,
+    const std::vector<double>& params,
+    const std::vector<size_t>& variableIdx,
+    bool bind_parameters,
+    ParseCache * cache
+    ) {
+  if ( type != ParserType::TFormula ) {
+    throw std::runtime_error("Unrecognized formula parser type");
+  }
+  FormulaAst ast;
+  if ( cache == nullptr ) {
+    ast = TFormulaParser(expression).parse();
+  }
+  else {
+    // The generic AST is only kept once an expression is seen a second
+    // time, so that an expression used once is not copied for nothing
+    auto [it, first] = cache->try_emplace({type, std::string(expression)});
+    if ( first ) {
+      ast = TFormulaParser(expression).parse();
+    }
+    else {
+      if ( it->second.nodetype_ == NodeType::Undefined ) {
+        it->second = TFormulaParser(expression).parse();
+      }
+      ast = it->second;
+    }
+  }
+  ast.bind(params, variableIdx, bind_parameters);
+  return ast;
+}
+
+// Errors are raised for the first variable or parameter missing in the
+// order they appear in the expression, as children are bound in order
+void FormulaAst::bind(
     const std::vector<double>& params,
     const std::vector<size_t>& variableIdx,
     bool bind_parameters
     ) {
-  if ( type == ParserType::TFormula ) {
-    const std::lock_guard<std::mutex> lock(tformula_parser.m);
-    return translate_tformula_ast(tformula_parser.parse(expression), TranslationContext{params, variableIdx, bind_parameters});
+  if ( nodetype_ == NodeType::Variable ) {
+    const auto idx = std::get<size_t>(data_);
+    if ( idx >= variableIdx.size() ) {
+      throw std::runtime_error("Insufficient variables for formula");
+    }
+    data_ = variableIdx[idx];
+  }
+  else if ( nodetype_ == NodeType::Parameter && bind_parameters ) {
+    const auto idx = std::get<size_t>(data_);
+    if ( idx >= params.size() ) {
+      throw std::runtime_error("Insufficient parameters for formula");
+    }
+    nodetype_ = NodeType::Literal;
+    data_ = params[idx];
+  }
+  for (auto& child : children_) {
+    child.bind(params, variableIdx, bind_parameters);
   }
-  throw std::runtime_error("Unrecognized formula parser type");
 }
 
 double FormulaAst::evaluate(const std::vector<Variable::Type>& values, const std::vector<double>& params) const {
@@ -250,3 +357,183 @@ double FormulaAst::evaluate(const std::vector<Variable::Type>& values, const std
       };
   }
 }
+
+FormulaProgram::FormulaProgram(const FormulaAst& ast) {
+  compile(ast, 0);
+}
+
+// Emits the instructions of ast, which start with depth values on the
+// stack. Returns whether ast is constant, in which case it was folded to a
+// single literal instruction.
+bool FormulaProgram::compile(const FormulaAst& ast, size_t depth) {
+  depth_ = std::max(depth_, depth + 1);
+  Instruction ins {Op::Literal, 0, 0., nullptr, nullptr};
+  switch (ast.nodetype_) {
+    case FormulaAst::NodeType::Literal:
+      ins.value = std::get<double>(ast.data_);
+      code_.push_back(ins);
+      return true;
+    case FormulaAst::NodeType::Variable:
+      ins.op = Op::Variable;
+      ins.index = std::get<size_t>(ast.data_);
+      code_.push_back(ins);
+      return false;
+    case FormulaAst::NodeType::Parameter:
+      ins.op = Op::Parameter;
+      ins.index = std::get<size_t>(ast.data_);
+      code_.push_back(ins);
+      return false;
+    case FormulaAst::NodeType::UAtom:
+      ins.op = Op::Negative;
+      break;
+    case FormulaAst::NodeType::UnaryCall:
+      ins.op = Op::UnaryCall;
+      ins.unary = std::get<FormulaAst::UnaryFcn>(ast.data_);
+      break;
+    case FormulaAst::NodeType::BinaryCall:
+      ins.op = Op::BinaryCall;
+      ins.binary = std::get<FormulaAst::BinaryFcn>(ast.data_);
+      break;
+    case FormulaAst::NodeType::Expression:
+      switch (std::get<FormulaAst::BinaryOp>(ast.data_)) {
+        case FormulaAst::BinaryOp::Equal: ins.op = Op::Equal; break;
+        case FormulaAst::BinaryOp::NotEqual: ins.op = Op::NotEqual; break;
+        case FormulaAst::BinaryOp::Greater: ins.op = Op::Greater; break;
+        case FormulaAst::BinaryOp::Less: ins.op = Op::Less; break;
+        case FormulaAst::BinaryOp::GreaterEq: ins.op = Op::GreaterEq; break;
+        case FormulaAst::BinaryOp::LessEq: ins.op = Op::LessEq; break;
+        case FormulaAst::BinaryOp::Minus: ins.op = Op::Minus; break;
+        case FormulaAst::BinaryOp::Plus: ins.op = Op::Plus; break;
+        case FormulaAst::BinaryOp::Div: ins.op = Op::Div; break;
+        case FormulaAst::BinaryOp::Times: ins.op = Op::Times; break;
+        case FormulaAst::BinaryOp::Pow: ins.op = Op::Pow; break;
+      }
+      break;
+    case FormulaAst::NodeType::Undefined:
+      throw std::runtime_error("Unrecognized AST node");
+  }
+  bool constant = true;
+  for (size_t i=0; i < ast.children_.size(); ++i) {
+    constant &= compile(ast.children_[i], depth + i);
+  }
+  if ( constant ) {
+    // the children are literals, so that ast evaluates without inputs
+    code_.resize(code_.size() - ast.children_.size());
+    code_.push_back({Op::Literal, 0, ast.evaluate({}, {}), nullptr, nullptr});
+    return true;
+  }
+  code_.push_back(ins);
+  return false;
+}
+
+double FormulaProgram::evaluate(const std::vector<Variable::Type>& values, const std::vector<double>& params) const {
+  // a fixed stack is enough for all but deeply nested expressions
+  std::array<double, 32> fixed {};
+  std::vector<double> dynamic;
+  double * stack = fixed.data();
+  if ( depth_ > fixed.size() ) {
+    dynamic.resize(depth_);
+    stack = dynamic.data();
+  }
+  size_t n {0};
+  for (const auto& ins : code_) {
+    switch (ins.op) {
+      case Op::Literal: stack[n++] = ins.value; continue;
+      case Op::Variable: stack[n++] = std::get<double>(values[ins.index]); continue;
+      case Op::Parameter: stack[n++] = params[ins.index]; continue;
+      case Op::Negative: stack[n - 1] = -stack[n - 1]; continue;
+      case Op::UnaryCall: stack[n - 1] = ins.unary(stack[n - 1]); continue;
+      default: break;
+    }
+    const double right = stack[--n];
+    double& left = stack[n - 1];
+    switch (ins.op) {
+      case Op::BinaryCall: left = ins.binary(left, right); break;
+      case Op::Equal: left = (left == right) ? 1. : 0.; break;
+      case Op::NotEqual: left = (left != right) ? 1. : 0.; break;
+      case Op::Greater: left = (left > right) ? 1. : 0.; break;
+      case Op::Less: left = (left < right) ? 1. : 0.; break;
+      case Op::GreaterEq: left = (left >= right) ? 1. : 0.; break;
+      case Op::LessEq: left = (left <= right) ? 1. : 0.; break;
+      case Op::Minus: left = left - right; break;
+      case Op::Plus: left = left + right; break;
+      case Op::Div: left = left / right; break;
+      case Op::Times: left = left * right; break;
+      case Op::Pow: left = std::pow(left, right); break;
+      default: break;
+    }
+  }
+  return stack[0];
+}
+
+namespace {
+  template<typename F>
+  inline void apply(double * left, const double * right, size_t nrows, F&& func) {
+    for (size_t i=0; i < nrows; ++i) left[i] = func(left[i], right[i]);
+  }
+}
+
+void FormulaProgram::evaluate(
+    const std::vector<Column>& columns,
+    const std::vector<double>& params,
+    const uint32_t * rows,
+    size_t nrows,
+    double * out
+    ) const {
+  if ( code_.size() == 1 && code_[0].op == Op::Literal ) {
+    for (size_t i=0; i < nrows; ++i) out[rows[i]] = code_[0].value;
+    return;
+  }
+  // each stack slot holds the values of all rows, in a buffer reused by
+  // the evaluations of a thread
+  thread_local std::vector<double> buffer;
+  if ( buffer.size() < depth_ * nrows ) buffer.resize(depth_ * nrows);
+  size_t n {0};
+  for (const auto& ins : code_) {
+    double * top = buffer.data() + n * nrows;
+    switch (ins.op) {
+      case Op::Literal:
+        std::fill(top, top + nrows, ins.value);
+        ++n;
+        continue;
+      case Op::Variable: {
+        const auto& column = columns[ins.index];
+        for (size_t i=0; i < nrows; ++i) top[i] = column.real(rows[i]);
+        ++n;
+        continue;
+      }
+      case Op::Parameter:
+        std::fill(top, top + nrows, params[ins.index]);
+        ++n;
+        continue;
+      case Op::Negative:
+        top -= nrows;
+        for (size_t i=0; i < nrows; ++i) top[i] = -top[i];
+        continue;
+      case Op::UnaryCall:
+        top -= nrows;
+        for (size_t i=0; i < nrows; ++i) top[i] = ins.unary(top[i]);
+        continue;
+      default: break;
+    }
+    --n;
+    double * left = top - 2 * nrows;
+    const double * right = top - nrows;
+    switch (ins.op) {
+      case Op::BinaryCall: apply(left, right, nrows, ins.binary); break;
+      case Op::Equal: apply(left, right, nrows, [](double x, double y) { return (x == y) ? 1. : 0.; }); break;
+      case Op::NotEqual: apply(left, right, nrows, [](double x, double y) { return (x != y) ? 1. : 0.; }); break;
+      case Op::Greater: apply(left, right, nrows, [](double x, double y) { return (x > y) ? 1. : 0.; }); break;
+      case Op::Less: apply(left, right, nrows, [](double x, double y) { return (x < y) ? 1. : 0.; }); break;
+      case Op::GreaterEq: apply(left, right, nrows, [](double x, double y) { return (x >= y) ? 1. : 0.; }); break;
+      case Op::LessEq: apply(left, right, nrows, [](double x, double y) { return (x <= y) ? 1. : 0.; }); break;
+      case Op::Minus: apply(left, right, nrows, [](double x, double y) { return x - y; }); break;
+      case Op::Plus: apply(left, right, nrows, [](double x, double y) { return x + y; }); break;
+      case Op::Div: apply(left, right, nrows, [](double x, double y) { return x / y; }); break;
+      case Op::Times: apply(left, right, nrows, [](double x, double y) { return x * y; }); break;
+      case Op::Pow: apply(left, right, nrows, [](double x, double y) { return std::pow(x, y); }); break;
+      default: break;
+    }
+  }
+  for (size_t i=0; i < nrows; ++i) out[rows[i]] = buffer[i];
+}
@@ -1,6 +1,18 @@
 #include <pybind11/numpy.h>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/ndarraytypes.h>
+#include <numpy/ufuncobject.h>
+#include <cstring>
+#include <limits>
+#include <optional>
+#include <string_view>
+#include <thread>
+#include <algorithm>
+#include <type_traits>
+#include <unordered_map>
+#include <variant>
 #include "correction.h"
 
 namespace py = pybind11;
@@ -8,69 +20,1111 @@ using namespace correction;
 
 namespace {
 
-  template<typename T>
-  py::array_t<double> evalv(T& c, py::args args) {
+  // rows per thread below which it is not worth spawning more threads
+  constexpr size_t min_rows_per_thread { 4096 };
+
+  // Split the rows into contiguous chunks, one per thread. Each chunk stops at
+  // its first failing row, as batch evaluations raise the error of the first
+  // failing row of a block, and after all threads are joined the error of the
+  // lowest failing chunk is raised, so the reported row is always the first
+  // failing row of the whole array regardless of scheduling.
+  template<typename F>
+  void parallel_chunks(size_t n, size_t nthreads, F&& func) {
+    nthreads = std::max<size_t>(1, std::min(nthreads, n / min_rows_per_thread));
+    if ( nthreads == 1 ) {
+      func(0, n);
+      return;
+    }
+    size_t chunk = (n + nthreads - 1) / nthreads;
+    std::vector<std::exception_ptr> errors(nthreads);
+    std::vector<std::thread> threads;
+    threads.reserve(nthreads - 1);
+    auto run = [&](size_t k) {
+      try {
+        func(k * chunk, std::min(n, (k + 1) * chunk));
+      } catch (...) {
+        errors[k] = std::current_exception();
+      }
+    };
+    try {
+      for (size_t k=1; k < nthreads; ++k) {
+        threads.emplace_back(run, k);
+      }
+    } catch (...) {
+      for (auto& thread : threads) thread.join();
+      throw;
+    }
+    run(0);
+    for (auto& thread : threads) thread.join();
+    for (const auto& error : errors) {
+      if ( error ) std::rethrow_exception(error);
+    }
+  }
+
+  // Strings encoded as indices into the list of their distinct values
+  struct EncodedStrings {
+    py::array_t<int> codes;
+    std::vector<std::string> dictionary;
+  };
+
+  // Variable-length lists, stored as the concatenated content of all lists
+  // and the offsets of each list in it: list i is content[offsets[i]:offsets[i + 1]]
+  struct JaggedArray {
+    py::array_t<int64_t> offsets;
+    py::object content; // array or EncodedStrings
+  };
+
+  JaggedArray make_jagged(const py::array_t<int64_t, py::array::c_style | py::array::forcecast>& offsets, py::object content) {
+    if ( offsets.ndim() != 1 || offsets.size() == 0 ) {
+      throw std::invalid_argument("Offsets must be a non-empty one-dimensional array");
+    }
+    py::ssize_t size;
+    if ( py::isinstance<EncodedStrings>(content) ) {
+      const auto& codes = py::cast<const EncodedStrings&>(content).codes;
+      if ( codes.ndim() != 1 ) throw std::invalid_argument("Content must be one-dimensional");
+      size = codes.size();
+    }
+    else {
+      content = py::cast<py::array>(content);
+      if ( py::cast<py::array>(content).ndim() != 1 ) throw std::invalid_argument("Content must be one-dimensional");
+      size = py::cast<py::array>(content).size();
+    }
+    // private read-only copy, checked once
+    auto copy = py::array_t<int64_t>(offsets.size(), offsets.data());
+    const int64_t * data = copy.data();
+    if ( data[0] < 0 || data[offsets.size() - 1] > size ) {
+      throw py::index_error("Offsets out of range of the content");
+    }
+    for (py::ssize_t i=1; i < copy.size(); ++i) {
+      if ( data[i] < data[i - 1] ) throw std::invalid_argument("Offsets must be non-decreasing");
+    }
+    copy.attr("setflags")(py::arg("write") = false);
+    return {copy, content};
+  }
+
+  bool same_layout(const JaggedArray& a, const JaggedArray& b) {
+    if ( a.offsets.ptr() == b.offsets.ptr() ) return true;
+    if ( a.offsets.size() != b.offsets.size() ) return false;
+    const int64_t * x = a.offsets.data();
+    const int64_t * y = b.offsets.data();
+    for (py::ssize_t i=1; i < a.offsets.size(); ++i) {
+      if ( x[i] - x[0] != y[i] - y[0] ) return false;
+    }
+    return true;
+  }
+
+  // Each distinct value is hashed and decoded once, at its first occurrence.
+  // The codes have the shape of the values.
+  EncodedStrings encode_strings(const py::array& array) {
+    const auto values = py::cast<py::array>(array.attr("reshape")(-1));
+    const char kind = values.dtype().kind();
+    if ( kind != 'U' && kind != 'S' && kind != 'O' ) {
+      throw std::invalid_argument("String arrays must be of unicode, bytes, or object dtype");
+    }
+    const size_t n = values.shape(0);
+    const size_t itemsize = values.itemsize();
+    const auto * data = static_cast<const char*>(values.data());
+    EncodedStrings out {py::array_t<int>(n), {}};
+    int * codes = out.codes.mutable_data();
+    // keys are views of the array items (or of the UTF-8 cache of str objects)
+    std::unordered_map<std::string_view, int> index;
+    for (size_t i=0; i < n; ++i) {
+      const char * item = data + static_cast<py::ssize_t>(i) * values.strides(0);
+      std::string_view key;
+      if ( kind == 'O' ) {
+        PyObject * obj = *reinterpret_cast<PyObject * const *>(item);
+        if ( ! PyUnicode_Check(obj) ) {
+          throw std::invalid_argument("Object arrays of strings may only contain str objects");
+        }
+        Py_ssize_t size;
+        const char * utf8 = PyUnicode_AsUTF8AndSize(obj, &size);
+        if ( utf8 == nullptr ) throw py::error_already_set();
+        key = std::string_view(utf8, size);
+      }
+      else {
+        // fixed-width items, zero-padded: equal strings have equal bytes
+        key = std::string_view(item, itemsize);
+      }
+      auto [it, inserted] = index.try_emplace(key, out.dictionary.size());
+      if ( inserted ) {
+        if ( kind == 'O' ) out.dictionary.emplace_back(key);
+        else out.dictionary.push_back(py::cast<std::string>(values.attr("__getitem__")(i)));
+      }
+      codes[i] = it->second;
+    }
+    // codes index into the dictionary without further checks
+    out.codes = py::cast<py::array_t<int>>(out.codes.attr("reshape")(array.attr("shape")));
+    out.codes.attr("setflags")(py::arg("write") = false);
+    return out;
+  }
+
+  // rows gathered at a time for arguments that cannot be used in place
+  constexpr size_t gather_block_size { 1024 };
+
+  struct BroadcastArg;
+  // copies rows [begin, begin + n) of the flattened broadcast array to the
+  // buffer, converted to the type of the input
+  typedef void (*GatherFcn)(const BroadcastArg& arg, const std::vector<py::ssize_t>& shape, size_t begin, size_t n, void * out);
+
+  // An array argument viewed with the (broadcast) output shape: strides are
+  // in bytes per output dimension, zero along broadcast dimensions.
+  struct BroadcastArg {
+    size_t pos;
+    py::array array;
+    Variable::VarType type;
+    const EncodedStrings * dictionary;
+    GatherFcn gather;
+    // whether the dtype is the one of the input, so that it can be read in place
+    bool same_type;
+    std::vector<py::ssize_t> strides;
+    // cached, to be used without holding the GIL
+    const void * data;
+    py::ssize_t itemsize;
+    // whether the elements are evenly spaced in flattened output order, so
+    // that the array can be used in place with a stride of `stride` elements
+    bool flat;
+    py::ssize_t stride;
+    // in jagged evaluation, for arrays with one value per list: the value of
+    // list i is used for rows offsets[i] - offsets[0] to offsets[i + 1] - offsets[0]
+    const int64_t * offsets {nullptr};
+    size_t nlists {0};
+    // for arguments given by name rather than position
+    std::string name {};
+  };
+
+  std::string describe(const BroadcastArg& arg) {
+    if ( ! arg.name.empty() ) return "input " + arg.name;
+    return "argument at position " + std::to_string(arg.pos);
+  }
+
+  std::vector<py::ssize_t> broadcast_shape(const std::vector<BroadcastArg>& vargs) {
+    std::vector<py::ssize_t> shape;
+    for (const auto& arg : vargs) {
+      size_t ndim = arg.array.ndim();
+      if ( ndim > shape.size() ) shape.insert(shape.begin(), ndim - shape.size(), 1);
+      for (size_t d=0; d < ndim; ++d) {
+        auto& out = shape[shape.size() - ndim + d];
+        py::ssize_t dim = arg.array.shape(d);
+        if ( out == 1 ) out = dim;
+        else if ( dim != 1 && dim != out ) {
+          throw std::invalid_argument("Array arguments cannot be broadcast together "
+              "(" + describe(arg) + " has dimension "
+              + std::to_string(d) + " of length " + std::to_string(dim) + ", expected "
+              + std::to_string(out) + ")");
+        }
+      }
+    }
+    return shape;
+  }
+
+  void set_strides(BroadcastArg& arg, const std::vector<py::ssize_t>& shape) {
+    size_t ndim = arg.array.ndim();
+    size_t offset = shape.size() - ndim;
+    arg.data = arg.array.data();
+    arg.itemsize = arg.array.itemsize();
+    arg.strides.assign(shape.size(), 0);
+    for (size_t d=0; d < ndim; ++d) {
+      if ( arg.array.shape(d) != 1 ) arg.strides[offset + d] = arg.array.strides(d);
+    }
+    // in flattened order, dimension d advances by the product of the inner lengths
+    std::optional<py::ssize_t> stride;
+    py::ssize_t inner {1};
+    arg.flat = true;
+    for (size_t d=shape.size(); d-- > 0; ) {
+      if ( shape[d] != 1 ) {
+        if ( ! stride ) stride = arg.strides[d];
+        arg.flat &= arg.strides[d] == *stride * inner;
+      }
+      inner *= shape[d];
+    }
+    arg.stride = stride.value_or(0) / arg.itemsize;
+    arg.flat &= arg.same_type && stride.value_or(0) % arg.itemsize == 0
+      && reinterpret_cast<uintptr_t>(arg.data) % arg.itemsize == 0;
+  }
+
+  template<typename V, typename S>
+  bool in_range(S value) {
+    if constexpr ( std::is_signed_v<S> ) {
+      return value >= std::numeric_limits<V>::min() && value <= std::numeric_limits<V>::max();
+    }
+    else {
+      return value <= static_cast<std::make_unsigned_t<V>>(std::numeric_limits<V>::max());
+    }
+  }
+
+  template<typename S, typename V>
+  V convert(const BroadcastArg& arg, const char * ptr, size_t element) {
+    S value;
+    std::memcpy(&value, ptr, sizeof(S));
+    if constexpr ( std::is_integral_v<V> && ! std::is_same_v<S, V> && ! std::is_same_v<S, bool> ) {
+      // integers beyond the range of the input are an error rather than wrapped
+      if ( ! in_range<V>(value) ) {
+        throw std::overflow_error("Integer input out of range (" + describe(arg)
+            + ", element " + std::to_string(element)
+            + " value: " + std::to_string(value) + ")");
+      }
+    }
+    return static_cast<V>(value);
+  }
+
+  template<typename S, typename V>
+  void gather(const BroadcastArg& arg, const std::vector<py::ssize_t>& shape, size_t begin, size_t n, void * buffer) {
+    V * out = static_cast<V*>(buffer);
+    const char * data = static_cast<const char*>(arg.data);
+    if ( arg.offsets != nullptr ) {
+      const int64_t * offsets = arg.offsets;
+      const int64_t first = offsets[0];
+      // last list starting at or before the first row, skipping empty lists after
+      size_t list = std::upper_bound(offsets, offsets + arg.nlists + 1, first + static_cast<int64_t>(begin)) - offsets - 1;
+      for (size_t i=0; i < n; ++i) {
+        while ( offsets[list + 1] - first <= static_cast<int64_t>(begin + i) ) ++list;
+        out[i] = convert<S, V>(arg, data + static_cast<py::ssize_t>(list) * arg.strides[0], list);
+      }
+      return;
+    }
+    const size_t ndim = shape.size();
+    std::vector<py::ssize_t> idx(ndim);
+    const char * ptr = data;
+    size_t row = begin;
+    for (size_t d=ndim; d-- > 0; ) {
+      idx[d] = row % shape[d];
+      row /= shape[d];
+      ptr += idx[d] * arg.strides[d];
+    }
+    for (size_t i=0; i < n; ++i) {
+      out[i] = convert<S, V>(arg, ptr, begin + i);
+      for (size_t d=ndim; d-- > 0; ) {
+        ptr += arg.strides[d];
+        if ( ++idx[d] < shape[d] ) break;
+        ptr -= arg.strides[d] * shape[d];
+        idx[d] = 0;
+      }
+    }
+  }
+
+  // Conversion from the numpy dtype to the input type V, or nullptr if the
+  // dtype is not read natively. Only lossless conversions are supported
+  // (narrowing integers being range-checked).
+  template<typename V>
+  GatherFcn gather_from(const py::dtype& dtype) {
+    if ( ! dtype.attr("isnative").cast<bool>() ) return nullptr;
+    const auto size = dtype.itemsize();
+    switch ( dtype.kind() ) {
+      case 'b': return gather<bool, V>;
+      case 'i':
+        if ( size == 1 ) return gather<int8_t, V>;
+        if ( size == 2 ) return gather<int16_t, V>;
+        if ( size == 4 ) return gather<int32_t, V>;
+        if ( size == 8 ) return gather<int64_t, V>;
+        break;
+      case 'u':
+        if ( size == 1 ) return gather<uint8_t, V>;
+        if ( size == 2 ) return gather<uint16_t, V>;
+        if ( size == 4 ) return gather<uint32_t, V>;
+        if ( size == 8 ) return gather<uint64_t, V>;
+        break;
+      case 'f':
+        if ( std::is_integral_v<V> ) break;
+        if ( size == 4 ) return gather<float, V>;
+        if ( size == 8 ) return gather<double, V>;
+        break;
+    }
+    return nullptr;
+  }
+
+  // numpy arrays are read in their own dtype where possible, otherwise converted
+  template<typename V>
+  BroadcastArg numeric_arg(size_t pos, Variable::VarType type, const py::handle& arg) {
+    auto array = py::reinterpret_borrow<py::array>(arg);
+    GatherFcn fcn = gather_from<V>(array.dtype());
+    if ( fcn == nullptr ) {
+      array = py::cast<py::array_t<V, py::array::forcecast>>(arg);
+      fcn = gather<V, V>;
+    }
+    return {pos, array, type, nullptr, fcn, fcn == gather<V, V>};
+  }
+
+  Column array_column(const BroadcastArg& arg, const void * data, py::ssize_t stride) {
+    if ( arg.dictionary != nullptr ) {
+      return Column(static_cast<const int*>(data), arg.dictionary->dictionary.data(), arg.dictionary->dictionary.size(), stride);
+    }
+    else if ( arg.type == Variable::VarType::integer ) {
+      return Column(static_cast<const int*>(data), stride);
+    }
+    return Column(static_cast<const double*>(data), stride);
+  }
+
+  bool is_array_arg(const py::handle& arg) {
+    return py::isinstance<EncodedStrings>(arg) || py::isinstance<py::array>(arg);
+  }
+
+  // An array or encoded strings argument for an input of the given type,
+  // restricted to `rows` if given. Arrays of strings are encoded into
+  // `encoded`, which must have enough capacity not to reallocate.
+  BroadcastArg array_arg(size_t pos, const std::string& name, Variable::VarType type, const py::object& arg,
+      const std::optional<py::slice>& rows, std::vector<EncodedStrings>& encoded) {
+    BroadcastArg out;
+    if ( type == Variable::VarType::string ) {
+      const EncodedStrings * dictionary;
+      py::array codes;
+      if ( py::isinstance<EncodedStrings>(arg) ) {
+        dictionary = &py::cast<const EncodedStrings&>(arg);
+        codes = dictionary->codes;
+        if ( rows ) codes = py::cast<py::array>(codes[*rows]);
+      }
+      else {
+        encoded.push_back(encode_strings(py::cast<py::array>(arg)));
+        dictionary = &encoded.back();
+        codes = dictionary->codes;
+      }
+      out = {pos, codes, Variable::VarType::string, dictionary, gather<int, int>, true};
+    }
+    else if ( py::isinstance<EncodedStrings>(arg) ) {
+      out.pos = pos;
+      out.name = name;
+      throw std::invalid_argument("Encoded strings given for non-string " + describe(out));
+    }
+    else if ( type == Variable::VarType::integer ) {
+      out = numeric_arg<int>(pos, Variable::VarType::integer, arg);
+    }
+    else if ( type == Variable::VarType::real ) {
+      out = numeric_arg<double>(pos, Variable::VarType::real, arg);
+    }
+    else {
+      throw std::logic_error("Invalid variable type");
+    }
+    out.name = name;
+    return out;
+  }
+
+  // stands in for array arguments among the scalar inputs
+  Variable::Type placeholder(Variable::VarType type) {
+    switch ( type ) {
+      case Variable::VarType::string: return std::string();
+      case Variable::VarType::integer: return 0;
+      case Variable::VarType::real: return 0.0;
+    }
+    throw std::logic_error("Invalid variable type");
+  }
+
+  // how outputs are stored into an existing array
+  enum class Accumulate {none, add, multiply};
+
+  Accumulate parse_accumulate(const std::optional<std::string>& op) {
+    if ( ! op ) return Accumulate::none;
+    if ( *op == "add" ) return Accumulate::add;
+    if ( *op == "multiply" ) return Accumulate::multiply;
+    throw std::invalid_argument("Unknown op '" + *op + "', expected 'add' or 'multiply'");
+  }
+
+  // The array the result of evaluate_arrays is written to, for the given
+  // output shape: a float64 array, or the content of a jagged array
+  py::array_t<double> output_array(const py::object& out, const std::vector<py::ssize_t>& shape, const std::vector<BroadcastArg>& vargs) {
+    py::object array = out;
+    if ( py::isinstance<JaggedArray>(out) ) array = py::cast<const JaggedArray&>(out).content;
+    if ( ! py::isinstance<py::array_t<double>>(array) ) {
+      throw std::invalid_argument("out must be a float64 array");
+    }
+    auto output = py::reinterpret_borrow<py::array_t<double>>(array);
+    if ( ! output.writeable() || ! (output.flags() & py::array::c_style) ) {
+      throw std::invalid_argument("out must be a writeable C-contiguous array");
+    }
+    if ( static_cast<size_t>(output.ndim()) != shape.size() || ! std::equal(shape.begin(), shape.end(), output.shape()) ) {
+      throw std::invalid_argument("out has shape " + py::str(array.attr("shape")).cast<std::string>()
+          + ", expected " + py::str(py::cast(shape)).cast<std::string>());
+    }
+    // rows of an input may be read after earlier rows of out are written
+    auto may_share_memory = py::module_::import("numpy").attr("may_share_memory");
+    for (const auto& arg : vargs) {
+      if ( py::cast<bool>(may_share_memory(output, arg.array)) ) {
+        throw std::invalid_argument("out overlaps the " + describe(arg));
+      }
+    }
+    return output;
+  }
+
+  // The rows selected by `where` for an output of the given shape: a boolean
+  // mask broadcast to the shape, or an array of indices into the flattened
+  // output. For jagged outputs, either may be given as a jagged array.
+  py::array_t<bool> selection(const py::object& where, const std::vector<py::ssize_t>& shape, size_t n) {
+    py::object array = where;
+    if ( py::isinstance<JaggedArray>(where) ) array = py::cast<const JaggedArray&>(where).content;
+    auto numpy = py::module_::import("numpy");
+    auto values = py::cast<py::array>(numpy.attr("asarray")(array));
+    const char kind = values.dtype().kind();
+    if ( kind == 'b' ) {
+      return py::cast<py::array_t<bool>>(numpy.attr("ascontiguousarray")(numpy.attr("broadcast_to")(values, py::cast(shape))));
+    }
+    else if ( kind != 'i' && kind != 'u' ) {
+      throw std::invalid_argument("where must be a boolean mask or an array of indices");
+    }
+    auto indices = py::cast<py::array_t<int64_t, py::array::forcecast>>(values);
+    if ( indices.ndim() != 1 ) {
+      throw std::invalid_argument("An array of indices for where must be one-dimensional");
+    }
+    py::array_t<bool> mask(static_cast<py::ssize_t>(n));
+    bool * data = mask.mutable_data();
+    std::fill(data, data + n, false);
+    const int64_t nrows = static_cast<int64_t>(n);
+    for (py::ssize_t i=0; i < indices.size(); ++i) {
+      int64_t row = indices.at(i);
+      if ( row < 0 ) row += nrows;
+      if ( row < 0 || row >= nrows ) {
+        throw py::index_error("Index " + std::to_string(indices.at(i)) + " in where is out of range for " + std::to_string(n) + " rows");
+      }
+      data[row] = true;
+    }
+    return mask;
+  }
+
+  // Where the outputs of evaluate_arrays go: a new array, or `out` if given,
+  // whose values are replaced or combined with them by op. With a selection
+  // `where`, only the selected rows are evaluated, the others keep the values
+  // of `out`, or get `fill` in a new array.
+  struct OutputOptions {
+    py::object out = py::none();
+    Accumulate op {Accumulate::none};
+    py::object where = py::none();
+    double fill {0.};
+  };
+
+  // Evaluates the correction on the broadcast arguments with
+  // evaluate(columns, out, status, select, n), which writes `width` outputs
+  // per row if given, as an extra innermost dimension of the result. If
+  // with_status, the result is a tuple of the outputs and of the status of
+  // each output, otherwise status is null. select is null unless options
+  // select rows, see OutputOptions.
+  template<typename T, typename F>
+  py::object evaluate_arrays(const T& c, const py::tuple& args, size_t nthreads, std::optional<size_t> width, bool with_status,
+      const OutputOptions& options, F&& evaluate) {
+    const auto& out = options.out;
+    const Accumulate op = options.op;
+    if ( op != Accumulate::none && out.is_none() ) {
+      throw std::invalid_argument("An op requires an out array to accumulate into");
+    }
+    if ( nthreads == 0 ) {
+      nthreads = std::max(1u, std::thread::hardware_concurrency());
+    }
     std::vector<Variable::Type> inputs;
     inputs.reserve(py::len(args));
-    std::vector<std::pair<size_t, py::buffer_info>> vargs;
+    std::vector<BroadcastArg> vargs;
+    std::vector<EncodedStrings> encoded;
+    encoded.reserve(py::len(args));
     if ( py::len(args) != c.inputs().size() ) {
       throw std::invalid_argument("Incorrect number of inputs (got " + std::to_string(py::len(args))
           + ", expected " + std::to_string(c.inputs().size()) + ")");
     }
+    // jagged arguments must share the list lengths, and their content is
+    // evaluated with the values of the other array arguments for each list
+    const JaggedArray * layout {nullptr};
+    std::vector<bool> per_object(py::len(args), false);
     for (size_t i=0; i < py::len(args); ++i) {
-      if ( py::isinstance<py::array>(args[i]) ) {
-        if ( c.inputs()[i].type() == Variable::VarType::integer ) {
-          vargs.emplace_back(i, py::cast<py::array_t<int, py::array::c_style | py::array::forcecast>>(args[i]).request());
-          inputs.emplace_back(0);
+      py::object arg = args[i];
+      std::optional<py::slice> rows;
+      if ( py::isinstance<JaggedArray>(arg) ) {
+        const auto& jagged = py::cast<const JaggedArray&>(arg);
+        if ( layout == nullptr ) {
+          layout = &jagged;
+        }
+        else if ( ! same_layout(*layout, jagged) ) {
+          throw std::invalid_argument("Jagged arguments must all have the same list lengths "
+              "(argument at position " + std::to_string(i) + ")");
+        }
+        const int64_t * offsets = jagged.offsets.data();
+        rows = py::slice(offsets[0], offsets[jagged.offsets.size() - 1], 1);
+        arg = jagged.content;
+        if ( py::isinstance<py::array>(arg) ) arg = arg[*rows];
+        per_object[i] = true;
+      }
+      if ( is_array_arg(arg) ) {
+        vargs.push_back(array_arg(i, {}, c.inputs()[i].type(), arg, rows, encoded));
+        inputs.push_back(placeholder(c.inputs()[i].type()));
+      }
+      else {
+        inputs.push_back(py::cast<Variable::Type>(arg));
+      }
+    }
+    // without array arguments, a single evaluation
+    std::vector<py::ssize_t> shape;
+    if ( ! width ) shape = {1};
+    if ( layout != nullptr ) {
+      const int64_t * offsets = layout->offsets.data();
+      const size_t nlists = layout->offsets.size() - 1;
+      shape = {offsets[nlists] - offsets[0]};
+      for (auto& arg : vargs) {
+        if ( per_object[arg.pos] ) {
+          set_strides(arg, shape);
+          continue;
         }
-        else if ( c.inputs()[i].type() == Variable::VarType::real ) {
-          vargs.emplace_back(i, py::cast<py::array_t<double, py::array::c_style | py::array::forcecast>>(args[i]).request());
-          inputs.emplace_back(0.0);
+        if ( arg.array.ndim() > 1 || (arg.array.ndim() == 1 && arg.array.shape(0) != 1
+              && static_cast<size_t>(arg.array.shape(0)) != nlists) ) {
+          throw std::invalid_argument("Array arguments must have one value per list in jagged evaluation "
+              "(argument at position " + std::to_string(arg.pos) + ")");
         }
-        else {
-          throw std::invalid_argument("Array arguments only allowed for integer and real input types");
+        set_strides(arg, {static_cast<py::ssize_t>(nlists)});
+        if ( ! (arg.flat && arg.stride == 0) ) {
+          arg.flat = false;
+          arg.offsets = offsets;
+          arg.nlists = nlists;
         }
-
-        if ( vargs.back().second.ndim != 1 ) {
-          throw std::invalid_argument("Array arguments with dimension greater "
-              "than one are not supported (argument at position " + std::to_string(i) + ")");
+      }
+    }
+    else if ( vargs.size() > 0 ) {
+      shape = broadcast_shape(vargs);
+      for (auto& arg : vargs) set_strides(arg, shape);
+    }
+    size_t n {1};
+    for (auto dim : shape) n *= dim;
+    const size_t stride = width.value_or(1);
+    auto output_shape = shape;
+    if ( width ) output_shape.push_back(*width);
+    auto output = out.is_none() ? py::array_t<double>(output_shape) : output_array(out, output_shape, vargs);
+    double * outptr = output.mutable_data();
+    py::array_t<uint8_t> status;
+    Status * statusptr {nullptr};
+    if ( with_status ) {
+      status = py::array_t<uint8_t>(output_shape);
+      statusptr = reinterpret_cast<Status*>(status.mutable_data());
+    }
+    // the status of the rows from `begin`, if any
+    auto status_at = [statusptr, stride](size_t begin) { return statusptr != nullptr ? statusptr + begin * stride : nullptr; };
+    py::array_t<bool> select;
+    const bool * selectptr {nullptr};
+    if ( ! options.where.is_none() ) {
+      select = selection(options.where, shape, n);
+      selectptr = select.data();
+    }
+    auto select_at = [selectptr](size_t begin) { return selectptr != nullptr ? selectptr + begin : nullptr; };
+    // the arrays are kept alive by vargs and the scalars by inputs, so the
+    // columns can be evaluated without touching any python object
+    std::vector<Column> columns;
+    columns.reserve(inputs.size());
+    for (const auto& input : inputs) {
+      columns.push_back(Column::scalar(input));
+    }
+    std::vector<const BroadcastArg*> gathered;
+    for (const auto& arg : vargs) {
+      if ( arg.flat ) columns[arg.pos] = array_column(arg, arg.data, arg.stride);
+      else gathered.push_back(&arg);
+    }
+    // gathered columns keep the type of their placeholder, so the types
+    // checked here hold for every block
+    c.validate(columns);
+    {
+      py::gil_scoped_release release;
+      parallel_chunks(n, nthreads, [&](size_t begin, size_t end) {
+        if ( selectptr != nullptr && out.is_none() ) {
+          for (size_t i=begin; i < end; ++i) {
+            if ( ! selectptr[i] ) std::fill(outptr + i * stride, outptr + (i + 1) * stride, options.fill);
+          }
+        }
+        std::vector<Column> chunk;
+        chunk.reserve(columns.size());
+        if ( gathered.size() == 0 && op == Accumulate::none ) {
+          for (const auto& column : columns) chunk.push_back(column.slice(begin));
+          evaluate(chunk, outptr + begin * stride, status_at(begin), select_at(begin), end - begin);
+          return;
         }
-        if ( vargs.back().second.size != vargs.front().second.size ) {
-          throw std::invalid_argument("Array arguments must all have the same size"
-              "(argument at position " + std::to_string(i) + " is length "
-              + std::to_string(vargs.back().second.size) + ")");
+        // 8-byte slots fit both int and double values
+        std::vector<std::vector<double>> buffers(gathered.size(), std::vector<double>(gather_block_size));
+        // accumulated outputs are evaluated a block at a time, then combined
+        // while the block is still in cache
+        std::vector<double> block(op == Accumulate::none ? 0 : gather_block_size * stride);
+        for (size_t pos=begin; pos < end; pos += gather_block_size) {
+          size_t nblock = std::min(gather_block_size, end - pos);
+          chunk.clear();
+          for (const auto& column : columns) chunk.push_back(column.slice(pos));
+          for (size_t k=0; k < gathered.size(); ++k) {
+            const auto& arg = *gathered[k];
+            arg.gather(arg, shape, pos, nblock, buffers[k].data());
+            chunk[arg.pos] = array_column(arg, buffers[k].data(), 1);
+          }
+          double * dest = outptr + pos * stride;
+          const bool * bselect = select_at(pos);
+          if ( op == Accumulate::none ) {
+            evaluate(chunk, dest, status_at(pos), bselect, nblock);
+            continue;
+          }
+          evaluate(chunk, block.data(), status_at(pos), bselect, nblock);
+          for (size_t i=0; i < nblock * stride; ++i) {
+            if ( bselect != nullptr && ! bselect[i / stride] ) continue;
+            if ( op == Accumulate::add ) dest[i] += block[i];
+            else dest[i] *= block[i];
+          }
         }
+      });
+    }
+    if ( layout != nullptr ) {
+      auto offsets = layout->offsets;
+      if ( offsets.at(0) != 0 ) {
+        offsets = py::array_t<int64_t>(offsets.size());
+        int64_t * data = offsets.mutable_data();
+        for (py::ssize_t i=0; i < offsets.size(); ++i) data[i] = layout->offsets.at(i) - layout->offsets.at(0);
+        offsets.attr("setflags")(py::arg("write") = false);
+      }
+      if ( with_status ) {
+        return py::make_tuple(JaggedArray{offsets, output}, JaggedArray{offsets, status});
+      }
+      return py::cast(JaggedArray{offsets, output});
+    }
+    if ( with_status ) return py::make_tuple(output, status);
+    return output;
+  }
+
+  template<typename T>
+  py::object evalv(const T& c, py::args args, size_t nthreads, const py::object& out, const std::optional<std::string>& op,
+      const py::object& where, double fill) {
+    OutputOptions options {out, parse_accumulate(op), where, fill};
+    return evaluate_arrays(c, args, nthreads, std::nullopt, false, options, [&c](const std::vector<Column>& columns, double * out, Status *, const bool * select, size_t n) {
+      if ( select != nullptr ) c.evaluate_batch_unchecked(columns, out, select, n);
+      else c.evaluate_batch_unchecked(columns, out, n);
+    });
+  }
+
+  // as evalv, returning the outputs and their status, lookup errors giving
+  // the fill value instead of raising
+  template<typename T>
+  py::object evalv_status(const T& c, py::args args, double fill, size_t nthreads) {
+    return evaluate_arrays(c, args, nthreads, std::nullopt, true, {}, [&c, fill](const std::vector<Column>& columns, double * out, Status * status, const bool *, size_t n) {
+      c.evaluate_batch_unchecked(columns, out, status, fill, n);
+    });
+  }
+
+  // The arguments are the other inputs, in order. The result has one more
+  // dimension than the broadcast arguments, of one output per value.
+  py::object evaluate_variations(const Correction& c, const std::string& input, const std::vector<Variable::Type>& values, py::args args, size_t nthreads) {
+    const size_t idx = c.input_index(input);
+    if ( args.size() + 1 != c.inputs().size() ) {
+      throw std::invalid_argument("Incorrect number of inputs (got " + std::to_string(args.size())
+          + ", expected " + std::to_string(c.inputs().size() - 1) + " besides " + input + ")");
+    }
+    // the column of the input is not read, any value of its type stands in
+    py::list full(args);
+    full.insert(idx, py::cast(placeholder(c.inputs()[idx].type())));
+    return evaluate_arrays(c, py::tuple(full), nthreads, values.size(), false, {}, [&](const std::vector<Column>& columns, double * out, Status *, const bool *, size_t n) {
+      c.evaluate_variations(columns, idx, values, out, n);
+    });
+  }
+
+  // Evaluates several corrections of a set on inputs given by name. Each
+  // distinct input is converted and validated once, and the rows are
+  // evaluated in a single pass, block by block, for all corrections.
+  py::dict evaluate_many(const CorrectionSet& cset, const std::vector<std::string>& names, const py::dict& values, size_t nthreads) {
+    if ( nthreads == 0 ) {
+      nthreads = std::max(1u, std::thread::hardware_concurrency());
+    }
+    typedef std::variant<Correction::Ref, CompoundCorrection::Ref> Target;
+    std::vector<Target> targets;
+    targets.reserve(names.size());
+    for (const auto& name : names) {
+      if ( cset.contains(name) ) {
+        targets.emplace_back(cset.at(name));
+      }
+      else if ( auto cit = cset.compound().find(name); cit != cset.compound().end() ) {
+        targets.emplace_back(cit->second);
+      }
+      else {
+        throw py::key_error("No correction named " + name);
+      }
+    }
+    // the distinct inputs, which corrections may share if they agree on the type
+    std::vector<const Variable*> variables;
+    std::vector<std::vector<size_t>> slots(targets.size());
+    for (size_t k=0; k < targets.size(); ++k) {
+      const auto& inputs = std::visit([](const auto& c) -> const std::vector<Variable>& { return c->inputs(); }, targets[k]);
+      for (const auto& var : inputs) {
+        auto it = std::find_if(variables.begin(), variables.end(), [&var](const Variable * other) {
+            return other->name() == var.name() && other->type() == var.type();
+        });
+        slots[k].push_back(it - variables.begin());
+        if ( it == variables.end() ) variables.push_back(&var);
+      }
+    }
+    std::vector<Variable::Type> inputs;
+    inputs.reserve(variables.size());
+    std::vector<BroadcastArg> vargs;
+    std::vector<EncodedStrings> encoded;
+    encoded.reserve(variables.size());
+    for (size_t i=0; i < variables.size(); ++i) {
+      const auto& var = *variables[i];
+      if ( ! values.contains(var.name()) ) {
+        throw py::key_error("Missing value for input " + var.name());
+      }
+      py::object arg = values[py::str(var.name())];
+      if ( is_array_arg(arg) ) {
+        vargs.push_back(array_arg(i, var.name(), var.type(), arg, std::nullopt, encoded));
+        inputs.push_back(placeholder(var.type()));
       }
       else {
-        inputs.push_back(py::cast<Variable::Type>(args[i]));
+        inputs.push_back(py::cast<Variable::Type>(arg));
+        var.validate(inputs.back());
       }
     }
-    auto output = py::array_t<double>((vargs.size() > 0) ? vargs.front().second.size : 1);
-    py::buffer_info outbuffer = output.request();
-    double * outptr = static_cast<double*>(outbuffer.ptr);
-    for (size_t i=0; i < outbuffer.shape[0]; ++i) {
-      for (const auto& varg : vargs) {
-        if ( std::holds_alternative<int>(inputs[varg.first]) ) {
-          inputs[varg.first] = static_cast<int*>(varg.second.ptr)[i];
+    // without array arguments, a single evaluation of each correction, of
+    // shape (1,) as in evalv
+    std::vector<py::ssize_t> shape {1};
+    if ( vargs.size() > 0 ) shape = broadcast_shape(vargs);
+    for (auto& arg : vargs) set_strides(arg, shape);
+    size_t n {1};
+    for (auto dim : shape) n *= dim;
+    std::vector<py::array_t<double>> outputs;
+    std::vector<double*> outptrs;
+    for (size_t k=0; k < targets.size(); ++k) {
+      outputs.emplace_back(shape);
+      outptrs.push_back(outputs.back().mutable_data());
+    }
+    std::vector<Column> columns;
+    columns.reserve(inputs.size());
+    for (const auto& input : inputs) {
+      columns.push_back(Column::scalar(input));
+    }
+    std::vector<const BroadcastArg*> gathered;
+    for (const auto& arg : vargs) {
+      if ( arg.flat ) columns[arg.pos] = array_column(arg, arg.data, arg.stride);
+      else gathered.push_back(&arg);
+    }
+    for (size_t k=0; k < targets.size(); ++k) {
+      std::vector<Column> chunk;
+      for (size_t slot : slots[k]) chunk.push_back(columns[slot]);
+      std::visit([&chunk](const auto& c) { c->validate(chunk); }, targets[k]);
+    }
+    {
+      py::gil_scoped_release release;
+      parallel_chunks(n, nthreads, [&](size_t begin, size_t end) {
+        std::vector<Column> block;
+        std::vector<Column> chunk;
+        // 8-byte slots fit both int and double values
+        std::vector<std::vector<double>> buffers(gathered.size(), std::vector<double>(gather_block_size));
+        for (size_t pos=begin; pos < end; pos += gather_block_size) {
+          size_t nblock = std::min(gather_block_size, end - pos);
+          block.clear();
+          for (const auto& column : columns) block.push_back(column.slice(pos));
+          for (size_t j=0; j < gathered.size(); ++j) {
+            const auto& arg = *gathered[j];
+            arg.gather(arg, shape, pos, nblock, buffers[j].data());
+            block[arg.pos] = array_column(arg, buffers[j].data(), 1);
+          }
+          for (size_t k=0; k < targets.size(); ++k) {
+            chunk.clear();
+            for (size_t slot : slots[k]) chunk.push_back(block[slot]);
+            std::visit([&](const auto& c) { c->evaluate_batch_unchecked(chunk, outptrs[k] + pos, nblock); }, targets[k]);
+          }
+        }
+      });
+    }
+    py::dict out;
+    for (size_t k=0; k < targets.size(); ++k) {
+      out[py::str(names[k])] = outputs[k];
+    }
+    return out;
+  }
+
+  // Everything the ufunc refers to, owned by the ufunc
+  template<typename T>
+  struct UFuncData {
+    // the python object of the correction, which keeps it alive
+    py::object owner;
+    const T * correction;
+    std::string name;
+    std::string doc;
+    std::vector<PyUFuncGenericFunction> functions;
+    std::vector<void*> data;
+    std::vector<char> types;
+  };
+
+  // Loops may run without the GIL and must not throw into numpy, so errors
+  // are raised by setting the python error indicator, which numpy checks
+  // once the loop is done. Only the first error is kept. The exception types
+  // are translated as pybind11 does.
+  void set_python_error(const std::exception& ex) {
+    PyGILState_STATE state = PyGILState_Ensure();
+    if ( ! PyErr_Occurred() ) {
+      PyObject * type = PyExc_RuntimeError;
+      if ( dynamic_cast<const std::overflow_error*>(&ex) ) type = PyExc_OverflowError;
+      else if ( dynamic_cast<const std::out_of_range*>(&ex) ) type = PyExc_IndexError;
+      else if ( dynamic_cast<const std::invalid_argument*>(&ex) ) type = PyExc_ValueError;
+      PyErr_SetString(type, ex.what());
+    }
+    PyGILState_Release(state);
+  }
+
+  // Inner loop over n rows. Integer inputs arrive as I, either int (used in
+  // place) or int64 (narrowed with a range check); string inputs arrive as
+  // python objects, for which numpy holds the GIL.
+  template<typename T, typename I>
+  void ufunc_loop(char ** args, const npy_intp * dimensions, const npy_intp * steps, void * data) {
+    const auto& ufunc = *static_cast<const UFuncData<T>*>(data);
+    const auto& inputs = ufunc.correction->inputs();
+    const size_t n = dimensions[0];
+    const size_t nin = inputs.size();
+    try {
+      std::vector<Column> columns(nin, Column(static_cast<const int*>(nullptr), 0));
+      std::vector<std::vector<int>> codes(nin);
+      std::vector<std::vector<std::string>> dictionaries(nin);
+      std::vector<double> output;
+      const bool out_in_place = steps[nin] == sizeof(double);
+      if ( ! out_in_place ) output.resize(gather_block_size);
+      for (size_t pos=0; pos < n; pos += gather_block_size) {
+        size_t nblock = std::min(gather_block_size, n - pos);
+        for (size_t k=0; k < nin; ++k) {
+          const char * ptr = args[k] + pos * steps[k];
+          const py::ssize_t step = steps[k];
+          switch ( inputs[k].type() ) {
+            case Variable::VarType::real:
+              if ( step % sizeof(double) == 0 ) {
+                columns[k] = Column(reinterpret_cast<const double*>(ptr), step / static_cast<py::ssize_t>(sizeof(double)));
+                continue;
+              }
+              throw std::runtime_error("Unsupported stride for ufunc input " + inputs[k].name());
+            case Variable::VarType::integer:
+              if ( std::is_same_v<I, int> && step % sizeof(int) == 0 ) {
+                columns[k] = Column(reinterpret_cast<const int*>(ptr), step / static_cast<py::ssize_t>(sizeof(int)));
+                continue;
+              }
+              codes[k].resize(nblock);
+              for (size_t i=0; i < nblock; ++i) {
+                I value;
+                std::memcpy(&value, ptr + i * step, sizeof(I));
+                if ( ! in_range<int>(value) ) {
+                  throw std::overflow_error("Integer input out of range (input " + inputs[k].name()
+                      + ", element " + std::to_string(pos + i) + " value: " + std::to_string(value) + ")");
+                }
+                codes[k][i] = static_cast<int>(value);
+              }
+              columns[k] = Column(codes[k].data());
+              continue;
+            case Variable::VarType::string:
+              {
+                // encoded per block, so each distinct string is looked up once
+                auto& dictionary = dictionaries[k];
+                dictionary.clear();
+                codes[k].resize(nblock);
+                std::unordered_map<std::string_view, int> index;
+                for (size_t i=0; i < nblock; ++i) {
+                  PyObject * item;
+                  std::memcpy(&item, ptr + i * step, sizeof(PyObject*));
+                  Py_ssize_t size;
+                  const char * str = PyUnicode_Check(item) ? PyUnicode_AsUTF8AndSize(item, &size) : nullptr;
+                  if ( str == nullptr ) {
+                    PyErr_Clear();
+                    throw std::invalid_argument("Expected a string for ufunc input " + inputs[k].name());
+                  }
+                  auto [it, inserted] = index.try_emplace(std::string_view(str, size), static_cast<int>(dictionary.size()));
+                  if ( inserted ) dictionary.emplace_back(str, size);
+                  codes[k][i] = it->second;
+                }
+                columns[k] = Column(codes[k].data(), dictionary.data(), dictionary.size());
+              }
+              continue;
+          }
         }
-        else if ( std::holds_alternative<double>(inputs[varg.first]) ) {
-          inputs[varg.first] = static_cast<double*>(varg.second.ptr)[i];
+        // the loop signature follows the input types, so the columns need no checks
+        char * out = args[nin] + pos * steps[nin];
+        if ( out_in_place ) {
+          ufunc.correction->evaluate_batch_unchecked(columns, reinterpret_cast<double*>(out), nblock);
+          continue;
+        }
+        ufunc.correction->evaluate_batch_unchecked(columns, output.data(), nblock);
+        for (size_t i=0; i < nblock; ++i) {
+          std::memcpy(out + i * steps[nin], &output[i], sizeof(double));
         }
       }
-      outptr[i] = c.evaluate(inputs);
+    } catch (std::exception& ex) {
+      set_python_error(ex);
     }
-    return output;
+    // numpy warns about the floating point status flags left set by the
+    // loop, which evalv and evaluate do not do, e.g. for log(x) at x < 0
+    PyUFunc_clearfperr();
+  }
+
+  // A numpy ufunc evaluating the correction, with one input per correction
+  // input and a float64 output. Real inputs take float64, integer inputs
+  // int32 or int64, and string inputs python objects.
+  //
+  // The data its loops refer to is held by a capsule in the obj slot of the
+  // ufunc, which numpy releases with the ufunc, as frompyfunc does.
+  template<typename T>
+  py::object make_ufunc(py::object self) {
+    auto c = self.cast<std::shared_ptr<const T>>();
+    auto storage = std::make_unique<UFuncData<T>>();
+    storage->owner = self;
+    storage->correction = c.get();
+    storage->name = c->name();
+    storage->doc = c->description();
+    const auto& inputs = c->inputs();
+    auto has_type = [&inputs](Variable::VarType type) {
+      return std::any_of(inputs.begin(), inputs.end(), [type](const Variable& var) { return var.type() == type; });
+    };
+    // numpy takes the first loop all arguments can be safely cast to, so an
+    // int32 loop is tried first to use such arrays in place. It is left out
+    // when there are string inputs, since numpy only casts str arrays to
+    // object for ufuncs with a single loop.
+    const bool narrow = has_type(Variable::VarType::integer) && ! has_type(Variable::VarType::string);
+    for (bool wide : {false, true}) {
+      if ( ! wide && ! narrow ) continue;
+      storage->functions.push_back(wide ? ufunc_loop<T, int64_t> : ufunc_loop<T, int>);
+      storage->data.push_back(storage.get());
+      for (const auto& var : inputs) {
+        switch ( var.type() ) {
+          case Variable::VarType::string: storage->types.push_back(NPY_OBJECT); break;
+          case Variable::VarType::integer: storage->types.push_back(wide ? NPY_LONGLONG : NPY_INT); break;
+          case Variable::VarType::real: storage->types.push_back(NPY_DOUBLE); break;
+        }
+      }
+      storage->types.push_back(NPY_DOUBLE);
+    }
+    PyObject * ufunc = PyUFunc_FromFuncAndData(
+        storage->functions.data(), storage->data.data(), storage->types.data(),
+        static_cast<int>(storage->functions.size()), static_cast<int>(inputs.size()), 1,
+        PyUFunc_None, storage->name.c_str(), storage->doc.c_str(), 0
+      );
+    if ( ufunc == nullptr ) throw py::error_already_set();
+    auto result = py::reinterpret_steal<py::object>(ufunc);
+    auto owner = py::capsule(storage.release(), [](void * ptr) { delete static_cast<UFuncData<T>*>(ptr); });
+    reinterpret_cast<PyUFuncObject*>(ufunc)->obj = owner.release().ptr();
+    return result;
+  }
+
+  // Everything a scalar evaluator refers to, owned by its self capsule
+  template<typename T>
+  struct ScalarEvaluator {
+    std::shared_ptr<const T> correction;
+    std::vector<Variable::VarType> signature;
+    std::string name;
+    PyMethodDef def;
+  };
+
+  constexpr const char * scalar_evaluator_capsule { "correctionlib.ScalarEvaluator" };
+
+  PyObject * scalar_type_error(const std::string& msg) {
+    PyErr_SetString(PyExc_TypeError, msg.c_str());
+    return nullptr;
+  }
+
+  // Converts each argument according to the type of its input, straight from
+  // the python object into values reused by the calls on this thread. Raises
+  // TypeError if the arguments are not python scalars of the input types, so
+  // the caller falls back to the generic evaluate, which converts or rejects
+  // them with the usual errors.
+  template<typename T>
+  PyObject * evaluate_scalar(PyObject * self, PyObject * const * args, Py_ssize_t nargs) {
+    const auto& evaluator = *static_cast<const ScalarEvaluator<T>*>(PyCapsule_GetPointer(self, scalar_evaluator_capsule));
+    const auto& signature = evaluator.signature;
+    const auto& inputs = evaluator.correction->inputs();
+    if ( static_cast<size_t>(nargs) != signature.size() ) {
+      return scalar_type_error("Expected " + std::to_string(signature.size()) + " arguments, got " + std::to_string(nargs));
+    }
+    thread_local std::vector<Variable::Type> values;
+    values.resize(signature.size());
+    for (size_t i=0; i < signature.size(); ++i) {
+      PyObject * arg = args[i];
+      switch ( signature[i] ) {
+        case Variable::VarType::real:
+          if ( ! PyFloat_Check(arg) ) return scalar_type_error("Expected a float for input " + inputs[i].name());
+          values[i] = PyFloat_AS_DOUBLE(arg);
+          break;
+        case Variable::VarType::integer:
+          {
+            if ( ! PyLong_Check(arg) ) return scalar_type_error("Expected an int for input " + inputs[i].name());
+            int overflow;
+            long value = PyLong_AsLongAndOverflow(arg, &overflow);
+            if ( overflow != 0 || ! in_range<int>(value) ) {
+              return scalar_type_error("Integer out of range for input " + inputs[i].name());
+            }
+            values[i] = static_cast<int>(value);
+          }
+          break;
+        case Variable::VarType::string:
+          {
+            Py_ssize_t size;
+            const char * str = PyUnicode_Check(arg) ? PyUnicode_AsUTF8AndSize(arg, &size) : nullptr;
+            if ( str == nullptr ) {
+              PyErr_Clear();
+              return scalar_type_error("Expected a str for input " + inputs[i].name());
+            }
+            // assigning in place reuses the storage of the previous call
+            if ( auto * current = std::get_if<std::string>(&values[i]) ) current->assign(str, size);
+            else values[i].emplace<std::string>(str, size);
+          }
+          break;
+      }
+    }
+    try {
+      // the signature was checked above
+      return PyFloat_FromDouble(evaluator.correction->evaluate_unchecked(values));
+    } catch (std::exception& ex) {
+      set_python_error(ex);
+      return nullptr;
+    }
+  }
+
+#if PY_VERSION_HEX < 0x03070000
+  template<typename T>
+  PyObject * evaluate_scalar_tuple(PyObject * self, PyObject * args) {
+    return evaluate_scalar<T>(self, &PyTuple_GET_ITEM(args, 0), PyTuple_GET_SIZE(args));
+  }
+#endif
+
+  // A builtin function evaluating the correction on python scalars, called
+  // with the vectorcall convention where available, without the argument
+  // conversion and dispatch of the bound evaluate
+  template<typename T>
+  py::object make_scalar_evaluator(std::shared_ptr<const T> c) {
+    auto storage = std::make_unique<ScalarEvaluator<T>>();
+    storage->correction = c;
+    for (const auto& var : c->inputs()) storage->signature.push_back(var.type());
+    storage->name = c->name();
+#if PY_VERSION_HEX >= 0x03070000
+    storage->def = {storage->name.c_str(), reinterpret_cast<PyCFunction>(reinterpret_cast<void(*)()>(evaluate_scalar<T>)), METH_FASTCALL, nullptr};
+#else
+    storage->def = {storage->name.c_str(), evaluate_scalar_tuple<T>, METH_VARARGS, nullptr};
+#endif
+    PyMethodDef * def = &storage->def;
+    PyObject * capsule = PyCapsule_New(storage.get(), scalar_evaluator_capsule, [](PyObject * self) {
+        delete static_cast<ScalarEvaluator<T>*>(PyCapsule_GetPointer(self, scalar_evaluator_capsule));
+      });
+    if ( capsule == nullptr ) throw py::error_already_set();
+    storage.release();
+    auto owner = py::reinterpret_steal<py::object>(capsule);
+    PyObject * func = PyCFunction_New(def, owner.ptr());
+    if ( func == nullptr ) throw py::error_already_set();
+    return py::reinterpret_steal<py::object>(func);
   }
 }
 
 PYBIND11_MODULE(_core, m) {
     m.doc() = "python binding for corrections evaluator";
 
+    import_ufunc();
+    if ( PyErr_Occurred() ) throw py::error_already_set();
+
     py::class_<Variable>(m, "Variable")
         .def_property_readonly("name", &Variable::name)
         .def_property_readonly("description", &Variable::description)
         .def_property_readonly("type", &Variable::typeStr);
 
+    py::class_<EncodedStrings>(m, "EncodedStrings")
+        .def(py::init([](py::array_t<int, py::array::c_style | py::array::forcecast> codes, std::vector<std::string> dictionary) {
+          // private read-only copy, checked once
+          auto copy = py::array_t<int>(codes.request().shape, codes.data());
+          const int * data = copy.data();
+          for (py::ssize_t i=0; i < copy.size(); ++i) {
+            if ( data[i] < 0 || static_cast<size_t>(data[i]) >= dictionary.size() ) {
+              throw py::index_error("String code " + std::to_string(data[i]) + " is not in the dictionary");
+            }
+          }
+          copy.attr("setflags")(py::arg("write") = false);
+          return EncodedStrings{copy, std::move(dictionary)};
+        }), py::arg("codes"), py::arg("dictionary"))
+        .def_static("encode", &encode_strings)
+        .def_readonly("codes", &EncodedStrings::codes)
+        .def_readonly("dictionary", &EncodedStrings::dictionary);
+
+    py::class_<JaggedArray>(m, "JaggedArray")
+        .def(py::init(&make_jagged), py::arg("offsets"), py::arg("content"))
+        .def_readonly("offsets", &JaggedArray::offsets)
+        .def_readonly("content", &JaggedArray::content);
+
     py::class_<Correction, std::shared_ptr<Correction>>(m, "Correction")
         .def_property_readonly("name", &Correction::name)
         .def_property_readonly("description", &Correction::description)
@@ -80,7 +1134,12 @@ PYBIND11_MODULE(_core, m) {
         .def("evaluate", [](Correction& c, py::args args) {
           return c.evaluate(py::cast<std::vector<Variable::Type>>(args));
         })
-        .def("evalv", evalv<Correction>);
+        .def_property_readonly("_scalar_evaluator", &make_scalar_evaluator<Correction>)
+        .def("evalv", evalv<Correction>, py::arg("nthreads") = 1, py::arg("out") = py::none(), py::arg("op") = py::none(),
+            py::arg("where") = py::none(), py::arg("fill") = std::numeric_limits<double>::quiet_NaN())
+        .def("evalv_status", evalv_status<Correction>, py::arg("fill"), py::arg("nthreads") = 1)
+        .def("evaluate_variations", &evaluate_variations, py::arg("input"), py::arg("values"), py::arg("nthreads") = 1)
+        .def_property_readonly("ufunc", &make_ufunc<Correction>);
 
     py::class_<CompoundCorrection, std::shared_ptr<CompoundCorrection>>(m, "CompoundCorrection")
         .def_property_readonly("name", &CompoundCorrection::name)
@@ -90,17 +1149,26 @@ PYBIND11_MODULE(_core, m) {
         .def("evaluate", [](CompoundCorrection& c, py::args args) {
           return c.evaluate(py::cast<std::vector<Variable::Type>>(args));
         })
-        .def("evalv", evalv<CompoundCorrection>);
+        .def_property_readonly("_scalar_evaluator", &make_scalar_evaluator<CompoundCorrection>)
+        .def("evalv", evalv<CompoundCorrection>, py::arg("nthreads") = 1, py::arg("out") = py::none(), py::arg("op") = py::none(),
+            py::arg("where") = py::none(), py::arg("fill") = std::numeric_limits<double>::quiet_NaN())
+        .def("evalv_status", evalv_status<CompoundCorrection>, py::arg("fill"), py::arg("nthreads") = 1)
+        .def_property_readonly("ufunc", &make_ufunc<CompoundCorrection>);
 
     py::class_<CorrectionSet>(m, "CorrectionSet")
-        .def_static("from_file", &CorrectionSet::from_file)
-        .def_static("from_string", &CorrectionSet::from_string)
+        .def_static("from_file", &CorrectionSet::from_file, py::arg("filename"), py::arg("lazy") = false,
+            py::arg("nthreads") = 1, py::call_guard<py::gil_scoped_release>())
+        .def_static("from_string", &CorrectionSet::from_string, py::arg("data"), py::arg("lazy") = false,
+            py::arg("nthreads") = 1, py::call_guard<py::gil_scoped_release>())
         .def_property_readonly("schema_version", &CorrectionSet::schema_version)
         .def_property_readonly("description", &CorrectionSet::description)
-        .def("__getitem__", &CorrectionSet::at, py::return_value_policy::move)
+        // a lazy set may build the correction, which needs no GIL
+        .def("__getitem__", &CorrectionSet::at, py::return_value_policy::move, py::call_guard<py::gil_scoped_release>())
         .def("__len__", &CorrectionSet::size)
+        .def("__contains__", &CorrectionSet::contains)
         .def("__iter__", [](const CorrectionSet &v) {
-          return py::make_key_iterator(v.begin(), v.end());
-        }, py::keep_alive<0, 1>())
-        .def_property_readonly("compound", &CorrectionSet::compound);
+          return py::iter(py::cast(v.names()));
+        })
+        .def_property_readonly("compound", &CorrectionSet::compound)
+        .def("evaluate_many", &evaluate_many, py::arg("names"), py::arg("inputs"), py::arg("nthreads") = 1);
 }
@@ -1,6 +1,8 @@
 import math
 import pickle
 
+import numpy
+
 import correctionlib
 import correctionlib.schemav2
 
@@ -72,5 +74,16 @@ def test_compound():
     assert corr.evaluate(1.2, 10.0) == 1.1 * (1 + 0.1 * math.log10(10) + 0.1 * 1.2)
     assert corr.evaluate(0.0, 10.0) == (1 + 0.1 * math.log10(10)) * 1.1
 
+    pt = numpy.random.exponential(20.0, size=3000)
+    eta = numpy.random.uniform(-2.0, 2.0, size=3000)
+    numpy.testing.assert_array_equal(
+        cset.compound["l1l2"].evaluate(pt, eta),
+        [cset.compound["l1l2"].evaluate(x, y) for x, y in zip(pt, eta)],
+    )
+    numpy.testing.assert_array_equal(
+        corr.evaluate(eta, pt),
+        [corr.evaluate(y, x) for x, y in zip(pt, eta)],
+    )
+
     corr2 = pickle.loads(pickle.dumps(corr))
     assert corr2.evaluate(0.0, 10.0) == (1 + 0.1 * math.log10(10)) * 1.1
@@ -2,6 +2,7 @@ import json
 import math
 import platform
 
+import numpy
 import pytest
 
 import correctionlib._core as core
@@ -667,6 +668,141 @@ def test_tformula():
             v,
         )
 
+    # a leading minus binds tighter than any binary operator
+    assert evaluate("-2^2", [], []) == 4.0
+    assert evaluate("-x^2", [3.0], []) == 9.0
+    assert evaluate("2^3^2", [], []) == 512.0
+    assert evaluate("2^-1", [], []) == 0.5
+    assert evaluate("2 -1", [], []) == 1.0
+    assert evaluate("[ 0]", [], [3.0]) == 3.0
+    # binary operators without an operand are skipped
+    assert evaluate("2+", [], []) == 2.0
+    assert evaluate("x>1^*2", [3.0], []) == 2.0
+    for expr in ["--x", "- 1", "x y", "1E5", ".5", "x**2", "log10", ""]:
+        with pytest.raises(RuntimeError, match="Failed to parse Formula expression"):
+            evaluate(expr, [1.0], [])
+    with pytest.raises(RuntimeError, match=r"at position 3:\nx\*\(\n  \^"):
+        evaluate("x*(", [1.0], [])
+    with pytest.raises(RuntimeError, match="Insufficient variables"):
+        evaluate("x+y", [1.0], [])
+
+
+def test_tformula_concurrent_parse():
+    from concurrent.futures import ThreadPoolExecutor
+
+    corrs = [
+        schema.Correction(
+            name=f"test{i}",
+            version=1,
+            inputs=[schema.Variable(name="x", type="real")],
+            output=schema.Variable(name="f", type="real"),
+            data=schema.Binning(
+                nodetype="binning",
+                input="x",
+                edges=[float(j) for j in range(51)],
+                flow="clamp",
+                content=[
+                    schema.Formula(
+                        nodetype="formula",
+                        expression=f"[0]*log(x+{j})+max(x,{i})^2",
+                        parser="TFormula",
+                        variables=["x"],
+                        parameters=[0.5],
+                    )
+                    for j in range(50)
+                ],
+            ),
+        )
+        for i in range(20)
+    ]
+    data = schema.CorrectionSet(schema_version=schema.VERSION, corrections=corrs).json()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        csets = list(pool.map(core.CorrectionSet.from_string, [data] * 8))
+    csets.append(core.CorrectionSet.from_string(data, nthreads=4))
+    for i in range(20):
+        expected = 0.5 * math.log(12.5 + int(12.5)) + max(12.5, i) ** 2
+        for cset in csets:
+            assert cset[f"test{i}"].evaluate(12.5) == pytest.approx(expected)
+
+
+def test_tformula_repeated_expression():
+    def make_corr(parameters, variables=("x", "y")):
+        return schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="y", type="real"),
+            ],
+            output=schema.Variable(name="f", type="real"),
+            data=schema.Binning(
+                nodetype="binning",
+                input="x",
+                edges=[0.0, 1.0, 2.0, 3.0],
+                flow="clamp",
+                content=[
+                    schema.Formula(
+                        nodetype="formula",
+                        expression="[0]*y+[1]" if i < 2 else "[0]*x+[1]",
+                        parser="TFormula",
+                        variables=variables if i > 0 else variables[::-1],
+                        parameters=params,
+                    )
+                    for i, params in enumerate(parameters)
+                ],
+            ),
+        )
+
+    corr = wrap(make_corr([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]))["test"]
+    assert corr.evaluate(0.5, 10.0) == 1.0 * 0.5 + 2.0
+    assert corr.evaluate(1.5, 10.0) == 3.0 * 10.0 + 4.0
+    assert corr.evaluate(2.5, 10.0) == 5.0 * 2.5 + 6.0
+
+    with pytest.raises(RuntimeError, match="Insufficient parameters"):
+        wrap(make_corr([[1.0, 2.0], [3.0], [5.0, 6.0]]))
+    with pytest.raises(RuntimeError, match="Insufficient variables"):
+        wrap(make_corr([[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]], ["x"]))
+
+
+def test_tformula_batch():
+    deep = "x" + "+(x" * 40 + ")" * 40
+    expressions = [
+        "log(2)*3+1",
+        "2*3+x",
+        "([0]+[1]*erf((x-[2])/y))*(x<5)+[0]*(x>=5)",
+        "max(0.5,-x^2+[1]*pow(y,0.5))",
+        deep,
+    ]
+    corrs = [
+        schema.Correction(
+            name=f"test{i}",
+            version=1,
+            inputs=[
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="y", type="real"),
+            ],
+            output=schema.Variable(name="f", type="real"),
+            data=schema.Formula(
+                nodetype="formula",
+                expression=expr,
+                parser="TFormula",
+                variables=["x", "y"],
+                parameters=[1.5, 0.25, 2.0],
+            ),
+        )
+        for i, expr in enumerate(expressions)
+    ]
+    cset = wrap(*corrs)
+    x = numpy.linspace(0.0, 10.0, 2001)
+    y = numpy.linspace(1.0, 3.0, 2001)
+    for i in range(len(expressions)):
+        corr = cset[f"test{i}"]
+        expected = [corr.evaluate(a, b) for a, b in zip(x.tolist(), y.tolist())]
+        assert list(corr.evalv(x, y)) == expected
+        assert list(corr.evalv(x, 2.0)) == [corr.evaluate(a, 2.0) for a in x.tolist()]
+    assert cset["test0"].evaluate(1.0, 1.0) == math.log(2) * 3 + 1
+    assert cset["test4"].evaluate(0.5, 1.0) == 20.5
+
 
 def test_category():
     def make_cat(items, default):
@@ -711,6 +847,40 @@ def test_category():
     with pytest.raises(RuntimeError):
         corr.evaluate("one")
 
+    # the first of duplicate keys is used, but all of their values are checked
+    def duplicate(value):
+        data = {
+            "schema_version": schema.VERSION,
+            "corrections": [
+                {
+                    "name": "test",
+                    "version": 2,
+                    "inputs": [{"name": "cat", "type": "int"}],
+                    "output": {"name": "a scale", "type": "real"},
+                    "data": {
+                        "nodetype": "category",
+                        "input": "cat",
+                        "content": [
+                            {"key": 0, "value": 1.2},
+                            {"key": 0, "value": value},
+                        ],
+                    },
+                }
+            ],
+        }
+        return core.CorrectionSet.from_string(json.dumps(data))["test"]
+
+    assert duplicate(1.4).evaluate(0) == 1.2
+    with pytest.raises(RuntimeError, match="could not find variable"):
+        duplicate(
+            {
+                "nodetype": "formula",
+                "expression": "x",
+                "parser": "TFormula",
+                "variables": ["pt"],
+            }
+        )
+
 
 def test_binning():
     def binning(flow):
@@ -934,3 +1104,138 @@ def test_transform():
         corr.evaluate(3)
     assert corr.evaluate(9) == 0.1
     assert corr.evaluate(10) == 0.1
+
+
+def test_uniform_binning():
+    def binning(edges):
+        nbins = len(edges) - 1
+        cset = wrap(
+            schema.Correction(
+                name="test",
+                version=2,
+                inputs=[
+                    schema.Variable(name="x", type="real"),
+                    schema.Variable(name="y", type="real"),
+                ],
+                output=schema.Variable(name="a scale", type="real"),
+                data=schema.Binning(
+                    nodetype="binning",
+                    input="x",
+                    edges=edges,
+                    content=[
+                        schema.MultiBinning(
+                            nodetype="multibinning",
+                            inputs=["x", "y"],
+                            edges=[edges, edges],
+                            content=[float(i) for i in range(nbins * nbins)],
+                            flow=-1.0,
+                        )
+                    ]
+                    + [float(i) for i in range(nbins - 1)],
+                    flow=42.0,
+                ),
+            )
+        )
+        return cset["test"]
+
+    # almost uniform edges use the arithmetic lookup, and adding one more edge
+    # far away forces a binary search: both must find the same bins
+    for edges in ([0.1 * i for i in range(31)], [-2.5 + i / 7 for i in range(36)]):
+        corr = binning(edges)
+        reference = binning(edges + [1000.0])
+        values = numpy.array(edges[:-1] + [-math.inf, math.nan])
+        values = numpy.concatenate(
+            [
+                numpy.nextafter(values, -math.inf),
+                values,
+                numpy.nextafter(values, math.inf),
+            ]
+        )
+        for x in values:
+            for y in (x, edges[0], edges[-2]):
+                assert corr.evaluate(x, y) == reference.evaluate(x, y)
+        assert corr.evaluate(edges[-1], 0.0) == 42.0
+        assert corr.evaluate(math.inf, 0.0) == 42.0
+
+
+def test_binning_search():
+    rng = numpy.random.default_rng(1)
+    for nedges in (2, 3, 4, 7, 100, 1001):
+        # quarter-integer edges, exactly representable in the json document
+        edges = numpy.cumsum(rng.integers(1, 40, size=nedges)) / 4.0
+        edges[0] = -edges[-1]
+        corr = wrap(
+            schema.Correction(
+                name="test",
+                version=2,
+                inputs=[schema.Variable(name="x", type="real")],
+                output=schema.Variable(name="a scale", type="real"),
+                data=schema.Binning(
+                    nodetype="binning",
+                    input="x",
+                    edges=list(edges),
+                    content=[float(i) for i in range(nedges - 1)],
+                    flow=-1.0,
+                ),
+            )
+        )["test"]
+        x = numpy.concatenate(
+            [
+                edges,
+                numpy.nextafter(edges, -math.inf),
+                numpy.nextafter(edges, math.inf),
+                rng.uniform(edges[0] - 1, edges[-1] + 1, size=1000),
+                [-math.inf, math.inf, math.nan],
+            ]
+        )
+        expected = numpy.searchsorted(edges, x, side="right") - 1.0
+        expected[(expected < 0) | (expected >= nedges - 1)] = -1.0
+        assert numpy.array_equal(corr.evalv(x), expected)
+        assert [corr.evaluate(float(v)) for v in x[:nedges]] == list(expected[:nedges])
+
+
+def test_category_lookup():
+    def category(keys, default):
+        vtype = "string" if isinstance(keys[0], str) else "int"
+        return wrap(
+            schema.Correction(
+                name="test",
+                version=2,
+                inputs=[schema.Variable(name="x", type=vtype)],
+                output=schema.Variable(name="a scale", type="real"),
+                data=schema.Category(
+                    nodetype="category",
+                    input="x",
+                    content=[
+                        schema.CategoryItem(key=key, value=float(i))
+                        for i, key in enumerate(keys)
+                    ],
+                    default=default,
+                ),
+            )
+        )["test"]
+
+    int32 = numpy.iinfo(numpy.int32)
+    for keys in (
+        [0, 1, 10, 11],  # dense table
+        [-3, 2, 5],
+        [int32.min, -1, 0, int32.max],  # hash table
+        [1000 * i - 7 for i in range(300)],
+        ["a", "b", "ab", ""],
+        ["key%d" % i for i in range(300)],
+    ):
+        isstr = isinstance(keys[0], str)
+        misses = ["c", "aa", "key", "key300"] if isstr else [-4, 3, 12, -7000, 299994]
+        corr = category(keys, 42.0)
+        for i, key in enumerate(keys):
+            assert corr.evaluate(key) == float(i)
+        for key in misses:
+            assert corr.evaluate(key) == 42.0
+        if not isstr:
+            x = numpy.array(keys + misses, dtype=numpy.int32)
+            expected = [float(i) for i in range(len(keys))] + [42.0] * len(misses)
+            assert list(corr.evalv(x)) == expected
+        corr = category(keys, None)
+        assert corr.evaluate(keys[-1]) == float(len(keys) - 1)
+        with pytest.raises(IndexError):
+            corr.evaluate(misses[0])
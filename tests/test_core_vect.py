@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy
 import pytest
 
@@ -60,14 +62,20 @@ def test_core_vectorized():
     )
     with pytest.raises(ValueError):
         corr.evalv(numpy.full(5, 0.3), numpy.full(10, 1), "")
-    with pytest.raises(ValueError):
-        corr.evalv(numpy.full((10, 2), 0.3), 1, "")
+    numpy.testing.assert_array_equal(
+        corr.evalv(numpy.full((10, 2), 0.3), 1, ""),
+        numpy.full((10, 2), 0.3),
+    )
     with pytest.raises(ValueError):
         corr.evalv(0.3)
     with pytest.raises(ValueError):
         corr.evalv(0.3, 1, 1, 1)
+    numpy.testing.assert_array_equal(
+        corr.evalv(0.3, 1, numpy.full(10, "asdf")),
+        numpy.full(10, 0.3),
+    )
     with pytest.raises(ValueError):
-        corr.evalv(0.3, 1, numpy.full(10, "asdf"))
+        corr.evalv(0.3, 1, numpy.full(10, 1))
 
     a = numpy.linspace(-3, 3, 100)
     b = numpy.arange(100) % 3
@@ -75,3 +83,567 @@ def test_core_vectorized():
         corr.evalv(a, b, ""),
         numpy.where(b == 1, a, -99.0),
     )
+
+
+def test_core_vectorized_threads():
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[schema.Variable(name="a", type="real")],
+            output=schema.Variable(name="a scale", type="real"),
+            data={
+                "nodetype": "formula",
+                "expression": "2*x",
+                "parser": "TFormula",
+                "variables": ["a"],
+            },
+        )
+    )
+    corr = cset["test"]
+    inputs = [numpy.random.uniform(size=10000) for _ in range(8)]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        outputs = list(pool.map(corr.evalv, inputs))
+    for a, out in zip(inputs, outputs):
+        numpy.testing.assert_array_equal(out, 2 * a)
+
+
+def test_core_vectorized_nthreads():
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="a", type="real"),
+                schema.Variable(name="b", type="int"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data={
+                "nodetype": "binning",
+                "input": "a",
+                "edges": [0.0, 0.5, 1.0],
+                "flow": "error",
+                "content": [
+                    {
+                        "nodetype": "formula",
+                        "expression": "x*x",
+                        "parser": "TFormula",
+                        "variables": ["a"],
+                    },
+                    {
+                        "nodetype": "category",
+                        "input": "b",
+                        "content": [{"key": 1, "value": 2.0}],
+                        "default": 3.0,
+                    },
+                ],
+            },
+        )
+    )
+    corr = cset["test"]
+
+    a = numpy.random.uniform(size=100000)
+    b = numpy.arange(100000) % 3
+    expected = corr.evalv(a, b)
+    for nthreads in (0, 2, 3, 8):
+        numpy.testing.assert_array_equal(corr.evalv(a, b, nthreads=nthreads), expected)
+    numpy.testing.assert_array_equal(
+        corr.evalv(a[:10], b[:10], nthreads=4), expected[:10]
+    )
+
+    # the first failing row is always the one reported
+    a[70000] = 7.0
+    a[30000] = 5.0
+    for nthreads in (1, 2, 4, 8):
+        with pytest.raises(RuntimeError, match="value: 5.0"):
+            corr.evalv(a, b, nthreads=nthreads)
+
+
+def test_core_vectorized_nodes():
+    cset = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="pt", type="real"),
+                schema.Variable(name="eta", type="real"),
+                schema.Variable(name="dm", type="int"),
+                schema.Variable(name="syst", type="string"),
+            ],
+            output=schema.Variable(name="weight", type="real"),
+            generic_formulas=[
+                {
+                    "nodetype": "formula",
+                    "expression": "[0] + [1]*x",
+                    "parser": "TFormula",
+                    "variables": ["pt"],
+                },
+            ],
+            data={
+                "nodetype": "transform",
+                "input": "pt",
+                "rule": {
+                    "nodetype": "formula",
+                    "expression": "1.1*x",
+                    "parser": "TFormula",
+                    "variables": ["pt"],
+                },
+                "content": {
+                    "nodetype": "binning",
+                    "input": "eta",
+                    "edges": [-2.5, -1.0, 1.0, 2.5],
+                    "flow": "clamp",
+                    "content": [
+                        {
+                            "nodetype": "multibinning",
+                            "inputs": ["pt", "eta"],
+                            "edges": [[20.0, 40.0, 80.0], [-2.5, -1.5, -1.0]],
+                            "content": [1.0, 2.0, 3.0, 4.0],
+                            "flow": {
+                                "nodetype": "formula",
+                                "expression": "x/100",
+                                "parser": "TFormula",
+                                "variables": ["pt"],
+                            },
+                        },
+                        {
+                            "nodetype": "category",
+                            "input": "dm",
+                            "content": [
+                                {
+                                    "key": 0,
+                                    "value": {
+                                        "nodetype": "formularef",
+                                        "index": 0,
+                                        "parameters": [0.5, 0.01],
+                                    },
+                                },
+                                {
+                                    "key": 1,
+                                    "value": {
+                                        "nodetype": "category",
+                                        "input": "syst",
+                                        "content": [
+                                            {"key": "nom", "value": 1.0},
+                                            {"key": "up", "value": 1.1},
+                                        ],
+                                    },
+                                },
+                                {
+                                    "key": 10,
+                                    "value": {
+                                        "nodetype": "transform",
+                                        "input": "dm",
+                                        "rule": 1.0,
+                                        "content": {
+                                            "nodetype": "category",
+                                            "input": "dm",
+                                            "content": [{"key": 1, "value": 7.0}],
+                                        },
+                                    },
+                                },
+                            ],
+                            "default": 0.5,
+                        },
+                        6.0,
+                    ],
+                },
+            },
+        )
+    )
+    corr = cset["test"]
+
+    pt = numpy.random.exponential(40.0, size=5000)
+    eta = numpy.random.uniform(-3.0, 3.0, size=5000)
+    dm = numpy.random.choice([0, 1, 5, 10], size=5000)
+    for syst in ("nom", "up"):
+        expected = [corr.evaluate(*args, syst) for args in zip(pt, eta, dm.tolist())]
+        numpy.testing.assert_array_equal(corr.evalv(pt, eta, dm, syst), expected)
+        numpy.testing.assert_array_equal(
+            corr.evalv(pt, 0.0, dm, syst),
+            [corr.evaluate(x, 0.0, y, syst) for x, y in zip(pt, dm.tolist())],
+        )
+        numpy.testing.assert_array_equal(
+            corr.evalv(pt, eta, 0, syst),
+            [corr.evaluate(x, y, 0, syst) for x, y in zip(pt, eta)],
+        )
+
+    with pytest.raises(IndexError):
+        corr.evalv(pt, eta, dm, "down")
+    with pytest.raises(RuntimeError, match="wrong type"):
+        corr.evalv(pt, eta, dm, 1)
+
+
+def test_core_vectorized_strings():
+    keys = ["Loose", "Medium", "Tight", ""]
+    corr = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="wp", type="string"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data=schema.Category(
+                nodetype="category",
+                input="wp",
+                content=[
+                    schema.CategoryItem(key=key, value=float(i))
+                    for i, key in enumerate(keys)
+                ],
+            ),
+        )
+    )["test"]
+
+    rng = numpy.random.default_rng(7)
+    wp = rng.choice(keys, size=5000).astype("U10")
+    expected = numpy.array([float(keys.index(k)) for k in wp])
+    for values in (wp, wp.astype("S"), wp.astype(object)):
+        numpy.testing.assert_array_equal(corr.evalv(1.0, values), expected)
+    numpy.testing.assert_array_equal(corr.evalv(1.0, wp[::3]), expected[::3])
+    numpy.testing.assert_array_equal(corr.evalv(1.0, wp[::-1]), expected[::-1])
+
+    encoded = core.EncodedStrings.encode(wp)
+    assert sorted(encoded.dictionary) == sorted(keys)
+    assert [encoded.dictionary[c] for c in encoded.codes] == list(wp)
+    with pytest.raises(ValueError):
+        encoded.codes[0] = 5
+    numpy.testing.assert_array_equal(corr.evalv(1.0, encoded), expected)
+    numpy.testing.assert_array_equal(
+        corr.evalv(numpy.ones(5000), encoded, nthreads=2), expected
+    )
+    rebuilt = core.EncodedStrings(encoded.codes, encoded.dictionary)
+    numpy.testing.assert_array_equal(corr.evalv(1.0, rebuilt), expected)
+    with pytest.raises(IndexError):
+        core.EncodedStrings(numpy.array([0, 4]), keys)
+    with pytest.raises(IndexError):
+        core.EncodedStrings(numpy.array([-1]), keys)
+    with pytest.raises(ValueError):
+        corr.evalv(encoded, "Loose")
+
+    # the first missing key is reported, whether encoded or not
+    wp[4000] = "VeryTight"
+    wp[4500] = "Medium "
+    for values in (wp, core.EncodedStrings.encode(wp)):
+        with pytest.raises(IndexError, match="val: VeryTight"):
+            corr.evalv(1.0, values)
+    with pytest.raises(ValueError):
+        corr.evalv(1.0, numpy.array(["Loose", 1], dtype=object))
+
+
+def test_core_vectorized_broadcast():
+    corr = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="pt", type="real"),
+                schema.Variable(name="eta", type="real"),
+                schema.Variable(name="dm", type="int"),
+                schema.Variable(name="syst", type="string"),
+            ],
+            output=schema.Variable(name="weight", type="real"),
+            data={
+                "nodetype": "binning",
+                "input": "eta",
+                "edges": [-2.5, 0.0, 2.5],
+                "flow": "clamp",
+                "content": [
+                    {
+                        "nodetype": "category",
+                        "input": "dm",
+                        "content": [
+                            {
+                                "key": 1,
+                                "value": {
+                                    "nodetype": "formula",
+                                    "expression": "x*x",
+                                    "parser": "TFormula",
+                                    "variables": ["pt"],
+                                },
+                            }
+                        ],
+                        "default": 2.0,
+                    },
+                    {
+                        "nodetype": "category",
+                        "input": "syst",
+                        "content": [
+                            {"key": "nom", "value": 1.0},
+                            {"key": "up", "value": 1.5},
+                        ],
+                    },
+                ],
+            },
+        )
+    )["test"]
+
+    def reference(*args):
+        # evaluation of contiguous, materialized copies
+        arrays = [arg for arg in args if isinstance(arg, numpy.ndarray)]
+        bargs = iter(numpy.broadcast_arrays(*arrays))
+        args = [
+            next(bargs).ravel() if isinstance(arg, numpy.ndarray) else arg
+            for arg in args
+        ]
+        return corr.evalv(*args).reshape(numpy.broadcast(*arrays).shape)
+
+    rng = numpy.random.default_rng(3)
+    nevt, nobj = 3000, 4
+    pt = rng.exponential(30.0, size=(nevt, nobj))
+    eta = rng.uniform(-3.0, 3.0, size=(nevt, nobj))
+    dm = rng.choice([0, 1], size=nevt).astype(numpy.int32)
+    syst = rng.choice(["nom", "up"], size=nobj)
+    cases = [
+        # per-event column against per-object matrices
+        (pt, eta, dm[:, None], "nom"),
+        (pt, eta, dm[:, None], syst),
+        (pt[:, :1], eta[0], dm[:, None], syst[None, :]),
+        # non-contiguous, reversed, transposed and zero-stride views
+        (pt[::2], eta[::-2], dm[::2, None], "up"),
+        (pt.T, eta.T, dm, "nom"),
+        (numpy.asfortranarray(pt), eta, 1, syst),
+        (pt[:, 1], numpy.broadcast_to(eta[:1, 1], (nevt,)), dm, "nom"),
+        (pt[:, None, :], eta[None, :5, :], dm[:, None, None], syst),
+        (numpy.array(5.0), eta, 1, "nom"),
+        (pt[:0], eta[:0], 1, "nom"),
+        # dtype conversion
+        (pt.astype(numpy.float32), eta, dm.astype(numpy.int64)[:, None], "nom"),
+    ]
+    for args in cases:
+        expected = reference(*args)
+        for nthreads in (1, 3):
+            out = corr.evalv(*args, nthreads=nthreads)
+            assert out.shape == expected.shape
+            numpy.testing.assert_array_equal(out, expected)
+
+    # unaligned buffer, e.g. from a packed record or memory map
+    raw = numpy.zeros(8 * nevt + 1, dtype=numpy.uint8)
+    unaligned = raw[1:].view(numpy.float64)
+    unaligned[:] = -1.0
+    assert not unaligned.flags.aligned
+    numpy.testing.assert_array_equal(
+        corr.evalv(pt[:, 0], unaligned, 1, "nom"), pt[:, 0] ** 2
+    )
+
+    with pytest.raises(ValueError, match="broadcast"):
+        corr.evalv(pt, eta.T, 1, "nom")
+
+
+def test_core_vectorized_dtypes():
+    corr = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="n", type="int"),
+            ],
+            output=schema.Variable(name="weight", type="real"),
+            data={
+                "nodetype": "category",
+                "input": "n",
+                "content": [
+                    {"key": 0, "value": 0.5},
+                    {
+                        "key": 1,
+                        "value": {
+                            "nodetype": "formula",
+                            "expression": "2*x",
+                            "parser": "TFormula",
+                            "variables": ["x"],
+                        },
+                    },
+                ],
+                "default": 7.0,
+            },
+        )
+    )["test"]
+
+    x = numpy.linspace(-2.0, 2.0, 101)
+    n = numpy.arange(101) % 4
+    expected = corr.evalv(x, n.astype(numpy.int32))
+    for dtype in ("i1", "i2", "i8", "u1", "u2", "u4", "u8", ">i4", ">u8"):
+        numpy.testing.assert_array_equal(corr.evalv(x, n.astype(dtype)), expected)
+        numpy.testing.assert_array_equal(
+            corr.evalv(x[:, None], n.astype(dtype)[::-1]),
+            corr.evalv(x[:, None], n.astype(numpy.int32)[::-1]),
+        )
+    for dtype in ("f4", "f2", ">f8", "i8", "u1"):
+        xcast = x.astype(dtype)
+        numpy.testing.assert_array_equal(
+            corr.evalv(xcast, n), corr.evalv(xcast.astype(numpy.float64), n)
+        )
+    numpy.testing.assert_array_equal(
+        corr.evalv(x, n % 2 == 1), corr.evalv(x, (n % 2).astype(numpy.int32))
+    )
+
+    int32 = numpy.iinfo(numpy.int32)
+    for dtype in ("i8", "u4", "u8"):
+        big = numpy.full(10000, 5, dtype=dtype)
+        big[[3, 9000]] = int32.max
+        numpy.testing.assert_array_equal(corr.evalv(1.0, big), 7.0)
+        big[9000] += 1
+        with pytest.raises(OverflowError, match="element 9000"):
+            corr.evalv(1.0, big, nthreads=2)
+    with pytest.raises(OverflowError):
+        corr.evalv(1.0, numpy.array([0, int32.min - 1]))
+    numpy.testing.assert_array_equal(
+        corr.evalv(1.0, numpy.array([int32.min, 0], dtype="i8")), [7.0, 0.5]
+    )
+
+
+def test_core_vectorized_jagged():
+    corr = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="pt", type="real"),
+                schema.Variable(name="rho", type="real"),
+                schema.Variable(name="flav", type="int"),
+                schema.Variable(name="syst", type="string"),
+            ],
+            output=schema.Variable(name="weight", type="real"),
+            data={
+                "nodetype": "category",
+                "input": "syst",
+                "content": [
+                    {
+                        "key": "nom",
+                        "value": {
+                            "nodetype": "category",
+                            "input": "flav",
+                            "content": [
+                                {
+                                    "key": flav,
+                                    "value": {
+                                        "nodetype": "formula",
+                                        "expression": f"x + 1000*y + {flav}e6",
+                                        "parser": "TFormula",
+                                        "variables": ["pt", "rho"],
+                                    },
+                                }
+                                for flav in (0, 4, 5)
+                            ],
+                        },
+                    },
+                    {"key": "up", "value": -1.0},
+                ],
+            },
+        )
+    )["test"]
+
+    rng = numpy.random.default_rng(5)
+    nevt = 5000
+    counts = rng.poisson(2.0, size=nevt)
+    counts[:3] = 0
+    offsets = numpy.zeros(nevt + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    nobj = offsets[-1]
+    pt = rng.uniform(0.0, 100.0, size=nobj)
+    flav = rng.choice([0, 4, 5], size=nobj).astype(numpy.uint8)
+    rho = rng.uniform(0.0, 50.0, size=nevt)
+    parents = numpy.repeat(numpy.arange(nevt), counts)
+
+    jpt = core.JaggedArray(offsets, pt)
+    jflav = core.JaggedArray(offsets, flav)
+    expected = pt + 1000 * rho[parents] + 1e6 * flav
+    for nthreads in (1, 2):
+        out = corr.evalv(jpt, rho, jflav, "nom", nthreads=nthreads)
+        assert isinstance(out, core.JaggedArray)
+        numpy.testing.assert_array_equal(out.offsets, offsets)
+        numpy.testing.assert_array_equal(out.content, expected)
+    numpy.testing.assert_array_equal(
+        corr.evalv(jpt, rho[::-1], 0, "nom").content,
+        pt + 1000 * rho[::-1][parents],
+    )
+    numpy.testing.assert_array_equal(
+        corr.evalv(jpt, 2.0, 1, numpy.array(["up"])).content, numpy.full(nobj, -1.0)
+    )
+    syst = numpy.where(numpy.arange(nobj) % 2 == 0, "nom", "up")
+    for jsyst in (
+        core.JaggedArray(offsets, syst),
+        core.JaggedArray(offsets, core.EncodedStrings.encode(syst)),
+    ):
+        numpy.testing.assert_array_equal(
+            corr.evalv(jpt, rho, jflav, jsyst).content,
+            numpy.where(syst == "nom", expected, -1.0),
+        )
+    esyst = core.EncodedStrings.encode(numpy.where(rho > 25.0, "up", "nom"))
+    numpy.testing.assert_array_equal(
+        corr.evalv(jpt, rho, jflav, esyst).content,
+        numpy.where(rho[parents] > 25.0, -1.0, expected),
+    )
+
+    # lists of a larger content, with the same lengths
+    shifted = core.JaggedArray(offsets[2000:] + 7, numpy.arange(nobj + 20.0))
+    out = corr.evalv(shifted, rho[2000:], 0, "nom")
+    numpy.testing.assert_array_equal(out.offsets, offsets[2000:] - offsets[2000])
+    numpy.testing.assert_array_equal(
+        out.content,
+        numpy.arange(offsets[2000] + 7, nobj + 7)
+        + 1000 * rho[parents[offsets[2000] :]],
+    )
+    with pytest.raises(ValueError, match="same list lengths"):
+        corr.evalv(jpt, rho, core.JaggedArray(offsets[:-1], flav), "nom")
+    with pytest.raises(ValueError, match="one value per list"):
+        corr.evalv(jpt, rho[:-1], 0, "nom")
+    with pytest.raises(IndexError):
+        core.JaggedArray(offsets, pt[:-1])
+    with pytest.raises(ValueError):
+        core.JaggedArray(offsets[::-1], pt)
+
+
+def test_core_vectorized_first_error():
+    corr = wrap(
+        schema.Correction(
+            name="test",
+            version=1,
+            inputs=[
+                schema.Variable(name="x", type="real"),
+                schema.Variable(name="k", type="int"),
+            ],
+            output=schema.Variable(name="a scale", type="real"),
+            data={
+                "nodetype": "binning",
+                "input": "x",
+                "edges": [0.0, 1.0, 2.0],
+                "content": [
+                    {
+                        "nodetype": "category",
+                        "input": "k",
+                        "content": [{"key": 1, "value": 1.0}],
+                    },
+                    2.0,
+                ],
+                "flow": "error",
+            },
+        )
+    )["test"]
+
+    # the first failing row is in a node evaluated after the other failure
+    x = numpy.array([0.5, 5.0])
+    k = numpy.array([7, 1], dtype=numpy.int32)
+    with pytest.raises(IndexError, match="val: 7"):
+        corr.evaluate(0.5, 7)
+    with pytest.raises(IndexError, match="val: 7"):
+        corr.evalv(x, k)
+    with pytest.raises(RuntimeError, match="above bounds"):
+        corr.evalv(x, k, where=numpy.array([False, True]))
+
+    # and so for any block and thread
+    n = 100_000
+    x = numpy.full(n, 1.5)
+    k = numpy.ones(n, dtype=numpy.int32)
+    x[[30_000, 90_000]] = 5.0
+    x[50_000] = 0.5
+    k[50_000] = 7
+    for nthreads in (1, 3):
+        with pytest.raises(RuntimeError, match="above bounds"):
+            corr.evalv(x, k, nthreads=nthreads)
+        x[30_000] = 1.5
+        with pytest.raises(IndexError, match="val: 7"):
+            corr.evalv(x, k, nthreads=nthreads)
+        x[30_000] = 5.0
@@ -1,4 +1,9 @@
+import gc
+import json
 import pickle
+import warnings
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 import pytest
@@ -42,6 +47,880 @@ def test_highlevel():
         sf.evaluate(numpy.ones((3, 4)), numpy.ones(4)),
         numpy.full((3, 4), 1.234),
     )
+    numpy.testing.assert_array_equal(
+        sf.evaluate(numpy.ones((3, 4)), numpy.ones(4), nthreads=2),
+        numpy.full((3, 4), 1.234),
+    )
 
     sf2 = pickle.loads(pickle.dumps(sf))
     assert sf2.evaluate(1.0, 1.0) == 1.234
+
+
+def test_highlevel_strings():
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet(
+            schema_version=model.VERSION,
+            corrections=[
+                model.Correction(
+                    name="test corr",
+                    version=2,
+                    inputs=[
+                        model.Variable(name="a", type="real"),
+                        model.Variable(name="syst", type="string"),
+                    ],
+                    output=model.Variable(name="a scale", type="real"),
+                    data=model.Category(
+                        nodetype="category",
+                        input="syst",
+                        content=[
+                            model.CategoryItem(key="up", value=2.0),
+                            model.CategoryItem(key="down", value=0.5),
+                        ],
+                        default=1.0,
+                    ),
+                )
+            ],
+        )
+    )
+    sf = cset["test corr"]
+    syst = numpy.array([["up", "nom"], ["down", "up"], ["nom", "nom"]])
+    expected = numpy.array([[2.0, 1.0], [0.5, 2.0], [1.0, 1.0]])
+    numpy.testing.assert_array_equal(sf.evaluate(1.0, syst), expected)
+    numpy.testing.assert_array_equal(
+        sf.evaluate(numpy.ones(2), syst.astype(object)), expected
+    )
+
+    codes = sf.encode("syst", syst)
+    assert sorted(codes.dictionary) == ["down", "nom", "up"]
+    assert codes.codes.shape == syst.shape
+    numpy.testing.assert_array_equal(sf.evaluate(1.0, codes), expected)
+    numpy.testing.assert_array_equal(
+        sf.evaluate(numpy.ones((4, 3, 1)), codes),
+        numpy.broadcast_to(expected, (4, 3, 2)),
+    )
+    with pytest.raises(ValueError):
+        sf.encode("a", syst)
+    with pytest.raises(KeyError):
+        sf.encode("b", syst)
+
+
+def test_highlevel_jagged():
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet(
+            schema_version=model.VERSION,
+            corrections=[
+                model.Correction(
+                    name="test corr",
+                    version=2,
+                    inputs=[
+                        model.Variable(name="pt", type="real"),
+                        model.Variable(name="rho", type="real"),
+                    ],
+                    output=model.Variable(name="a scale", type="real"),
+                    data=model.Formula(
+                        nodetype="formula",
+                        expression="x + 1000*y",
+                        parser="TFormula",
+                        variables=["pt", "rho"],
+                    ),
+                )
+            ],
+        )
+    )
+    sf = cset["test corr"]
+    offsets = numpy.array([0, 2, 2, 5])
+    pt = numpy.array([1.0, 2.0, 3.0, 4.0, 5.0])
+    rho = numpy.array([1.0, 2.0, 3.0])
+    out = sf.evaluate(correctionlib._core.JaggedArray(offsets, pt), rho)
+    numpy.testing.assert_array_equal(out.offsets, offsets)
+    numpy.testing.assert_array_equal(
+        out.content, [1001.0, 1002.0, 3003.0, 3004.0, 3005.0]
+    )
+
+    ak = pytest.importorskip("awkward")
+    jpt = ak.Array([[1.0, 2.0], [], [3.0, 4.0, 5.0]])
+    out = sf.evaluate(jpt, ak.Array(rho))
+    assert out.tolist() == [[1001.0, 1002.0], [], [3003.0, 3004.0, 3005.0]]
+    out = sf.evaluate(jpt[1:], 1.0)
+    assert out.tolist() == [[], [1003.0, 1004.0, 1005.0]]
+    assert sf.evaluate(ak.Array(rho), 0.0).tolist() == [1.0, 2.0, 3.0]
+
+
+def test_highlevel_ufunc():
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet(
+            schema_version=model.VERSION,
+            corrections=[
+                model.Correction(
+                    name="test corr",
+                    version=2,
+                    inputs=[
+                        model.Variable(name="a", type="real"),
+                        model.Variable(name="b", type="int"),
+                    ],
+                    output=model.Variable(name="a scale", type="real"),
+                    data=model.Category(
+                        nodetype="category",
+                        input="b",
+                        content=[
+                            model.CategoryItem(
+                                key=1,
+                                value=model.Formula(
+                                    nodetype="formula",
+                                    expression="2*x",
+                                    parser="TFormula",
+                                    variables=["a"],
+                                ),
+                            ),
+                        ],
+                        default=1.0,
+                    ),
+                ),
+                model.Correction(
+                    name="syst corr",
+                    version=2,
+                    inputs=[model.Variable(name="syst", type="string")],
+                    output=model.Variable(name="a scale", type="real"),
+                    data=model.Category(
+                        nodetype="category",
+                        input="syst",
+                        content=[model.CategoryItem(key="up", value=2.0)],
+                        default=1.0,
+                    ),
+                ),
+            ],
+        )
+    )
+    sf = cset["test corr"]
+    ufunc = sf.ufunc
+    assert isinstance(ufunc, numpy.ufunc)
+    assert ufunc is sf.ufunc
+    assert (ufunc.nin, ufunc.nout) == (2, 1)
+
+    a = numpy.arange(6.0).reshape(2, 3) / 4
+    b = numpy.array([1, 0, 1])
+    expected = numpy.where(b == 1, 2 * a, 1.0)
+    for bs in (b, b.astype(numpy.int32), b.astype(numpy.uint8)):
+        numpy.testing.assert_array_equal(ufunc(a, bs), expected)
+    numpy.testing.assert_array_equal(ufunc(a.astype(numpy.float32), b), expected)
+    numpy.testing.assert_array_equal(ufunc(a[:, ::2], b[::2]), expected[:, ::2])
+    assert ufunc(0.5, 1) == 1.0
+
+    out = numpy.full((2, 3), -1.0)
+    assert ufunc(a, b, out=out) is out
+    numpy.testing.assert_array_equal(out, expected)
+    out = numpy.full((2, 3), -1.0)
+    ufunc(a, b, out=out, where=a > 0.5)
+    numpy.testing.assert_array_equal(out, numpy.where(a > 0.5, expected, -1.0))
+    out = numpy.full((3, 2), -1.0)
+    ufunc(a.T, b[:, None], out=out.T.T)
+    numpy.testing.assert_array_equal(out, expected.T)
+
+    with pytest.raises(OverflowError):
+        ufunc(a, 2**40)
+
+    syst = cset["syst corr"].ufunc
+    values = numpy.array(["up", "down", "up"])
+    numpy.testing.assert_array_equal(syst(values), [2.0, 1.0, 2.0])
+    numpy.testing.assert_array_equal(syst(values.astype(object)), [2.0, 1.0, 2.0])
+    with pytest.raises(ValueError):
+        syst(numpy.array([1, "up"], dtype=object))
+
+    assert pickle.loads(pickle.dumps(sf)).ufunc(0.5, 1) == 1.0
+    # no floating point warnings, as for evaluate
+    logx = correctionlib.CorrectionSet(
+        model.CorrectionSet(
+            schema_version=model.VERSION,
+            corrections=[
+                model.Correction(
+                    name="log",
+                    version=1,
+                    inputs=[model.Variable(name="x", type="real")],
+                    output=model.Variable(name="y", type="real"),
+                    data=model.Formula(
+                        nodetype="formula",
+                        expression="log(x)",
+                        parser="TFormula",
+                        variables=["x"],
+                    ),
+                )
+            ],
+        )
+    )["log"]
+    x = numpy.array([-1.0, 0.0, 1.0])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        numpy.testing.assert_array_equal(logx.ufunc(x), logx.evaluate(x))
+        numpy.testing.assert_array_equal(logx.ufunc(x), [numpy.nan, -numpy.inf, 0.0])
+
+    # the ufunc keeps the correction alive, and releases it when dropped
+    base = weakref.ref(sf._base)
+    del cset, sf, syst
+    gc.collect()
+    assert base() is not None
+    assert ufunc(0.5, 1) == 1.0
+    del ufunc
+    gc.collect()
+    assert base() is None
+
+
+def test_highlevel_evaluate_many():
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet.parse_obj(
+            {
+                "schema_version": model.VERSION,
+                "corrections": [
+                    {
+                        "name": "scale",
+                        "version": 1,
+                        "inputs": [
+                            {"name": "pt", "type": "real"},
+                            {"name": "dm", "type": "int"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "data": {
+                            "nodetype": "category",
+                            "input": "dm",
+                            "content": [
+                                {
+                                    "key": 1,
+                                    "value": {
+                                        "nodetype": "formula",
+                                        "expression": "x/2",
+                                        "parser": "TFormula",
+                                        "variables": ["pt"],
+                                    },
+                                },
+                            ],
+                            "default": 1.0,
+                        },
+                    },
+                    {
+                        "name": "syst",
+                        "version": 1,
+                        "inputs": [
+                            {"name": "syst", "type": "string"},
+                            {"name": "dm", "type": "int"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "data": {
+                            "nodetype": "category",
+                            "input": "syst",
+                            "content": [{"key": "up", "value": 2.0}],
+                            "default": 1.0,
+                        },
+                    },
+                ],
+                "compound_corrections": [
+                    {
+                        "name": "both",
+                        "inputs": [
+                            {"name": "pt", "type": "real"},
+                            {"name": "dm", "type": "int"},
+                            {"name": "syst", "type": "string"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "inputs_update": [],
+                        "input_op": "*",
+                        "output_op": "*",
+                        "stack": ["scale", "syst"],
+                    },
+                ],
+            }
+        )
+    )
+    pt = numpy.linspace(10.0, 100.0, 12).reshape(4, 3)
+    dm = numpy.array([1, 0, 1])
+    syst = numpy.array([["up"], ["nom"], ["up"], ["down"]])
+    inputs = {"pt": pt, "dm": dm, "syst": syst, "unused": "ignored"}
+    out = cset.evaluate_many(["scale", "syst", "both"], inputs)
+    assert list(out) == ["scale", "syst", "both"]
+    for name in ("scale", "syst"):
+        corr = cset[name]
+        expected = corr.evaluate(*(inputs[var.name] for var in corr._base.inputs))
+        numpy.testing.assert_array_equal(
+            out[name], numpy.broadcast_to(expected, (4, 3))
+        )
+    numpy.testing.assert_array_equal(out["both"], out["scale"] * out["syst"])
+    numpy.testing.assert_array_equal(
+        cset.evaluate_many(["both"], inputs, nthreads=2)["both"], out["both"]
+    )
+
+    # scalar inputs give arrays of one value, as evalv does
+    out = cset.evaluate_many(["scale", "both"], {"pt": 10.0, "dm": 1, "syst": "up"})
+    assert out["scale"].shape == cset["scale"]._base.evalv(10.0, 1).shape == (1,)
+    assert out["scale"].tolist() == [5.0]
+    assert out["both"].shape == (1,)
+    with pytest.raises(KeyError):
+        cset.evaluate_many(["missing"], inputs)
+    with pytest.raises(KeyError):
+        cset.evaluate_many(["scale"], {"pt": pt})
+    with pytest.raises(RuntimeError, match="wrong type"):
+        cset.evaluate_many(["scale"], {"pt": pt, "dm": 1.0})
+    with pytest.raises(OverflowError, match="input dm"):
+        cset.evaluate_many(["scale"], {"pt": pt, "dm": numpy.full(3, 2**40)})
+
+
+def test_highlevel_evaluate_variations():
+    def syst(i):
+        return {
+            "nodetype": "category",
+            "input": "syst",
+            "content": [
+                {"key": "nom", "value": 1.0 + i},
+                {"key": "up", "value": 1.5 + i},
+                {
+                    "key": "down",
+                    "value": {
+                        "nodetype": "formula",
+                        "expression": "0.01*x",
+                        "parser": "TFormula",
+                        "variables": ["pt"],
+                    },
+                },
+            ],
+        }
+
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet.parse_obj(
+            {
+                "schema_version": model.VERSION,
+                "corrections": [
+                    {
+                        "name": "test corr",
+                        "version": 1,
+                        "inputs": [
+                            {"name": "pt", "type": "real"},
+                            {"name": "syst", "type": "string"},
+                            {"name": "dm", "type": "int"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "data": {
+                            "nodetype": "binning",
+                            "input": "pt",
+                            "edges": [0.0, 20.0, 50.0, 1000.0],
+                            "flow": "clamp",
+                            "content": [
+                                {
+                                    "nodetype": "category",
+                                    "input": "dm",
+                                    "content": [
+                                        {"key": 0, "value": syst(i)},
+                                        {
+                                            "key": 1,
+                                            "value": {
+                                                "nodetype": "formula",
+                                                "expression": "x/10",
+                                                "parser": "TFormula",
+                                                "variables": ["pt"],
+                                            },
+                                        },
+                                    ],
+                                    "default": syst(10 + i),
+                                }
+                                for i in range(3)
+                            ],
+                        },
+                    }
+                ],
+            }
+        )
+    )
+    corr = cset["test corr"]
+    rng = numpy.random.default_rng(42)
+    pt = rng.exponential(40.0, size=(500, 2))
+    dm = numpy.array([0, 10])
+    values = ["down", "nom", "up"]
+    out = corr.evaluate_variations("syst", values, pt, dm)
+    assert out.shape == (500, 2, 3)
+    for k, value in enumerate(values):
+        numpy.testing.assert_array_equal(out[..., k], corr.evaluate(pt, value, dm))
+    numpy.testing.assert_array_equal(
+        corr.evaluate_variations("syst", values, pt, dm, nthreads=2), out
+    )
+
+    dms = numpy.array([0, 1, 10])
+    out = corr.evaluate_variations("dm", dms, pt[:, :1], "up")
+    assert out.shape == (500, 1, 3)
+    for k, value in enumerate(dms):
+        numpy.testing.assert_array_equal(
+            out[..., k], corr.evaluate(pt[:, :1], "up", int(value))
+        )
+
+    out = corr.evaluate_variations("syst", values, 30.0, 0)
+    numpy.testing.assert_array_equal(out, [0.3, 2.0, 2.5])
+
+    jagged = correctionlib._core.JaggedArray(
+        numpy.array([0, 2, 2, 5]), pt[:5, 0].copy()
+    )
+    out = corr.evaluate_variations("syst", values, jagged, dm[:1])
+    assert out.content.shape == (5, 3)
+    numpy.testing.assert_array_equal(out.offsets, jagged.offsets)
+
+    with pytest.raises(RuntimeError, match="wrong type"):
+        corr.evaluate_variations("syst", [1, 2], pt, dm)
+    with pytest.raises(IndexError):
+        corr.evaluate_variations("syst", ["nom", "left"], pt, dm)
+    with pytest.raises(ValueError, match="number of inputs"):
+        corr.evaluate_variations("syst", values, pt)
+
+
+def test_highlevel_evaluate_with_status():
+    Status = correctionlib.highlevel.EvaluationStatus
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet.parse_obj(
+            {
+                "schema_version": model.VERSION,
+                "corrections": [
+                    {
+                        "name": "test corr",
+                        "version": 1,
+                        "inputs": [
+                            {"name": "pt", "type": "real"},
+                            {"name": "eta", "type": "real"},
+                            {"name": "syst", "type": "string"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "data": {
+                            "nodetype": "binning",
+                            "input": "pt",
+                            "edges": [0.0, 20.0, 100.0],
+                            "flow": "error",
+                            "content": [
+                                {
+                                    "nodetype": "category",
+                                    "input": "syst",
+                                    "content": [
+                                        {
+                                            "key": key,
+                                            "value": {
+                                                "nodetype": "multibinning",
+                                                "inputs": ["pt", "eta"],
+                                                "edges": [
+                                                    [0.0, 100.0],
+                                                    [-2.5, 0.0, 2.5],
+                                                ],
+                                                "content": [1.0 + i + k, 1.1 + i + k],
+                                                "flow": "error",
+                                            },
+                                        }
+                                        for k, key in enumerate(["nom", "up"])
+                                    ],
+                                }
+                                for i in range(2)
+                            ],
+                        },
+                    }
+                ],
+                "compound_corrections": [
+                    {
+                        "name": "test compound",
+                        "inputs": [
+                            {"name": "pt", "type": "real"},
+                            {"name": "eta", "type": "real"},
+                            {"name": "syst", "type": "string"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "inputs_update": ["pt"],
+                        "input_op": "*",
+                        "output_op": "*",
+                        "stack": ["test corr", "test corr"],
+                    }
+                ],
+            }
+        )
+    )
+    corr = cset["test corr"]
+    pt = numpy.array([10.0, -1.0, 200.0, numpy.nan, 30.0, 30.0, 60.0])
+    eta = numpy.array([0.5, 0.0, 0.0, 0.0, 3.0, -1.0, -1.0])
+    syst = numpy.array(["nom", "nom", "nom", "nom", "up", "down", "up"])
+    out, status = corr.evaluate_with_status(pt, eta, syst)
+    assert status.dtype == numpy.uint8
+    numpy.testing.assert_array_equal(
+        status,
+        [
+            Status.ok,
+            Status.below_bounds,
+            Status.above_bounds,
+            Status.above_bounds,
+            Status.above_bounds,
+            Status.missing_key,
+            Status.ok,
+        ],
+    )
+    numpy.testing.assert_array_equal(out, [1.1, numpy.nan, *[numpy.nan] * 4, 3.0])
+    good = status == Status.ok
+    numpy.testing.assert_array_equal(
+        out[good], corr.evaluate(pt[good], eta[good], syst[good])
+    )
+    with pytest.raises(RuntimeError, match="below bounds"):
+        corr.evaluate(pt, eta, syst)
+
+    out, status = corr.evaluate_with_status(pt, eta, syst, fill=-1.0, nthreads=2)
+    assert numpy.all(out[~good] == -1.0)
+    # a scalar input shared by all rows fails them all
+    out, status = corr.evaluate_with_status(pt[[0, 4, 6]], 0.5, "down")
+    numpy.testing.assert_array_equal(status, [Status.missing_key] * 3)
+    assert corr.evaluate_with_status(10.0, 0.5, "nom") == (1.1, Status.ok)
+
+    jagged = correctionlib._core.JaggedArray(numpy.array([0, 2, 2, 5]), pt[:5])
+    out, status = corr.evaluate_with_status(jagged, 0.5, "nom")
+    numpy.testing.assert_array_equal(status.offsets, jagged.offsets)
+    numpy.testing.assert_array_equal(status.content, [0, 1, 2, 2, 0])
+
+    # the first failing stage gives the status of a compound row
+    compound = cset.compound["test compound"]
+    pt = numpy.array([10.0, 60.0, 90.0, 30.0])
+    eta = numpy.array([0.5, 0.5, -1.0, -1.0])
+    out, status = compound.evaluate_with_status(pt, eta, "up")
+    numpy.testing.assert_array_equal(
+        status, [Status.ok, Status.above_bounds, Status.above_bounds, Status.ok]
+    )
+    numpy.testing.assert_array_equal(
+        out[[0, 3]], compound.evaluate(pt[[0, 3]], eta[[0, 3]], "up")
+    )
+    assert numpy.all(numpy.isnan(out[[1, 2]]))
+
+
+def test_highlevel_evaluate_out():
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet(
+            schema_version=model.VERSION,
+            corrections=[
+                model.Correction(
+                    name="test corr",
+                    version=2,
+                    inputs=[
+                        model.Variable(name="pt", type="real"),
+                        model.Variable(name="rho", type="real"),
+                    ],
+                    output=model.Variable(name="a scale", type="real"),
+                    data=model.Formula(
+                        nodetype="formula",
+                        expression="x + 1000*y",
+                        parser="TFormula",
+                        variables=["pt", "rho"],
+                    ),
+                )
+            ],
+        )
+    )
+    sf = cset["test corr"]
+    rng = numpy.random.default_rng(42)
+    pt = rng.uniform(size=(1500, 3))
+    rho = rng.uniform(size=3)
+    expected = sf.evaluate(pt, rho)
+
+    out = numpy.empty_like(pt)
+    assert sf.evaluate(pt, rho, out=out) is out
+    numpy.testing.assert_array_equal(out, expected)
+    weights = numpy.full_like(pt, 2.0)
+    sf.evaluate(pt, rho, out=weights, op="multiply")
+    numpy.testing.assert_array_equal(weights, 2.0 * expected)
+    sf.evaluate(pt, rho, out=weights, op="add", nthreads=2)
+    numpy.testing.assert_array_equal(weights, 3.0 * expected)
+    # rows of a column broadcast along the inner axis are gathered
+    column = rng.uniform(size=(1500, 1))
+    weights = numpy.ones(pt.shape)
+    sf.evaluate(pt, column, out=weights, op="multiply")
+    numpy.testing.assert_array_equal(weights, sf.evaluate(pt, column))
+
+    scalar = numpy.zeros(1)
+    sf.evaluate(1.0, 2.0, out=scalar, op="add")
+    numpy.testing.assert_array_equal(scalar, [2001.0])
+
+    jagged = correctionlib._core.JaggedArray(
+        numpy.array([0, 2, 2, 5]), pt[:5, 0].copy()
+    )
+    content = numpy.ones(5)
+    result = sf.evaluate(jagged, rho, out=content, op="multiply")
+    numpy.testing.assert_array_equal(result.offsets, jagged.offsets)
+    numpy.testing.assert_array_equal(content, sf.evaluate(jagged, rho).content)
+
+    with pytest.raises(ValueError, match="requires an out array"):
+        sf.evaluate(pt, rho, op="add")
+    with pytest.raises(ValueError, match="Unknown op"):
+        sf.evaluate(pt, rho, out=out, op="divide")
+    with pytest.raises(ValueError, match="expected"):
+        sf.evaluate(pt, rho, out=numpy.empty(3))
+    with pytest.raises(ValueError, match="float64"):
+        sf.evaluate(pt, rho, out=numpy.empty(pt.shape, dtype=numpy.float32))
+    with pytest.raises(ValueError, match="C-contiguous"):
+        sf.evaluate(pt, rho, out=numpy.empty((3, 1500)).T)
+    with pytest.raises(ValueError, match="overlaps"):
+        sf.evaluate(pt, rho, out=pt, op="multiply")
+
+
+def test_highlevel_evaluate_where():
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet.parse_obj(
+            {
+                "schema_version": model.VERSION,
+                "corrections": [
+                    {
+                        "name": "test corr",
+                        "version": 1,
+                        "inputs": [
+                            {"name": "pt", "type": "real"},
+                            {"name": "genmatch", "type": "int"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "data": {
+                            "nodetype": "category",
+                            "input": "genmatch",
+                            "content": [
+                                {
+                                    "key": 5,
+                                    "value": {
+                                        "nodetype": "formula",
+                                        "expression": "1+x/100",
+                                        "parser": "TFormula",
+                                        "variables": ["pt"],
+                                    },
+                                }
+                            ],
+                        },
+                    }
+                ],
+                "compound_corrections": [
+                    {
+                        "name": "test compound",
+                        "inputs": [
+                            {"name": "pt", "type": "real"},
+                            {"name": "genmatch", "type": "int"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "inputs_update": ["pt"],
+                        "input_op": "*",
+                        "output_op": "*",
+                        "stack": ["test corr", "test corr"],
+                    }
+                ],
+            }
+        )
+    )
+    corr = cset["test corr"]
+    rng = numpy.random.default_rng(42)
+    pt = rng.uniform(20.0, 100.0, size=(1500, 2))
+    # other keys are missing, so evaluating those rows would raise
+    genmatch = rng.choice([0, 5], size=(1500, 2))
+    where = genmatch == 5
+    out = corr.evaluate(pt, genmatch, where=where)
+    numpy.testing.assert_array_equal(out[where], 1 + pt[where] / 100)
+    assert numpy.all(numpy.isnan(out[~where]))
+
+    weights = numpy.full(pt.shape, 2.0)
+    corr.evaluate(pt, genmatch, out=weights, where=where, op="multiply", nthreads=2)
+    numpy.testing.assert_array_equal(weights[where], 2 * (1 + pt[where] / 100))
+    numpy.testing.assert_array_equal(weights[~where], 2.0)
+
+    indices = numpy.flatnonzero(where)
+    numpy.testing.assert_array_equal(
+        corr.evaluate(pt, genmatch, where=indices, fill=1.0),
+        numpy.where(where, out, 1.0),
+    )
+    numpy.testing.assert_array_equal(
+        corr.evaluate(pt, 5, where=[-1])[-1], [numpy.nan, 1 + pt[-1, 1] / 100]
+    )
+    # a mask broadcast along the rows
+    out = corr.evaluate(pt, 5, where=numpy.array([True, False]))
+    assert numpy.all(numpy.isnan(out[:, 1]))
+    numpy.testing.assert_array_equal(out[:, 0], 1 + pt[:, 0] / 100)
+
+    compound = cset.compound["test compound"]
+    out = compound.evaluate(pt, genmatch, where=where)
+    numpy.testing.assert_array_equal(
+        out[where], compound.evaluate(pt[where], genmatch[where])
+    )
+    assert numpy.all(numpy.isnan(out[~where]))
+
+    jagged = correctionlib._core.JaggedArray(
+        numpy.array([0, 2, 2, 5]), pt[:5, 0].copy()
+    )
+    out = corr.evaluate(jagged, 5, where=numpy.array([0, 4]))
+    numpy.testing.assert_array_equal(numpy.isnan(out.content), [0, 1, 1, 1, 0])
+
+    with pytest.raises(IndexError, match="out of range"):
+        corr.evaluate(pt, genmatch, where=[3000])
+    with pytest.raises(ValueError, match="boolean mask or an array of indices"):
+        corr.evaluate(pt, genmatch, where=numpy.ones(3))
+    with pytest.raises(ValueError):
+        corr.evaluate(pt, genmatch, where=numpy.ones(3, dtype=bool))
+
+
+def test_highlevel_scalar_evaluator():
+    cset = correctionlib.CorrectionSet(
+        model.CorrectionSet.parse_obj(
+            {
+                "schema_version": model.VERSION,
+                "corrections": [
+                    {
+                        "name": "test corr",
+                        "version": 1,
+                        "inputs": [
+                            {"name": "pt", "type": "real"},
+                            {"name": "dm", "type": "int"},
+                            {"name": "syst", "type": "string"},
+                        ],
+                        "output": {"name": "sf", "type": "real"},
+                        "data": {
+                            "nodetype": "category",
+                            "input": "syst",
+                            "content": [
+                                {
+                                    "key": "nom",
+                                    "value": {
+                                        "nodetype": "category",
+                                        "input": "dm",
+                                        "content": [
+                                            {
+                                                "key": dm,
+                                                "value": {
+                                                    "nodetype": "formula",
+                                                    "expression": f"{dm}*x",
+                                                    "parser": "TFormula",
+                                                    "variables": ["pt"],
+                                                },
+                                            }
+                                            for dm in (1, 3)
+                                        ],
+                                    },
+                                }
+                            ],
+                        },
+                    }
+                ],
+            }
+        )
+    )
+    corr = cset["test corr"]
+    scalar = corr._base._scalar_evaluator
+    assert scalar(2.5, 3, "nom") == corr._base.evaluate(2.5, 3, "nom") == 7.5
+    assert corr.evaluate(2.5, True, "nom") == 2.5
+    assert corr.evaluate(numpy.float64(2.5), numpy.int64(3), "nom") == 7.5
+    # arguments not matching the inputs are left to the generic evaluate
+    for args in [(2.5, 3), (2, 3, "nom"), (2.5, 2**40, "nom"), (2.5, 3, b"nom")]:
+        with pytest.raises(TypeError):
+            scalar(*args)
+    with pytest.raises(RuntimeError):
+        corr.evaluate(2, 3, "nom")
+    with pytest.raises(RuntimeError):
+        corr.evaluate(2.5, 2**40, "nom")
+    with pytest.raises(IndexError):
+        scalar(2.5, 3, "up")
+    with pytest.raises(IndexError):
+        corr.evaluate(2.5, 3, "up")
+    # the evaluator keeps the correction alive
+    del cset, corr
+    assert scalar(2.0, 3, "nom") == 6.0
+
+
+def test_highlevel_lazy(tmp_path):
+    def correction(name, value):
+        return {
+            "name": name,
+            "version": 1,
+            "inputs": [{"name": "x", "type": "real"}],
+            "output": {"name": "sf", "type": "real"},
+            "data": {
+                "nodetype": "formula",
+                "expression": f"x*{value}",
+                "parser": "TFormula",
+                "variables": ["x"],
+            },
+        }
+
+    broken = correction("broken", 1)
+    broken["data"]["expression"] = "x*("
+    data = {
+        "schema_version": model.VERSION,
+        "corrections": [correction(f"corr{i}", i) for i in range(5)] + [broken],
+        "compound_corrections": [
+            {
+                "name": "stack",
+                "inputs": [{"name": "x", "type": "real"}],
+                "output": {"name": "sf", "type": "real"},
+                "inputs_update": [],
+                "input_op": "*",
+                "output_op": "*",
+                "stack": ["corr2", "corr3"],
+            }
+        ],
+    }
+    text = json.dumps(data)
+    with pytest.raises(RuntimeError):
+        correctionlib.CorrectionSet.from_string(text)
+    cset = correctionlib.CorrectionSet.from_string(text, lazy=True)
+    assert len(cset) == 6
+    assert set(cset) == {"broken"} | {f"corr{i}" for i in range(5)}
+    assert "corr1" in cset and "corr9" not in cset
+    assert cset["corr3"].evaluate(2.0) == 6.0
+    assert cset.compound["stack"].evaluate(2.0) == 24.0
+    with pytest.raises(RuntimeError):
+        cset["broken"]
+    with pytest.raises(RuntimeError):
+        cset["broken"]
+
+    cset = pickle.loads(pickle.dumps(cset))
+    assert cset["corr4"].evaluate(1.5) == 6.0
+
+    path = tmp_path / "lazy.json"
+    del data["corrections"][-1]
+    path.write_text(json.dumps(data))
+    base = correctionlib._core.CorrectionSet.from_file(str(path), lazy=True)
+    # first accesses from several threads share a single build
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        corrs = list(pool.map(lambda _: base["corr1"], range(8)))
+    assert all(corr is corrs[0] for corr in corrs)
+    assert [name for name in base] == [f"corr{i}" for i in range(5)]
+
+    with pytest.raises(RuntimeError, match="JSON parse error"):
+        correctionlib.CorrectionSet.from_string(text[:-1], lazy=True)
+    data["corrections"].append("not a correction")
+    with pytest.raises(RuntimeError, match="Expected Correction object"):
+        correctionlib.CorrectionSet.from_string(json.dumps(data), lazy=True)
+
+
+def test_highlevel_parallel_load():
+    def correction(i, expression):
+        return {
+            "name": f"corr{i:02d}",
+            "version": 1,
+            "inputs": [{"name": "x", "type": "real"}],
+            "output": {"name": "sf", "type": "real"},
+            "data": {
+                "nodetype": "formula",
+                "expression": expression,
+                "parser": "TFormula",
+                "variables": ["x"],
+            },
+        }
+
+    corrections = [correction(i, f"x*{i}+log(x)") for i in range(40)]
+    text = json.dumps({"schema_version": model.VERSION, "corrections": corrections})
+    serial = correctionlib.CorrectionSet.from_string(text)
+    parallel = correctionlib.CorrectionSet.from_string(text, nthreads=4)
+    assert list(parallel) == list(serial)
+    for name in serial:
+        assert parallel[name].evaluate(3.0) == serial[name].evaluate(3.0)
+
+    # the error is that of the first invalid correction, whatever the threads
+    corrections[7] = correction(7, "x*(")
+    corrections[31] = correction(31, "x+")
+    corrections.append({"name": "last"})
+    text = json.dumps({"schema_version": model.VERSION, "corrections": corrections})
+    with pytest.raises(RuntimeError) as serial_error:
+        correctionlib.CorrectionSet.from_string(text)
+    for nthreads in (0, 2, 4):
+        with pytest.raises(RuntimeError) as error:
+            correctionlib.CorrectionSet.from_string(text, nthreads=nthreads)
+        assert str(error.value) == str(serial_error.value)
+
+    # an invalid correction is still built while later ones fail first
+    corrections = [correction(i, f"x*{i}") for i in range(16)]
+    corrections[9] = correction(9, "+".join(["log(x)"] * 200) + "*(")
+    corrections += ["not a correction"] * 100
+    text = json.dumps({"schema_version": model.VERSION, "corrections": corrections})
+    for _ in range(10):
+        with pytest.raises(RuntimeError, match="Failed to parse Formula expression"):
+            correctionlib.CorrectionSet.from_string(text, nthreads=8)